@@ -0,0 +1,92 @@
+"""
+Cold start benchmark of the AWS client setup
+Each scenario runs in a fresh interpreter and reports the import time, the client setup time of the first
+request, their total, and the setup time of a second request in the same (warm) process. No AWS call is made,
+only clients are built. Both scenarios build the same set: the comprehend, dynamodb and s3 clients, the dynamodb
+table resource, and the dynamodb type serializer.
+
+- eager: the previous behaviour, clients built at import time and a new comprehend client per request
+- registry: clients built on first use by ClientRegistry and reused by later requests
+
+Usage: python benchmarks/bench_cold_start.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+EAGER_SCENARIO = '''
+import time
+start = time.perf_counter()
+import boto3
+import boto3.dynamodb.types
+dynamodb_client = boto3.client('dynamodb', region_name='us-east-1')
+scrub_xform_table = boto3.resource('dynamodb', region_name='us-east-1').Table('scrub_transforms')
+serializer = boto3.dynamodb.types.TypeSerializer()
+s3_client = boto3.client('s3')
+import_seconds = time.perf_counter() - start
+request_seconds = []
+for _ in range(2):
+    start = time.perf_counter()
+    comprehend_client = boto3.client('comprehend')
+    request_seconds.append(time.perf_counter() - start)
+'''
+
+REGISTRY_SCENARIO = '''
+import time
+import bootstrap
+bootstrap.register_package()
+start = time.perf_counter()
+import anonymizer.app
+import anonymizer.anonymizer as anonymizer
+import anonymizer.InferenceFacade as InferenceFacade
+import_seconds = time.perf_counter() - start
+request_seconds = []
+for _ in range(2):
+    start = time.perf_counter()
+    InferenceFacade.InferenceFacade(language_code='en').comprehend_client
+    anonymizer.my_dynamo.dynamodb_client
+    anonymizer.my_dynamo.scrub_xform_table
+    anonymizer.my_dynamo.serializer
+    anonymizer.my_s3.s3_client
+    request_seconds.append(time.perf_counter() - start)
+'''
+
+REPORT = '''
+import json
+print(json.dumps({'import_seconds': import_seconds, 'first_request_seconds': request_seconds[0],
+                  'warm_request_seconds': request_seconds[1]}))
+'''
+
+SCENARIOS = {'eager': EAGER_SCENARIO, 'registry': REGISTRY_SCENARIO}
+
+
+def run_scenario(code: str) -> dict:
+    """
+    :param code: the scenario to run in a fresh interpreter
+    :return: the timings reported by the scenario
+    """
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    output = subprocess.run([sys.executable, '-c', code + REPORT], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'scenario':>10} {'import ms':>10} {'1st request ms':>15} {'cold total ms':>14} {'warm request ms':>16}")
+    for name, code in SCENARIOS.items():
+        runs = [run_scenario(code) for _ in range(args.runs)]
+        medians = {metric: statistics.median(run[metric] for run in runs) * 1000 for metric in runs[0]}
+        cold_total = statistics.median(run['import_seconds'] + run['first_request_seconds'] for run in runs) * 1000
+        print(f"{name:>10} {medians['import_seconds']:>10.1f} {medians['first_request_seconds']:>15.1f} "
+              f"{cold_total:>14.1f} {medians['warm_request_seconds']:>16.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Parity check and benchmark of the batched French detection
+Runs the French corpus through the sagemaker stand-in one text per invocation, and as inputs arrays, checks
+that both give the same entities for every text, then compares their throughput.
+
+Usage: python benchmarks/bench_fr_batching.py [--records 500] [--text-length 300] [--latency-ms 40]
+"""
+import argparse
+import sys
+import time
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.InferenceFacade as InferenceFacade  # noqa: E402
+import corpus  # noqa: E402
+import stand_ins  # noqa: E402
+
+# Texts the corpus does not produce: empty, entity at offset 0, non ascii, a single entity
+EDGE_TEXTS = ['', 'Camille Martin appelle', 'Société Générique à Lyon', 'Hugo Petit']
+
+
+def install_stand_ins(latency_seconds: float, low_score_rate: float) -> stand_ins.StandIns:
+    """
+    :return: the installed stand-ins, the sagemaker one giving a low score to a fraction of the entities
+    """
+    services = stand_ins.StandIns(corpus.vocabulary('fr'),
+                                  sagemaker_model=stand_ins.ServiceModel(latency_seconds=latency_seconds))
+    services.sagemaker_runtime.low_score_rate = low_score_rate
+    services.install()
+    return services
+
+
+def detect_single(texts: list) -> list:
+    my_inference = InferenceFacade.InferenceFacade(language_code='fr')
+    return [my_inference.detect_pii_entities(text) for text in texts]
+
+
+def detect_batched(texts: list) -> list:
+    my_inference = InferenceFacade.InferenceFacade(language_code='fr')
+    return my_inference.detect_pii_entities_packed(texts)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--text-length', type=int, default=300)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--low-score-rate', type=float, default=0.2, help='fraction of entities with a low score')
+    parser.add_argument('--latency-ms', type=float, default=40.0, help='latency of an invocation')
+    args = parser.parse_args()
+
+    texts = EDGE_TEXTS + [record['text'] for record in
+                          corpus.generate_records(args.records, args.text_length, args.density, 'fr')]
+    install_stand_ins(0.0, args.low_score_rate)
+    single, batched = detect_single(texts), detect_batched(texts)
+    mismatches = [index for index, (expected, actual) in enumerate(zip(single, batched)) if expected != actual]
+    entity_count = sum(len(transforms['Transforms']) for transforms in single)
+    print(f"parity: {len(texts)} texts, {entity_count} entities, {len(mismatches)} mismatches")
+    if mismatches or len(single) != len(batched):
+        print(f"first mismatch at text {mismatches[0] if mismatches else len(batched)}")
+        return 1
+
+    for name, detect in [('single', detect_single), ('batched', detect_batched)]:
+        services = install_stand_ins(args.latency_ms / 1000, args.low_score_rate)
+        start = time.perf_counter()
+        detect(texts)
+        elapsed = time.perf_counter() - start
+        calls = services.stats()['sagemaker_runtime']['calls']
+        print(f"{name:>8}: {len(texts) / elapsed:>9.1f} texts/s, {calls} invocations")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+Benchmark of the gazetteer backend of InferenceFacade
+Builds the Aho-Corasick automaton of synthetic customer dictionaries, of generated person names completed with the
+names, locations and organizations of the corpus, then reports the build time and file size, the time to open the
+memory mapped file as a warm start does, and the detection throughput on corpus records.
+
+Usage: python benchmarks/bench_gazetteer.py [--terms 300000] [--records 2000] [--text-lengths 200 2000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.GazetteerDetector as GazetteerDetector  # noqa: E402
+import corpus  # noqa: E402
+
+SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'ha', 'je', 'ki', 'lo', 'mu', 'na', 'pe', 'ri', 'so', 'tu', 'va', 'ze']
+
+
+def generate_dictionaries(term_count: int, seed: int = 11) -> dict:
+    """
+    :param term_count: the number of generated person names
+    :param seed: the seed of the generated names
+    :return: dict of category to its terms, the corpus entities included
+    """
+    rng = random.Random(seed)
+
+    def generated_word():
+        return ''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))).capitalize()
+
+    first_names = [generated_word() for _ in range(max(1, term_count // 100))]
+    names = {f"{rng.choice(first_names)} {generated_word()}" for _ in range(term_count)}
+    for language_code in ['en', 'fr']:
+        names.update(f"{first} {last}" for first in corpus.FIRST_NAMES[language_code]
+                     for last in corpus.LAST_NAMES[language_code])
+    return {GazetteerDetector.CATEGORY_NAMES: sorted(names),
+            GazetteerDetector.CATEGORY_ORGANIZATIONS: corpus.ORGANIZATIONS['en'] + corpus.ORGANIZATIONS['fr'],
+            GazetteerDetector.CATEGORY_LOCATIONS: corpus.LOCATIONS['en'] + corpus.LOCATIONS['fr']}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--terms', type=int, default=300000)
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--text-lengths', nargs='+', type=int, default=[200, 2000])
+    parser.add_argument('--languages', nargs='+', default=['en', 'fr'], choices=['en', 'fr'])
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    dictionaries = generate_dictionaries(args.terms)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'gazetteer.bin')
+        start_time = time.perf_counter()
+        built = GazetteerDetector.build_automaton(dictionaries, path)
+        build_seconds = time.perf_counter() - start_time
+        print(f"build: {built['terms']} terms, {built['words']} words, {built['states']} states, "
+              f"{built['bytes'] / 1e6:.1f} MB in {build_seconds:.2f} s")
+        start_time = time.perf_counter()
+        automaton = GazetteerDetector.GazetteerAutomaton(path)
+        print(f"open (warm start): {(time.perf_counter() - start_time) * 1000:.3f} ms, "
+              f"{build_seconds / (time.perf_counter() - start_time):.0f}x faster than the build")
+        print(f"{'lang':>4} {'length':>6} {'texts/s':>9} {'MB/s':>6} {'entities':>9} {'ms/text':>8}")
+        for language_code in args.languages:
+            detector = GazetteerDetector.GazetteerDetector(automaton, language_code)
+            for text_length in args.text_lengths:
+                texts = [record['text'] for record in
+                         corpus.generate_records(args.records, text_length, 0.05, language_code)]
+                start_time = time.perf_counter()
+                entities = sum(len(detector.detect_pii_entities(text)['Transforms']) for text in texts)
+                elapsed = time.perf_counter() - start_time
+                megabytes = sum(len(text.encode('utf-8')) for text in texts) / 1e6
+                print(f"{language_code:>4} {text_length:>6} {len(texts) / elapsed:>9.0f} {megabytes / elapsed:>6.2f} "
+                      f"{entities:>9} {elapsed * 1000 / len(texts):>8.3f}")
+        automaton.close()
+
+
+if __name__ == '__main__':
+    main()
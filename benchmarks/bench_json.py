@@ -0,0 +1,119 @@
+"""
+Micro-benchmark of the JSON encoders on the documents the service serializes
+Compares the json module as the service used it, JsonCodec on the json module, and JsonCodec on orjson when it is
+installed, for records of growing text length: the client response body, the JSON Lines of the s3 output and input,
+and the payload and response of the French sagemaker endpoint.
+
+Usage: python benchmarks/bench_json.py [--records 1000] [--text-lengths 200 2000 20000] [--languages en fr]
+"""
+import argparse
+import contextlib
+import json
+import timeit
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.InferenceFacade as InferenceFacade  # noqa: E402
+import anonymizer.JsonCodec as JsonCodec  # noqa: E402
+import corpus  # noqa: E402
+
+ENCODER_STDLIB_DEFAULT = 'json (before)'
+
+
+@contextlib.contextmanager
+def using_encoder(encoder: str):
+    """
+    Make JsonCodec use the encoder, the json module if orjson is not the one
+    """
+    saved = JsonCodec.orjson
+    if encoder != JsonCodec.ENCODER_ORJSON:
+        JsonCodec.orjson = None
+    try:
+        yield
+    finally:
+        JsonCodec.orjson = saved
+
+
+def stdlib_operations(records: list, lines: list, payload: dict, response: bytes) -> dict:
+    """
+    :return: dict of operation to the function doing it with the json module, the way the service did
+    """
+    return {
+        'client body': lambda: json.dumps(records),
+        'jsonl encode': lambda: [json.dumps(record).encode('utf-8') + b'\n' for record in records],
+        'jsonl decode': lambda: [json.loads(line) for line in lines],
+        'fr payload': lambda: bytes(json.dumps(payload), 'utf-8'),
+        'fr response': lambda: json.loads(response.decode('utf-8'))
+    }
+
+
+def codec_operations(records: list, lines: list, payload: dict, response: bytes) -> dict:
+    """
+    :return: dict of operation to the function doing it with JsonCodec
+    """
+    return {
+        'client body': lambda: JsonCodec.dumps_text(records),
+        'jsonl encode': lambda: [JsonCodec.dumps(record) + b'\n' for record in records],
+        'jsonl decode': lambda: [JsonCodec.loads(line) for line in lines],
+        'fr payload': lambda: JsonCodec.dumps(payload),
+        'fr response': lambda: JsonCodec.loads(response)
+    }
+
+
+def best_time(function, repeat: int = 5) -> float:
+    """
+    :return: the best time of a few runs, in seconds
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def build_documents(records: list, language_code: str) -> (list, dict, bytes):
+    """
+    :return: the JSON Lines of the records, the sagemaker payload of their texts, and a sagemaker response
+    """
+    lines = [json.dumps(record).encode('utf-8') for record in records]
+    texts = [record['text'] for record in records]
+    payload = {'inputs': texts, 'parameters': {'entities': InferenceFacade.FR_ENTITIES}}
+    found = [{'found': [{'entity_type': 'PERSON', 'start': 10, 'end': 21, 'score': 0.97, 'word': 'Marie Curie'}]
+              * max(1, len(text) // 200)} for text in texts]
+    return lines, payload, json.dumps(found, ensure_ascii=language_code == 'en').encode('utf-8')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--text-lengths', nargs='+', type=int, default=[200, 2000, 20000])
+    parser.add_argument('--languages', nargs='+', default=['en', 'fr'], choices=['en', 'fr'])
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    encoders = [ENCODER_STDLIB_DEFAULT, JsonCodec.ENCODER_STDLIB]
+    if JsonCodec.orjson is not None:
+        encoders.append(JsonCodec.ENCODER_ORJSON)
+    print(f"{'lang':>4} {'length':>6} {'operation':>13} " + ' '.join(f"{encoder + ' ms':>16}" for encoder in encoders)
+          + f" {'MB':>7} {'speedup':>8}")
+    for language_code in args.languages:
+        for text_length in args.text_lengths:
+            records = corpus.generate_records(args.records, text_length, 0.05, language_code)
+            lines, payload, response = build_documents(records, language_code)
+            timings = {}
+            for encoder in encoders:
+                with using_encoder(encoder):
+                    operations = stdlib_operations(records, lines, payload, response) \
+                        if encoder == ENCODER_STDLIB_DEFAULT else codec_operations(records, lines, payload, response)
+                    timings[encoder] = {operation: best_time(function) for operation, function in operations.items()}
+            for operation in timings[ENCODER_STDLIB_DEFAULT]:
+                megabytes = len(JsonCodec.dumps(records)) / 1e6 if operation.startswith(('client', 'jsonl')) \
+                    else len(response if operation == 'fr response' else JsonCodec.dumps(payload)) / 1e6
+                times = [timings[encoder][operation] for encoder in encoders]
+                print(f"{language_code:>4} {text_length:>6} {operation:>13} "
+                      + ' '.join(f"{elapsed * 1000:>16.2f}" for elapsed in times)
+                      + f" {megabytes:>7.2f} {times[0] / times[-1]:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Benchmark of the micro-batching HTTP server, fully offline
+Starts server.py on a free local port against the stand-ins of stand_ins.py, and runs concurrent clients, each
+posting requests of a few records on a keep-alive connection. Compares a batch per request with the records of
+concurrent requests coalesced in shared batches, and reports records per second, request latency percentiles,
+records per batch, and the service calls per record.
+
+Usage: python benchmarks/bench_server.py [--clients 1 8 32] [--requests-per-client 20] [--records-per-request 2]
+           [--text-length 200] [--max-wait-ms 10] [--latency-scale 1.0]
+"""
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.anonymizer as anonymizer  # noqa: E402
+import anonymizer.DetectionCache as DetectionCache  # noqa: E402
+import anonymizer.Metrics as Metrics  # noqa: E402
+import anonymizer.MicroBatcher as MicroBatcher  # noqa: E402
+import anonymizer.RateLimiter as RateLimiter  # noqa: E402
+import anonymizer.server as server  # noqa: E402
+import corpus  # noqa: E402
+import stand_ins  # noqa: E402
+
+# Typical latency of each service, in milliseconds, scaled by --latency-scale
+SERVICE_LATENCY_MS = {
+    'comprehend': 25.0,
+    'dynamodb': 6.0
+}
+# Records of each batch mode at most, a batch per request or shared batches
+BATCH_MODES = {
+    'per_request': 1,
+    'micro_batched': MicroBatcher.DEFAULT_MAX_BATCH_RECORDS
+}
+
+
+def run_client(port: int, requests: list, latencies: list, errors: list) -> None:
+    """
+    Post the requests one after the other on one keep-alive connection
+    """
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        for event in requests:
+            body = json.dumps(event)
+            start = time.perf_counter()
+            connection.request('POST', server.ANONYMIZE_PATH, body=body,
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            records = json.loads(response.read())
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200 or [record['id'] for record in records] != \
+                    [record['id'] for record in event['records']]:
+                errors.append(f"status {response.status}")
+    finally:
+        connection.close()
+
+
+def run_case(batch_mode: str, clients: int, args) -> dict:
+    """
+    Run the clients against a new server
+    :return: the result of the case
+    """
+    latency = SERVICE_LATENCY_MS['comprehend'] * args.latency_scale / 1000
+    services = stand_ins.StandIns(
+        corpus.vocabulary('en'),
+        comprehend_model=stand_ins.ServiceModel(latency_seconds=latency),
+        dynamodb_model=stand_ins.ServiceModel(latency_seconds=SERVICE_LATENCY_MS['dynamodb'] * args.latency_scale
+                                              / 1000))
+    services.install()
+    anonymizer.detection_cache = DetectionCache.DetectionCache()
+    RateLimiter.reset()
+    metrics = Metrics.MetricsRecorder()
+    batcher = MicroBatcher.MicroBatcher(server.create_batch_processor(metrics),
+                                        max_batch_records=BATCH_MODES[batch_mode],
+                                        max_wait_seconds=args.max_wait_ms / 1000, workers=args.workers)
+    http_server = server.create_server(batcher, metrics, port=0)
+    serving = threading.Thread(target=http_server.serve_forever, daemon=True)
+    serving.start()
+    control = {'language_code': 'en', 'field_name': 'text', anonymizer.PACKED_DETECTION_OPTION: True}
+    records = corpus.generate_records(clients * args.requests_per_client * args.records_per_request,
+                                      args.text_length, 0.05, 'en', seed=args.seed)
+    requests = [[{'metadata': {'control': control},
+                  'records': records[start:start + args.records_per_request]}
+                 for start in range(client * args.requests_per_client * args.records_per_request,
+                                    (client + 1) * args.requests_per_client * args.records_per_request,
+                                    args.records_per_request)]
+                for client in range(clients)]
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=run_client, args=(http_server.server_address[1], client_requests, latencies,
+                                                         errors))
+               for client_requests in requests]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    http_server.shutdown()
+    http_server.server_close()
+    batcher.close()
+    calls = services.stats()
+    latencies.sort()
+    return {'batch_mode': batch_mode,
+            'clients': clients,
+            'records': len(records),
+            'errors': len(errors),
+            'records_per_second': len(records) / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            'records_per_batch': batcher.stats()['records_per_batch'],
+            'comprehend_calls_per_record': calls['comprehend']['calls'] / len(records),
+            'dynamodb_calls_per_record': calls['dynamodb']['calls'] / len(records)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', nargs='+', type=int, default=[1, 8, 32])
+    parser.add_argument('--requests-per-client', type=int, default=20)
+    parser.add_argument('--records-per-request', type=int, default=2)
+    parser.add_argument('--text-length', type=int, default=200)
+    parser.add_argument('--max-wait-ms', type=float, default=MicroBatcher.DEFAULT_MAX_WAIT_SECONDS * 1000)
+    parser.add_argument('--workers', type=int, default=MicroBatcher.DEFAULT_WORKERS)
+    parser.add_argument('--latency-scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=5)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    print(f"{'batch mode':>14} {'clients':>7} {'records/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'rec/batch':>9} "
+          f"{'comprehend/rec':>14} {'dynamodb/rec':>12} {'errors':>6}")
+    for clients in args.clients:
+        for batch_mode in BATCH_MODES:
+            result = run_case(batch_mode, clients, args)
+            print(f"{result['batch_mode']:>14} {result['clients']:>7} {result['records_per_second']:>10.0f} "
+                  f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['records_per_batch']:>9.1f} "
+                  f"{result['comprehend_calls_per_record']:>14.3f} {result['dynamodb_calls_per_record']:>12.3f} "
+                  f"{result['errors']:>6}")
+
+
+if __name__ == '__main__':
+    main()
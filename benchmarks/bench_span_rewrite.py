@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the span rewrite engine of ScrubTransforms
+Compares generate_anonymous_text and generate_original_text with the previous string concatenation, for a
+growing number of entities, the text length growing with it. Time per entity should stay flat.
+
+Usage: python benchmarks/bench_span_rewrite.py
+"""
+import copy
+import timeit
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.ScrubTransforms as ScrubTransforms  # noqa: E402
+
+ENTITY_COUNTS = [100, 1000, 10000, 50000]
+FILLER = "please call me back about the ticket, "
+NAME = "Marie Curie"
+
+
+def concatenate_anonymous_text(text: str, transform_as_dict: dict) -> (str, dict):
+    """
+    The previous implementation, appending to the output and measuring it on every transform
+    """
+    anonymous_text = ""
+    offset = 0
+    for transform in transform_as_dict['Transforms']:
+        anonymous_text += text[offset:transform['BeginOffset']]
+        transform['AnonBeginOffset'] = len(anonymous_text)
+        anonymous_text += transform['Anonymized']
+        transform['AnonEndOffset'] = len(anonymous_text)-1
+        offset = transform['EndOffset']
+    anonymous_text += text[offset:len(text)]
+    return anonymous_text, transform_as_dict
+
+
+def build_document(entity_count: int) -> (str, dict):
+    """
+    :param entity_count: the number of entities in the document
+    :return: the text, and its transforms ready to be applied
+    """
+    pieces = []
+    transforms = []
+    offset = 0
+    for _ in range(entity_count):
+        pieces.append(FILLER)
+        offset += len(FILLER)
+        pieces.append(NAME)
+        transforms.append({'Type': 'PERSON', 'BeginOffset': offset, 'EndOffset': offset + len(NAME),
+                           'Original': NAME, 'Anonymized': 'John Doe'})
+        offset += len(NAME)
+    return ''.join(pieces), {'Transforms': transforms}
+
+
+def time_call(function, text: str, transforms: dict, repeat=5) -> float:
+    """
+    :return: the best time of a few runs, in seconds, each run on a fresh copy of the transforms
+    """
+    best = None
+    for _ in range(repeat):
+        transforms_copy = copy.deepcopy(transforms)
+        elapsed = timeit.timeit(lambda: function(text, transforms_copy), number=1)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    print(f"{'entities':>10} {'text chars':>12} {'concat ms':>10} {'engine ms':>10} {'revert ms':>10} "
+          f"{'engine us/entity':>17}")
+    for entity_count in ENTITY_COUNTS:
+        text, transforms = build_document(entity_count)
+        anonymous_text, complete_transforms = ScrubTransforms.ScrubTransforms.generate_anonymous_text(
+            text, copy.deepcopy(transforms))
+        assert (anonymous_text, complete_transforms) == concatenate_anonymous_text(text, copy.deepcopy(transforms))
+        assert ScrubTransforms.ScrubTransforms.generate_original_text(anonymous_text, complete_transforms) == text
+        concat_time = time_call(concatenate_anonymous_text, text, transforms)
+        engine_time = time_call(ScrubTransforms.ScrubTransforms.generate_anonymous_text, text, transforms)
+        revert_time = time_call(ScrubTransforms.ScrubTransforms.generate_original_text, anonymous_text,
+                                complete_transforms)
+        print(f"{entity_count:>10} {len(text):>12} {concat_time * 1000:>10.2f} {engine_time * 1000:>10.2f} "
+              f"{revert_time * 1000:>10.2f} {engine_time / entity_count * 1e6:>17.3f}")
+
+
+if __name__ == '__main__':
+    main()
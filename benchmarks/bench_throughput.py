@@ -0,0 +1,271 @@
+"""
+End-to-end throughput benchmark, fully offline
+Runs app.lambda_handler, anonymize_records and revert_records against the in-process stand-ins of
+stand_ins.py over synthetic corpora, and writes records per second and request latency percentiles to a JSON
+report, so results can be compared between releases.
+
+Usage: python benchmarks/bench_throughput.py [--records 100] [--text-lengths 200 2000] [--densities 0.05]
+           [--languages en fr] [--scenarios baseline packed] [--transform-store dynamodb]
+           [--output benchmark_report.json]
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import platform
+import statistics
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import bootstrap
+
+bootstrap.register_package()
+
+import anonymizer.anonymizer as anonymizer  # noqa: E402
+import anonymizer.anonymizer_async as anonymizer_async  # noqa: E402
+import anonymizer.app as app  # noqa: E402
+import anonymizer.DetectionCache as DetectionCache  # noqa: E402
+import anonymizer.Metrics as Metrics  # noqa: E402
+import anonymizer.RateLimiter as RateLimiter  # noqa: E402
+import anonymizer.RevertTokens as RevertTokens  # noqa: E402
+import anonymizer.TransformStore as TransformStore  # noqa: E402
+import corpus  # noqa: E402
+import stand_ins  # noqa: E402
+
+ENTRYPOINTS = ['lambda_handler', 'lambda_handler_s3', 'anonymize_records', 'anonymize_records_async',
+               'revert_records', 'revert_records_async']
+REVERT_ENTRYPOINTS = ['revert_records', 'revert_records_async']
+
+# Processing options of each scenario, as control parameters of the request
+SCENARIOS = {
+    'baseline': {},
+    'packed': {anonymizer.PACKED_DETECTION_OPTION: True},
+    'concurrent': {anonymizer.CONCURRENCY_OPTION: 8},
+    'packed_concurrent': {anonymizer.PACKED_DETECTION_OPTION: True, anonymizer.CONCURRENCY_OPTION: 8},
+    'pre_detection': {anonymizer.PRE_DETECTION_OPTION: 'conservative'},
+    'irreversible': {anonymizer.REVERSIBLE_OPTION: False},
+    'packed_concurrent_irreversible': {anonymizer.PACKED_DETECTION_OPTION: True, anonymizer.CONCURRENCY_OPTION: 8,
+                                       anonymizer.REVERSIBLE_OPTION: False},
+    'revert_token': {anonymizer.REVERT_MODE_OPTION: anonymizer.REVERT_MODE_TOKEN},
+    'packed_concurrent_revert_token': {anonymizer.PACKED_DETECTION_OPTION: True, anonymizer.CONCURRENCY_OPTION: 8,
+                                       anonymizer.REVERT_MODE_OPTION: anonymizer.REVERT_MODE_TOKEN}
+}
+
+# Scenarios whose output has no revert_key, revert_records does not run them
+IRREVERSIBLE_SCENARIOS = [name for name, options in SCENARIOS.items()
+                          if not options.get(anonymizer.REVERSIBLE_OPTION, True)]
+
+# Options that revert_records accepts
+REVERT_OPTIONS = [anonymizer.CONCURRENCY_OPTION]
+
+# Typical latency of each service, in milliseconds, scaled by --latency-scale
+SERVICE_LATENCY_MS = {
+    'comprehend': 25.0,
+    'sagemaker_runtime': 40.0,
+    'dynamodb': 6.0,
+    's3': 15.0
+}
+
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    :return: the value at the fraction of the sorted values, interpolated
+    """
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def create_stand_ins(language_code: str, args) -> stand_ins.StandIns:
+    """
+    :return: stand-ins knowing the corpus vocabulary, with the latency, jitter and throttling of the arguments
+    """
+    def model(service):
+        latency = SERVICE_LATENCY_MS[service] * args.latency_scale / 1000
+        return stand_ins.ServiceModel(latency_seconds=latency, jitter_seconds=latency * args.jitter,
+                                      throttle_rate=args.throttle_rate, seed=args.seed, max_rate=args.max_rate)
+    return stand_ins.StandIns(corpus.vocabulary(language_code), comprehend_model=model('comprehend'),
+                              sagemaker_model=model('sagemaker_runtime'), dynamodb_model=model('dynamodb'),
+                              s3_model=model('s3'))
+
+
+def create_transform_store(store: str, directory: str) -> TransformStore.TransformStore:
+    """
+    :param store: one of TransformStore.STORES
+    :param directory: the directory of the SQLite database files
+    :return: a new empty transform store, the dynamodb one writes to the stand-in
+    """
+    if store == TransformStore.STORE_SQLITE:
+        file_descriptor, path = tempfile.mkstemp(suffix='.db', dir=directory)
+        os.close(file_descriptor)
+        return TransformStore.SQLiteTransformStore(path)
+    if store == TransformStore.STORE_MEMORY:
+        return TransformStore.InMemoryTransformStore()
+    return TransformStore.DynamoDBTransformStore(anonymizer.my_dynamo)
+
+
+def run_request(entrypoint: str, records: list, language_code: str, options: dict) -> None:
+    """
+    Process one request of records through the entry point
+    """
+    if entrypoint in ['lambda_handler', 'lambda_handler_s3']:
+        control = dict(options, language_code=language_code, field_name='text', table_name='benchmark',
+                       destination=anonymizer.DESTINATION_S3 if entrypoint == 'lambda_handler_s3'
+                       else anonymizer.DESTINATION_CLIENT)
+        app.lambda_handler({'metadata': {'control': control}, 'records': records}, None)
+    elif entrypoint == 'anonymize_records':
+        anonymizer.anonymize_records(records, 'text', language_code=language_code, **options)
+    elif entrypoint == 'anonymize_records_async':
+        asyncio.run(anonymizer_async.anonymize_records_async(records, 'text', language_code=language_code, **options))
+    else:
+        revert_options = {name: value for name, value in options.items() if name in REVERT_OPTIONS}
+        if entrypoint == 'revert_records_async':
+            asyncio.run(anonymizer_async.revert_records_async(records, 'text', **revert_options))
+        else:
+            anonymizer.revert_records(records, 'text', **revert_options)
+
+
+def run_case(entrypoint: str, scenario: str, language_code: str, text_length: int, density: float, args,
+             directory: str) -> dict:
+    """
+    Run the requests of one case of the matrix
+    :param directory: the directory of the SQLite transform stores
+    :return: the result of the case for the report
+    """
+    services = create_stand_ins(language_code, args)
+    services.install()
+    anonymizer.transform_store.close()
+    anonymizer.transform_store = create_transform_store(args.transform_store, directory)
+    # each case starts with unbounded rate limiters, as in a new container
+    RateLimiter.reset()
+    records = corpus.generate_records(args.records, text_length, density, language_code, seed=args.seed)
+    options = SCENARIOS[scenario]
+    if entrypoint in REVERT_ENTRYPOINTS:
+        records = anonymizer.anonymize_records(
+            copy.deepcopy(records), 'text', language_code=language_code,
+            revert_mode=options.get(anonymizer.REVERT_MODE_OPTION, anonymizer.REVERT_MODE_STORAGE))
+    calls_before = services.stats()
+    latencies = []
+    errors = []
+    failed_records = 0
+    for _ in range(args.requests):
+        if not args.warm_cache:
+            anonymizer.detection_cache = DetectionCache.DetectionCache()
+        request_records = copy.deepcopy(records)
+        Metrics.reset()
+        start = time.perf_counter()
+        try:
+            run_request(entrypoint, request_records, language_code, options)
+        except Exception as error:
+            errors.append(f"{type(error).__name__}: {error}")
+        latencies.append(time.perf_counter() - start)
+        failed_records += Metrics.current().counters.get(Metrics.FAILED_RECORDS, 0)
+    calls_after = services.stats()
+    total_seconds = sum(latencies)
+    return {
+        'entrypoint': entrypoint,
+        'scenario': scenario,
+        'options': options,
+        'language_code': language_code,
+        'records_per_request': args.records,
+        'text_length': text_length,
+        'entity_density': density,
+        'requests': args.requests,
+        'failed_requests': len(errors),
+        'errors': sorted(set(errors))[:5],
+        'failed_records': failed_records,
+        'records_per_second': args.records * args.requests / total_seconds if total_seconds else None,
+        'latency_ms': {'mean': statistics.mean(latencies) * 1000,
+                       'p50': percentile(latencies, 0.50) * 1000,
+                       'p95': percentile(latencies, 0.95) * 1000,
+                       'p99': percentile(latencies, 0.99) * 1000},
+        'service_calls_per_request': {
+            service: (calls_after[service]['calls'] - calls_before[service]['calls']) / args.requests
+            for service in calls_after},
+        'service_throttled': {service: calls_after[service]['throttled'] - calls_before[service]['throttled']
+                              for service in calls_after},
+        'rate_limiters': RateLimiter.stats()
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=bootstrap.SRC_PATH, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entrypoints', nargs='+', default=ENTRYPOINTS, choices=ENTRYPOINTS)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--languages', nargs='+', default=['en', 'fr'], choices=['en', 'fr'])
+    parser.add_argument('--records', type=int, default=100, help='records per request')
+    parser.add_argument('--text-lengths', nargs='+', type=int, default=[200], help='characters per text')
+    parser.add_argument('--densities', nargs='+', type=float, default=[0.05], help='fraction of words that are PII')
+    parser.add_argument('--requests', type=int, default=5, help='requests per case')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplier of the service latencies')
+    parser.add_argument('--jitter', type=float, default=0.2, help='jitter, as a fraction of the latency')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls or items throttled')
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help='calls or items per second of each service above which they are throttled')
+    parser.add_argument('--transform-store', default=TransformStore.STORE_DYNAMODB, choices=TransformStore.STORES,
+                        help='where the transforms are persisted, the local stores do not call the dynamodb stand-in')
+    parser.add_argument('--warm-cache', action='store_true', help='keep the detection cache between requests')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark_report.json')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    app.VERBOSE = False
+    app.EMIT_METRICS = False
+    app.LOG_SAMPLE_RATE = 0.0
+    if anonymizer.revert_token_keyring is None:
+        # a throwaway key, the revert_token scenarios only need one to exist
+        anonymizer.revert_token_keyring = RevertTokens.RevertTokenKeyring(
+            {'benchmark': RevertTokens.decode_base64(RevertTokens.RevertTokenKeyring.generate_key())})
+    results = []
+    directory = tempfile.TemporaryDirectory()
+    print(f"{'entrypoint':>18} {'scenario':>18} {'lang':>4} {'length':>6} {'density':>7} {'rec/s':>9} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'failed':>6} {'records':>7}")
+    for entrypoint in args.entrypoints:
+        for scenario in args.scenarios:
+            if entrypoint in REVERT_ENTRYPOINTS and scenario in IRREVERSIBLE_SCENARIOS:
+                continue
+            for language_code in args.languages:
+                for text_length in args.text_lengths:
+                    for density in args.densities:
+                        result = run_case(entrypoint, scenario, language_code, text_length, density, args,
+                                          directory.name)
+                        results.append(result)
+                        latency = result['latency_ms']
+                        print(f"{entrypoint:>18} {scenario:>18} {language_code:>4} {text_length:>6} {density:>7} "
+                              f"{result['records_per_second'] or 0:>9.1f} {latency['p50']:>8.1f} "
+                              f"{latency['p95']:>8.1f} {latency['p99']:>8.1f} {result['failed_requests']:>6} "
+                              f"{result['failed_records']:>7}")
+    anonymizer.transform_store.close()
+    directory.cleanup()
+    report = {
+        'generated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'settings': {name: value for name, value in vars(args).items() if name != 'output'},
+        'service_latency_ms': SERVICE_LATENCY_MS,
+        'results': results
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"report written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""
+Make the src directory importable as the anonymizer package, the way it is deployed in the lambda
+"""
+import importlib.util
+import pathlib
+import sys
+
+SRC_PATH = pathlib.Path(__file__).resolve().parent.parent / 'src'
+PACKAGE_NAME = 'anonymizer'
+
+
+def register_package() -> None:
+    """
+    Register the src directory as the anonymizer package, unless it is already importable
+    :return: None
+    """
+    if PACKAGE_NAME in sys.modules:
+        return
+    spec = importlib.util.spec_from_file_location(PACKAGE_NAME, SRC_PATH / '__init__.py',
+                                                  submodule_search_locations=[str(SRC_PATH)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[PACKAGE_NAME] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,94 @@
+"""
+Synthetic English and French records for the benchmarks
+Texts are made of filler words with entities mixed in at a given density, drawn from a fixed vocabulary that
+the stand-in detectors know about.
+"""
+import random
+
+FIRST_NAMES = {
+    'en': ['John', 'Mary', 'Robert', 'Patricia', 'Michael', 'Linda', 'David', 'Susan', 'James', 'Karen'],
+    'fr': ['Camille', 'Louis', 'Chloé', 'Hugo', 'Léa', 'Gabriel', 'Manon', 'Arthur', 'Inès', 'Jules']
+}
+LAST_NAMES = {
+    'en': ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Wilson', 'Taylor'],
+    'fr': ['Martin', 'Bernard', 'Dubois', 'Thomas', 'Robert', 'Richard', 'Petit', 'Durand', 'Leroy', 'Moreau']
+}
+LOCATIONS = {
+    'en': ['Seattle', 'Boston', 'Denver', 'Austin', 'Chicago', 'Portland'],
+    'fr': ['Lyon', 'Marseille', 'Toulouse', 'Bordeaux', 'Nantes', 'Strasbourg']
+}
+ORGANIZATIONS = {
+    'en': ['Acme Corp', 'Globex', 'Initech', 'Umbrella Inc'],
+    'fr': ['Société Générique', 'Dupont SA', 'Atelier Lumière', 'Groupe Horizon']
+}
+FILLER_WORDS = {
+    'en': ['the', 'order', 'was', 'shipped', 'late', 'and', 'please', 'call', 'back', 'about', 'my', 'ticket',
+           'account', 'is', 'still', 'locked', 'thanks', 'for', 'your', 'help', 'today', 'with', 'refund'],
+    'fr': ['la', 'commande', 'est', 'arrivée', 'en', 'retard', 'merci', 'de', 'rappeler', 'pour', 'mon',
+           'dossier', 'le', 'compte', 'reste', 'bloqué', 'votre', 'aide', 'remboursement', 'avec', 'aujourd']
+}
+VALUES_PER_GENERATED_TYPE = 200
+ENTITY_TYPES = ['PERSON', 'EMAIL', 'PHONE', 'LOCATION', 'ORGANIZATION']
+
+
+def phone_number(language_code: str, rng: random.Random) -> str:
+    if language_code == 'fr':
+        return '0' + str(rng.randint(1, 9)) + ''.join(f" {rng.randint(0, 99):02d}" for _ in range(4))
+    return f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04d}"
+
+
+def vocabulary(language_code: str, seed: int = 7) -> dict:
+    """
+    :param language_code: 'en' or 'fr'
+    :param seed: seed of the generated emails and phone numbers
+    :return: dict of entity type to the values the corpus uses
+    """
+    rng = random.Random(seed)
+    people = [f"{first} {last}" for first in FIRST_NAMES[language_code] for last in LAST_NAMES[language_code]]
+    emails = [f"{rng.choice(FIRST_NAMES['en']).lower()}.{index}@example.com"
+              for index in range(VALUES_PER_GENERATED_TYPE)]
+    phones = list(dict.fromkeys(phone_number(language_code, rng) for _ in range(VALUES_PER_GENERATED_TYPE)))
+    return {'PERSON': people,
+            'EMAIL': emails,
+            'PHONE': phones,
+            'LOCATION': LOCATIONS[language_code],
+            'ORGANIZATION': ORGANIZATIONS[language_code]}
+
+
+def generate_text(length: int, entity_density: float, language_code: str, words: dict,
+                  rng: random.Random) -> str:
+    """
+    :param length: the approximate length of the text, in characters
+    :param entity_density: the fraction of the words that are entities
+    :param language_code: 'en' or 'fr'
+    :param words: the vocabulary of the entities
+    :param rng: the random generator
+    :return: the text
+    """
+    pieces = []
+    size = 0
+    while size < length:
+        if rng.random() < entity_density:
+            piece = rng.choice(words[rng.choice(ENTITY_TYPES)])
+        else:
+            piece = rng.choice(FILLER_WORDS[language_code])
+        pieces.append(piece)
+        size += len(piece) + 1
+    return ' '.join(pieces)
+
+
+def generate_records(count: int, text_length: int, entity_density: float, language_code: str = 'en',
+                     seed: int = 1, text_field_name: str = 'text') -> list:
+    """
+    :param count: the number of records
+    :param text_length: the approximate length of each text, in characters
+    :param entity_density: the fraction of the words that are entities
+    :param language_code: 'en' or 'fr'
+    :param seed: the seed of the corpus, the same seed gives the same records
+    :param text_field_name: the name of the text field
+    :return: list of records with an 'id' and the text field
+    """
+    rng = random.Random(seed)
+    words = vocabulary(language_code)
+    return [{'id': index, text_field_name: generate_text(text_length, entity_density, language_code, words, rng)}
+            for index in range(count)]
@@ -0,0 +1,331 @@
+"""
+In-process stand-ins for the AWS services used by the anonymizer: Comprehend, the SageMaker runtime, DynamoDB
+and S3. They implement the client calls the facades make, with configurable latency, jitter and throttling.
+Install them with install_stand_ins, which registers them in ClientRegistry.
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+
+import botocore.exceptions
+import botocore.response
+
+COMPREHEND_MAX_TEXT_BYTES = 100 * 1024
+SAGEMAKER_MAX_PAYLOAD_BYTES = 6 * 1024 * 1024
+
+# Key attribute of the tables the anonymizer uses
+TABLE_KEY_NAMES = {
+    'scrub_transforms': 'guid',
+    'pii_detection_cache': 'text_hash'
+}
+
+
+class ServiceModel:
+    """
+    Latency, jitter and throttling of a stand-in service, and counters of the calls it received
+    """
+
+    def __init__(self, latency_seconds=0.0, jitter_seconds=0.0, throttle_rate=0.0, seed=None, max_rate=None):
+        """
+        :param throttle_rate: fraction of the calls or items throttled at random
+        :param max_rate: calls or items per second above which they are throttled, like a provisioned capacity
+        """
+        self.latency_seconds = latency_seconds
+        self.jitter_seconds = jitter_seconds
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        # token bucket of the capacity, holding one second of calls
+        self.tokens = max_rate
+        self.refilled_at = time.monotonic()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+
+    def wait(self) -> None:
+        """
+        Count the call, and sleep for the latency plus a uniform jitter
+        :return: None
+        """
+        with self.lock:
+            self.calls += 1
+            delay = self.latency_seconds + self.random.uniform(-self.jitter_seconds, self.jitter_seconds)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_throttle(self) -> bool:
+        """
+        :return: True, and count it, if this call or item is throttled
+        """
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if self.max_rate is not None:
+                now = time.monotonic()
+                self.tokens = min(self.max_rate, self.tokens + (now - self.refilled_at) * self.max_rate)
+                self.refilled_at = now
+                if self.tokens < 1:
+                    throttled = True
+                elif not throttled:
+                    self.tokens -= 1
+            if throttled:
+                self.throttled += 1
+        return throttled
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'calls': self.calls, 'throttled': self.throttled}
+
+
+def client_error(code: str, message: str, operation_name: str) -> botocore.exceptions.ClientError:
+    """
+    :return: the error botocore raises for a service error response
+    """
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+
+class EntityMatcher:
+    """
+    Finds the entities of a synthetic corpus in a text, standing in for the detection models
+    """
+
+    def __init__(self, vocabulary: dict):
+        """
+        :param vocabulary: dict of entity type to the values of that type
+        """
+        self.patterns = []
+        for entity_type, values in vocabulary.items():
+            alternatives = '|'.join(re.escape(value) for value in sorted(values, key=len, reverse=True))
+            self.patterns.append((entity_type, re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")))
+
+    def find(self, text: str) -> list:
+        """
+        :param text: the text to search
+        :return: list of (type, begin offset, end offset), ordered by begin offset
+        """
+        found = []
+        for entity_type, pattern in self.patterns:
+            found.extend((entity_type, match.start(), match.end()) for match in pattern.finditer(text))
+        found.sort(key=lambda x: x[1])
+        return found
+
+
+class FakeComprehend:
+    """
+    Stand-in of the comprehend client, detect_pii_entities only
+    """
+
+    def __init__(self, matcher: EntityMatcher, model: ServiceModel = None, type_names: dict = None):
+        self.matcher = matcher
+        self.model = model or ServiceModel()
+        # corpus entity type to Comprehend entity type
+        self.type_names = type_names or {'PERSON': 'NAME', 'EMAIL': 'EMAIL', 'PHONE': 'PHONE',
+                                         'LOCATION': 'ADDRESS', 'ORGANIZATION': 'NAME'}
+
+    def detect_pii_entities(self, Text: str, LanguageCode: str) -> dict:
+        self.model.wait()
+        if len(Text.encode('utf-8')) > COMPREHEND_MAX_TEXT_BYTES:
+            raise client_error('TextSizeLimitExceededException', 'Input text size exceeds limit',
+                               'DetectPiiEntities')
+        if self.model.should_throttle():
+            raise client_error('ThrottlingException', 'Rate exceeded', 'DetectPiiEntities')
+        return {'Entities': [{'Type': self.type_names.get(entity_type, entity_type), 'Score': 0.99,
+                              'BeginOffset': begin, 'EndOffset': end}
+                             for entity_type, begin, end in self.matcher.find(Text)]}
+
+
+class FakeSageMakerRuntime:
+    """
+    Stand-in of the sagemaker-runtime client serving the French PII model
+    Like the model, it reports the start of words one character early, except for phone numbers and emails.
+    A fraction of the entities, chosen by their value, get a low score.
+    An 'inputs' list is answered with one {'found': [...]} per input
+    """
+
+    def __init__(self, matcher: EntityMatcher, model: ServiceModel = None, type_names: dict = None,
+                 low_score_rate: float = 0.0):
+        self.matcher = matcher
+        self.model = model or ServiceModel()
+        self.type_names = type_names or {'PERSON': 'PERSON', 'EMAIL': 'EMAIL_ADDRESS', 'PHONE': 'PHONE_NUMBER',
+                                         'LOCATION': 'LOCATION', 'ORGANIZATION': 'ORGANIZATION'}
+        self.low_score_rate = low_score_rate
+
+    def find(self, text: str) -> list:
+        found = []
+        for entity_type, begin, end in self.matcher.find(text):
+            entity_type = self.type_names.get(entity_type, entity_type)
+            low_score = zlib.crc32(text[begin:end].encode('utf-8')) % 1000 < self.low_score_rate * 1000
+            if entity_type not in ['PHONE_NUMBER', 'EMAIL_ADDRESS']:
+                begin -= 1
+            found.append({'entity_type': entity_type, 'start': begin, 'end': end, 'score': 0.5 if low_score else 0.95})
+        # the model does not return the entities in text order
+        found.reverse()
+        return found
+
+    def invoke_endpoint(self, EndpointName: str, ContentType: str, Body: bytes) -> dict:
+        self.model.wait()
+        if len(Body) > SAGEMAKER_MAX_PAYLOAD_BYTES:
+            raise client_error('ValidationError', 'Request payload is too large', 'InvokeEndpoint')
+        if self.model.should_throttle():
+            raise client_error('ThrottlingException', 'Rate exceeded', 'InvokeEndpoint')
+        inputs = json.loads(Body)['inputs']
+        if isinstance(inputs, list):
+            result = [{'found': self.find(text)} for text in inputs]
+        else:
+            result = {'found': self.find(inputs)}
+        body = json.dumps(result).encode('utf-8')
+        return {'Body': botocore.response.StreamingBody(io.BytesIO(body), len(body)),
+                'ContentType': 'application/json'}
+
+
+class FakeDynamoDB:
+    """
+    Stand-in of the low-level dynamodb client, batch_write_item and batch_get_item
+    Throttled items come back as unprocessed, a request with every item throttled raises like the service does
+    """
+
+    def __init__(self, model: ServiceModel = None, key_names: dict = None):
+        self.model = model or ServiceModel()
+        self.key_names = key_names or TABLE_KEY_NAMES
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems: dict) -> dict:
+        self.model.wait()
+        unprocessed = {}
+        request_count = 0
+        with self.lock:
+            for table_name, requests in RequestItems.items():
+                if len(requests) > 25:
+                    raise client_error('ValidationException', 'Too many items requested', 'BatchWriteItem')
+                table = self.tables.setdefault(table_name, {})
+                key_name = self.key_names[table_name]
+                for request in requests:
+                    request_count += 1
+                    if self.model.should_throttle():
+                        unprocessed.setdefault(table_name, []).append(request)
+                        continue
+                    item = request['PutRequest']['Item']
+                    table[item[key_name]['S']] = item
+        if request_count and sum(len(requests) for requests in unprocessed.values()) == request_count:
+            raise client_error('ProvisionedThroughputExceededException', 'Throughput exceeds the limit',
+                               'BatchWriteItem')
+        return {'UnprocessedItems': unprocessed}
+
+    def batch_get_item(self, RequestItems: dict) -> dict:
+        self.model.wait()
+        responses = {}
+        unprocessed = {}
+        key_count = 0
+        with self.lock:
+            for table_name, request in RequestItems.items():
+                if len(request['Keys']) > 100:
+                    raise client_error('ValidationException', 'Too many items requested', 'BatchGetItem')
+                table = self.tables.get(table_name, {})
+                for key in request['Keys']:
+                    key_count += 1
+                    if self.model.should_throttle():
+                        unprocessed.setdefault(table_name, {'Keys': []})['Keys'].append(key)
+                        continue
+                    (key_value,) = key.values()
+                    item = table.get(key_value['S'])
+                    if item is not None:
+                        responses.setdefault(table_name, []).append(item)
+        if key_count and sum(len(request['Keys']) for request in unprocessed.values()) == key_count:
+            raise client_error('ProvisionedThroughputExceededException', 'Throughput exceeds the limit',
+                               'BatchGetItem')
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+
+class FakeS3:
+    """
+    Stand-in of the s3 client: put_object, get_object and the multipart upload calls
+    """
+
+    def __init__(self, model: ServiceModel = None):
+        self.model = model or ServiceModel()
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def call(self, operation_name: str) -> None:
+        self.model.wait()
+        if self.model.should_throttle():
+            raise client_error('SlowDown', 'Please reduce your request rate', operation_name)
+
+    def put_object(self, Bucket: str, Key: str, Body, ContentType: str = None) -> dict:
+        self.call('PutObject')
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        return {'ETag': '"stand-in"'}
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        self.call('GetObject')
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise client_error('NoSuchKey', 'The specified key does not exist', 'GetObject')
+            body = self.objects[(Bucket, Key)]
+        return {'Body': botocore.response.StreamingBody(io.BytesIO(body), len(body)), 'ContentLength': len(body)}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, ContentType: str = None) -> dict:
+        self.call('CreateMultipartUpload')
+        with self.lock:
+            upload_id = f"upload-{len(self.uploads) + 1}-{random.getrandbits(32):08x}"
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes) -> dict:
+        self.call('UploadPart')
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"part-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict) -> dict:
+        self.call('CompleteMultipartUpload')
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {'Location': f"{Bucket}/{Key}"}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> dict:
+        self.call('AbortMultipartUpload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class StandIns:
+    """
+    One stand-in of each service, sharing the corpus vocabulary
+    """
+
+    def __init__(self, vocabulary: dict, comprehend_model: ServiceModel = None,
+                 sagemaker_model: ServiceModel = None, dynamodb_model: ServiceModel = None,
+                 s3_model: ServiceModel = None):
+        matcher = EntityMatcher(vocabulary)
+        self.comprehend = FakeComprehend(matcher, comprehend_model)
+        self.sagemaker_runtime = FakeSageMakerRuntime(matcher, sagemaker_model)
+        self.dynamodb = FakeDynamoDB(dynamodb_model)
+        self.s3 = FakeS3(s3_model)
+
+    def install(self, dynamodb_region='us-east-1') -> None:
+        """
+        Register the stand-ins in ClientRegistry, the anonymizer package must be importable
+        :param dynamodb_region: the region the DynamoDBFacade of the anonymizer uses
+        :return: None
+        """
+        import anonymizer.ClientRegistry as ClientRegistry
+        ClientRegistry.reset()
+        ClientRegistry.register_client('comprehend', self.comprehend)
+        ClientRegistry.register_client('sagemaker-runtime', self.sagemaker_runtime)
+        ClientRegistry.register_client('dynamodb', self.dynamodb, region_name=dynamodb_region)
+        ClientRegistry.register_client('s3', self.s3)
+
+    def stats(self) -> dict:
+        return {'comprehend': self.comprehend.model.stats(),
+                'sagemaker_runtime': self.sagemaker_runtime.model.stats(),
+                'dynamodb': self.dynamodb.model.stats(),
+                's3': self.s3.model.stats()}
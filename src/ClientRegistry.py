@@ -0,0 +1,118 @@
+#######
+# Client Registry v1.00
+#######
+
+import threading
+
+# Connection pool of each client, raised on demand when a caller needs more parallel requests
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+# Services whose calls the RateLimiter retries on throttling, their clients make a single attempt so the retries of
+# botocore do not multiply the retries, nor hide the throttling from the limiter
+RATE_LIMITED_SERVICES = frozenset({'comprehend', 'sagemaker-runtime', 'dynamodb'})
+SINGLE_ATTEMPT_RETRIES = {'mode': 'standard', 'total_max_attempts': 1}
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = {}
+
+
+def get_session():
+    """
+    Get the boto3 session shared by all the clients of the process
+    boto3 is imported on first use, so importing the service does not pay for it before a client is needed
+    :return: the shared boto3 session
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                import boto3
+                _session = boto3.session.Session()
+    return _session
+
+
+def create_config(max_pool_connections: int, service_name: str = None):
+    """
+    :param max_pool_connections: the size of the connection pool
+    :param service_name: the name of the service of the client, None for the default retries
+    :return: the botocore config of the clients, keeping connections alive between invocations
+    """
+    import botocore.config
+    if service_name in RATE_LIMITED_SERVICES:
+        return botocore.config.Config(max_pool_connections=max_pool_connections, tcp_keepalive=True,
+                                      retries=dict(SINGLE_ATTEMPT_RETRIES))
+    return botocore.config.Config(max_pool_connections=max_pool_connections, tcp_keepalive=True)
+
+
+def get_client(service_name: str, region_name: str = None,
+               max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Get the client of a service, created on first use and reused by later calls and invocations
+    The client is created again with a larger pool if a caller needs more connections than it has
+    :param service_name: the name of the service, e.g. 'comprehend'
+    :param region_name: the region of the service, None for the default region
+    :param max_pool_connections: the number of connections the caller may use in parallel
+    :return: the shared client
+    """
+    key = (service_name, region_name)
+    entry = _clients.get(key)
+    if entry is not None and entry[1] >= max_pool_connections:
+        return entry[0]
+    session = get_session()
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None or entry[1] < max_pool_connections:
+            client = session.client(service_name, region_name=region_name,
+                                    config=create_config(max(max_pool_connections, DEFAULT_MAX_POOL_CONNECTIONS),
+                                                         service_name))
+            entry = (client, max(max_pool_connections, DEFAULT_MAX_POOL_CONNECTIONS))
+            _clients[key] = entry
+        return entry[0]
+
+
+def get_resource(service_name: str, region_name: str = None,
+                 max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Get the resource of a service, created on first use and reused by later calls and invocations
+    Resources are not thread safe, use them from one thread or use the client
+    :param service_name: the name of the service, e.g. 'dynamodb'
+    :param region_name: the region of the service, None for the default region
+    :param max_pool_connections: the size of the connection pool
+    :return: the shared resource
+    """
+    key = (service_name, region_name)
+    resource = _resources.get(key)
+    if resource is None:
+        session = get_session()
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = session.resource(service_name, region_name=region_name,
+                                            config=create_config(max_pool_connections, service_name))
+                _resources[key] = resource
+    return resource
+
+
+def register_client(service_name: str, client, region_name: str = None) -> None:
+    """
+    Use the given client for a service, for example a local stand-in
+    :param service_name: the name of the service
+    :param client: the client to return for the service
+    :param region_name: the region of the service, None for the default region
+    :return: None
+    """
+    with _lock:
+        _clients[(service_name, region_name)] = (client, float('inf'))
+
+
+def reset() -> None:
+    """
+    Forget all the clients, resources, and the session
+    :return: None
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _session = None
@@ -0,0 +1,207 @@
+#######
+# Detection Cache v1.00
+#######
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import anonymizer.Metrics as Metrics
+
+# Budget of the in-process tier, estimated from the number of entities cached
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+ENTRY_OVERHEAD_BYTES = 200
+ENTITY_BYTES = 120
+
+# Persistent tier, shared by warm lambda containers and other workers
+DETECTION_CACHE_TABLE = 'pii_detection_cache'
+DETECTION_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+
+class DetectionCache:
+    """
+    Cache of detected PII entities, keyed by a hash of the language code and the text
+    Only the hash, and the type and offsets of the entities are kept, never the text itself.
+    The in-process tier is an LRU evicting the least recently used entries over a size budget,
+    backed by an optional persistent tier
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, persistent_tier=None):
+        self.max_bytes = max_bytes
+        self.persistent_tier = persistent_tier
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persistent_errors = 0
+
+    @staticmethod
+    def make_key(language_code: str, text: str) -> str:
+        """
+        :param language_code: the language code the text is detected with
+        :param text: the text
+        :return: the cache key of the text
+        """
+        return hashlib.sha256(f"{language_code}\x00{text}".encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def transforms_to_entry(transforms: dict) -> tuple:
+        """
+        :param transforms: dict of PII entities returned by InferenceFacade
+        :return: the compact (type, begin offset, end offset) tuples kept in the cache
+        """
+        return tuple((transform['Type'], transform['BeginOffset'], transform['EndOffset'])
+                     for transform in transforms['Transforms'])
+
+    @staticmethod
+    def entry_to_transforms(entry: tuple) -> dict:
+        """
+        :param entry: the cached (type, begin offset, end offset) tuples
+        :return: a new dict of PII entities, safe for the caller to update
+        """
+        return {'Transforms': [{'Type': entity_type,
+                                'BeginOffset': begin_offset,
+                                'EndOffset': end_offset,
+                                'Original': "",
+                                'Anonymized': ""
+                                } for entity_type, begin_offset, end_offset in entry]}
+
+    def get_many(self, keys: list) -> list:
+        """
+        Look up the keys in the in-process tier, then the missing ones in the persistent tier
+        A failure of the persistent tier counts its keys as misses, the caller detects them again
+        :param keys: the cache keys
+        :return: the cached transforms in the same order as keys, None for a miss
+        """
+        results = [None] * len(keys)
+        missing = []
+        with self.lock:
+            for position, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is None:
+                    missing.append(position)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    results[position] = self.entry_to_transforms(entry)
+        if missing and self.persistent_tier is not None:
+            found = self.call_persistent_tier(self.persistent_tier.get_many,
+                                              [keys[position] for position in missing]) or {}
+            with self.lock:
+                for position in missing:
+                    entry = found.get(keys[position])
+                    if entry is not None:
+                        self.persistent_hits += 1
+                        self.store(keys[position], entry)
+                        results[position] = self.entry_to_transforms(entry)
+        misses = sum(1 for result in results if result is None)
+        with self.lock:
+            self.misses += misses
+        Metrics.current().increment(Metrics.DETECTION_CACHE_HITS, len(keys) - misses)
+        Metrics.current().increment(Metrics.DETECTION_CACHE_MISSES, misses)
+        return results
+
+    def put_many(self, keys: list, transforms_list: list) -> None:
+        """
+        Cache the transforms detected for the keys, in both tiers
+        A failure of the persistent tier skips the write, the entries are only cached in process
+        :param keys: the cache keys
+        :param transforms_list: the transforms detected, in the same order as keys
+        :return: None
+        """
+        entries = {key: self.transforms_to_entry(transforms) for key, transforms in zip(keys, transforms_list)}
+        with self.lock:
+            for key, entry in entries.items():
+                self.store(key, entry)
+        if entries and self.persistent_tier is not None:
+            self.call_persistent_tier(self.persistent_tier.put_many, entries)
+
+    def call_persistent_tier(self, method, argument):
+        """
+        Call the persistent tier, the cache is an optimization so its failures do not fail the detection, whether
+        the service call failed or its retries ran out, they are counted in the metrics of the invocation
+        :param method: the get_many or put_many method of the persistent tier
+        :param argument: the keys or the entries
+        :return: the result of the method, None if it failed
+        """
+        try:
+            return method(argument)
+        except Exception:
+            with self.lock:
+                self.persistent_errors += 1
+            Metrics.current().increment(Metrics.DETECTION_CACHE_ERRORS)
+            return None
+
+    def store(self, key: str, entry: tuple) -> None:
+        """
+        Add an entry to the in-process tier and evict over the size budget, the lock must be held
+        :param key: the cache key
+        :param entry: the cached (type, begin offset, end offset) tuples
+        :return: None
+        """
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size_bytes -= self.entry_size(previous)
+        self.entries[key] = entry
+        self.size_bytes += self.entry_size(entry)
+        while self.size_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size_bytes -= self.entry_size(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def entry_size(entry: tuple) -> int:
+        """
+        :return: the estimated memory used by an entry
+        """
+        return ENTRY_OVERHEAD_BYTES + ENTITY_BYTES * len(entry)
+
+    def stats(self) -> dict:
+        """
+        :return: the counters of the cache
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'persistent_hits': self.persistent_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'persistent_errors': self.persistent_errors,
+                    'entries': len(self.entries),
+                    'size_bytes': self.size_bytes}
+
+
+class DynamoDBCacheTier:
+    """
+    Persistent tier of the detection cache in a ddb table keyed by 'text_hash', with an 'expires_at' TTL
+    """
+
+    def __init__(self, dynamo, table_name: str = DETECTION_CACHE_TABLE,
+                 ttl_seconds: int = DETECTION_CACHE_TTL_SECONDS):
+        self.dynamo = dynamo
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+
+    def get_many(self, keys: list) -> dict:
+        """
+        :param keys: the cache keys
+        :return: dict of key to the cached (type, begin offset, end offset) tuples, for the keys found
+        """
+        items = self.dynamo.batch_get_items(self.table_name, 'text_hash', keys)
+        now = int(time.time())
+        return {key: tuple(tuple(entity) for entity in json.loads(item['entities']))
+                for key, item in items.items() if int(item.get('expires_at', now)) >= now}
+
+    def put_many(self, entries: dict) -> None:
+        """
+        :param entries: dict of key to the (type, begin offset, end offset) tuples to cache
+        :return: None
+        """
+        expires_at = int(time.time()) + self.ttl_seconds
+        self.dynamo.batch_write_items(self.table_name, [
+            {'text_hash': key, 'entities': json.dumps(entry, separators=(',', ':')), 'expires_at': expires_at}
+            for key, entry in entries.items()])
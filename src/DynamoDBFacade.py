@@ -2,21 +2,80 @@
 # DynamoDB Facade v1.00
 #######
 
-import boto3
-import boto3.dynamodb.types
+import time
 import uuid
 from decimal import Decimal
 
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.RateLimiter as RateLimiter
+import anonymizer.TransformCodec as TransformCodec
+
 SCRUB_TRANSFORMS_TABLE = 'scrub_transforms'
+# Attributes of the items holding transforms in the TransformCodec format, older items have a 'Transforms' list
+ENCODING_VERSION_ATTRIBUTE = 'EncodingVersion'
+ENCODED_TRANSFORMS_ATTRIBUTE = 'EncodedTransforms'
+
+# DynamoDB limits on the number of items in a single batch request
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_GET_MAX_KEYS = 100
+# Retries of unprocessed items and keys, with exponential backoff and full jitter
+BATCH_MAX_RETRIES = 8
 
 
 class DynamoDBFacade:
 
-    def __init__(self, region):
-        self.dynamodb_client = boto3.client('dynamodb', region_name=region)
+    def __init__(self, region, max_pool_connections=10):
+        self.region = region
+        self.max_pool_connections = max_pool_connections
         self.scrub_xform_table_name = SCRUB_TRANSFORMS_TABLE
-        self.scrub_xform_table = boto3.resource('dynamodb', region_name=region).Table(self.scrub_xform_table_name)
-        self.deserializer = boto3.dynamodb.types.TypeDeserializer()
+        self._serializer = None
+        self._deserializer = None
+        self._scrub_xform_table = None
+
+    @property
+    def dynamodb_client(self):
+        """
+        The shared ddb client, created on first use
+        """
+        return ClientRegistry.get_client('dynamodb', region_name=self.region,
+                                         max_pool_connections=self.max_pool_connections)
+
+    @property
+    def rate_limiter(self):
+        """
+        The rate limiter shared by the ddb calls of the process
+        """
+        return RateLimiter.get_limiter('dynamodb')
+
+    @property
+    def scrub_xform_table(self):
+        """
+        The scrub transforms table resource, created on first use and again if the registry creates a new resource
+        """
+        resource = ClientRegistry.get_resource('dynamodb', region_name=self.region)
+        if self._scrub_xform_table is None or self._scrub_xform_table[0] is not resource:
+            self._scrub_xform_table = (resource, resource.Table(self.scrub_xform_table_name))
+        return self._scrub_xform_table[1]
+
+    @property
+    def serializer(self):
+        """
+        Converts python values to ddb attribute values, boto3 is imported on first use
+        """
+        if self._serializer is None:
+            import boto3.dynamodb.types
+            self._serializer = boto3.dynamodb.types.TypeSerializer()
+        return self._serializer
+
+    @property
+    def deserializer(self):
+        """
+        Converts ddb attribute values to python values, boto3 is imported on first use
+        """
+        if self._deserializer is None:
+            import boto3.dynamodb.types
+            self._deserializer = boto3.dynamodb.types.TypeDeserializer()
+        return self._deserializer
 
     @staticmethod
     def create_base64_guid() -> str:
@@ -29,9 +88,57 @@ class DynamoDBFacade:
         """
         Gets a scrub transform by guid from the ddb table
         """
-        response = self.scrub_xform_table.get_item(Key={'guid': guid})
+        response = self.rate_limiter.call(self.scrub_xform_table.get_item, Key={'guid': guid})
         item = response['Item']
+        return self.item_to_scrub_xform(item)
+
+    def get_scrub_xforms(self, guids: list) -> list:
+        """
+        Gets many scrub transforms by guid from the ddb table with batch reads
+        :param guids: the guids of the scrub transforms
+        :return: the scrub transforms in the same order as guids, None for a guid that is not in the table
+        """
+        items = self.batch_get_items(self.scrub_xform_table_name, 'guid', guids)
+        return [self.item_to_scrub_xform(items[guid]) if guid in items else None for guid in guids]
 
+    def batch_get_items(self, table_name: str, key_name: str, key_values: list) -> dict:
+        """
+        Gets items by a string key with batch reads, retrying unprocessed keys
+        :param table_name: the name of the ddb table
+        :param key_name: the name of the partition key
+        :param key_values: the keys of the items, duplicates are read once
+        :return: dict of key to item, for the keys found in the table
+        """
+        unique_values = list(dict.fromkeys(key_values))
+        items = {}
+        for start in range(0, len(unique_values), BATCH_GET_MAX_KEYS):
+            keys = [{key_name: {'S': value}} for value in unique_values[start:start + BATCH_GET_MAX_KEYS]]
+            request_items = {table_name: {'Keys': keys}}
+            attempt = 0
+            while request_items:
+                requested = len(request_items[table_name]['Keys'])
+                response = self.rate_limiter.call(self.dynamodb_client.batch_get_item, RequestItems=request_items,
+                                                  units=requested)
+                for item in response['Responses'].get(table_name, []):
+                    item = {name: self.deserializer.deserialize(value) for name, value in item.items()}
+                    items[item[key_name]] = item
+                request_items = response.get('UnprocessedKeys', {})
+                if request_items:
+                    # unprocessed keys are the way ddb throttles part of a batch, the retries are counted from
+                    # the last request that made progress
+                    unprocessed = len(request_items[table_name]['Keys'])
+                    self.rate_limiter.on_throttle(unprocessed)
+                    attempt = self.backoff(attempt if unprocessed == requested else 0)
+        return items
+
+    @staticmethod
+    def item_to_scrub_xform(item: dict) -> dict:
+        """
+        Converts a ddb item back to a scrub transform, in the compact encoding or in the original list of maps
+        """
+        if ENCODED_TRANSFORMS_ATTRIBUTE in item:
+            encoded = item[ENCODED_TRANSFORMS_ATTRIBUTE]
+            return TransformCodec.decode(bytes(getattr(encoded, 'value', encoded)))
         # Convert DynamoDB Decimals back to int
         transforms = []
         for xform in item['Transforms']:
@@ -47,5 +154,66 @@ class DynamoDBFacade:
         """
         key = self.create_base64_guid()
         scrub_xform['guid'] = key
-        self.scrub_xform_table.put_item(Item=scrub_xform)
+        self.rate_limiter.call(self.scrub_xform_table.put_item, Item=self.scrub_xform_to_item(key, scrub_xform))
         return key
+
+    @staticmethod
+    def scrub_xform_to_item(guid: str, scrub_xform: dict) -> dict:
+        """
+        Converts a scrub transform to a ddb item, with the transforms in the compact encoding
+        """
+        return {'guid': guid,
+                ENCODING_VERSION_ATTRIBUTE: TransformCodec.encoding_version(scrub_xform),
+                ENCODED_TRANSFORMS_ATTRIBUTE: TransformCodec.encode(scrub_xform)}
+
+    def put_scrub_xforms(self, scrub_xforms: list) -> list:
+        """
+        Puts many scrub transforms to the ddb table with batch writes
+        :param scrub_xforms: the scrub transforms to put
+        :return: the guids of the scrub transforms, in the same order as scrub_xforms
+        """
+        keys = []
+        items = []
+        for scrub_xform in scrub_xforms:
+            key = self.create_base64_guid()
+            scrub_xform['guid'] = key
+            keys.append(key)
+            items.append(self.scrub_xform_to_item(key, scrub_xform))
+        self.batch_write_items(self.scrub_xform_table_name, items)
+        return keys
+
+    def batch_write_items(self, table_name: str, items: list) -> None:
+        """
+        Puts items with batch writes, retrying unprocessed items
+        :param table_name: the name of the ddb table
+        :param items: the items to put
+        :return: None
+        """
+        put_requests = [{'PutRequest': {'Item': {name: self.serializer.serialize(value)
+                                                 for name, value in item.items()}}} for item in items]
+        for start in range(0, len(put_requests), BATCH_WRITE_MAX_ITEMS):
+            request_items = {table_name: put_requests[start:start + BATCH_WRITE_MAX_ITEMS]}
+            attempt = 0
+            while request_items:
+                requested = len(request_items[table_name])
+                response = self.rate_limiter.call(self.dynamodb_client.batch_write_item, RequestItems=request_items,
+                                                  units=requested)
+                request_items = response.get('UnprocessedItems', {})
+                if request_items:
+                    # unprocessed items are the way ddb throttles part of a batch, the retries are counted from
+                    # the last request that made progress
+                    unprocessed = len(request_items[table_name])
+                    self.rate_limiter.on_throttle(unprocessed)
+                    attempt = self.backoff(attempt if unprocessed == requested else 0)
+
+    @staticmethod
+    def backoff(attempt: int) -> int:
+        """
+        Sleeps before retrying unprocessed items of a batch request
+        :param attempt: the number of retries so far
+        :return: the number of retries including this one
+        """
+        if attempt >= BATCH_MAX_RETRIES:
+            raise RuntimeError(f"DynamoDB batch request still has unprocessed items after {attempt} retries")
+        time.sleep(RateLimiter.backoff_delay(attempt))
+        return attempt + 1
@@ -0,0 +1,381 @@
+#######
+# Gazetteer Detector v1.00
+#######
+
+import array
+import bisect
+import hashlib
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+# Categories of the customer dictionaries, and the entity type of each one as returned by the remote detector of
+# each language. Other categories are used as entity types as they are
+CATEGORY_NAMES = 'names'
+CATEGORY_ORGANIZATIONS = 'organizations'
+CATEGORY_LOCATIONS = 'locations'
+TYPES_BY_LANGUAGE = {
+    'en': {CATEGORY_NAMES: 'NAME', CATEGORY_ORGANIZATIONS: 'ORGANIZATION', CATEGORY_LOCATIONS: 'LOCATION'},
+    'fr': {CATEGORY_NAMES: 'PERSON_FR', CATEGORY_ORGANIZATIONS: 'ORGANIZATION', CATEGORY_LOCATIONS: 'LOCATION'}
+}
+
+# Terms and texts are split into words, a term matches a run of whole words of the text, case folded, whatever
+# separates them. An apostrophe between letters is part of the word, as in O'Brien or d'Artagnan
+TOKEN_PATTERN = re.compile(r"\w+(?:['’]\w+)*")
+
+# The automaton file is a header followed by sections of little endian uint32, read in place through mmap
+GAZETTEER_PATH_ENVIRONMENT_VARIABLE = 'GAZETTEER_PATH'
+MAGIC = b'SCRUBGAZ'
+FORMAT_VERSION = 1
+# magic, format version, flags, digest of the sections, and the sizes of the sections: categories, categories bytes,
+# words, words bytes, hash slots, states, edges, patterns
+HEADER = struct.Struct('<8sII16s8I')
+# a match must start with a capitalized word of the text
+FLAG_REQUIRE_CAPITALIZED = 1
+UINT32_BYTES = 4
+# Words of the texts already looked up in the automaton, by the texts of the process
+WORD_CACHE_MAX_ENTRIES = 100000
+
+
+def build_automaton(dictionaries: dict, path: str, require_capitalized: bool = False) -> dict:
+    """
+    Build the Aho-Corasick automaton of the dictionaries over their words, and write it to a file
+    A term found in several categories keeps the first one
+    :param dictionaries: dict of category to the iterable of its terms, in order of priority
+    :param path: the path of the automaton file, replaced atomically
+    :param require_capitalized: only match terms starting with a capitalized word in the text
+    :return: dict of the numbers of terms, words and states of the automaton, and the size of the file
+    """
+    categories = list(dictionaries)
+    if any('\n' in category for category in categories):
+        raise ValueError('A dictionary category can not contain a line break')
+    vocabulary = {}
+    children = [{}]
+    state_patterns = [0]
+    # (number of words, category index) of each pattern, states refer to them as pattern index + 1
+    patterns = []
+    for category_index, category in enumerate(categories):
+        for term in dictionaries[category]:
+            words = [token.casefold() for token in TOKEN_PATTERN.findall(term)]
+            if not words:
+                continue
+            state = 0
+            for word in words:
+                word_id = vocabulary.setdefault(word, len(vocabulary))
+                child = children[state].get(word_id)
+                if child is None:
+                    child = len(children)
+                    children[state][word_id] = child
+                    children.append({})
+                    state_patterns.append(0)
+                state = child
+            if not state_patterns[state]:
+                patterns.append((len(words), category_index))
+                state_patterns[state] = len(patterns)
+    fail_states, output_links = link_states(children, state_patterns)
+    sections = serialize_sections(categories, vocabulary, children, state_patterns, patterns, fail_states,
+                                  output_links)
+    body = b''.join(sections)
+    categories_size = len('\n'.join(categories).encode('utf-8'))
+    words_size = sum(len(word.encode('utf-8')) for word in vocabulary)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_REQUIRE_CAPITALIZED if require_capitalized else 0,
+                         hashlib.sha256(body).digest()[:16], len(categories), categories_size, len(vocabulary),
+                         words_size, len(sections[3]) // UINT32_BYTES, len(children),
+                         sum(len(edges) for edges in children[1:]), len(patterns))
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'wb') as automaton_file:
+        automaton_file.write(header)
+        automaton_file.write(body)
+    os.replace(temporary_path, path)
+    return {'terms': len(patterns), 'words': len(vocabulary), 'states': len(children),
+            'bytes': len(header) + len(body)}
+
+
+def build_automaton_from_files(dictionary_paths: dict, path: str, require_capitalized: bool = False) -> dict:
+    """
+    :param dictionary_paths: dict of category to the path of its dictionary, a UTF-8 text file with one term per line
+    :param path: the path of the automaton file
+    :param require_capitalized: only match terms starting with a capitalized word in the text
+    :return: the numbers returned by build_automaton
+    """
+    def read_terms(dictionary_path):
+        with open(dictionary_path, encoding='utf-8') as dictionary_file:
+            yield from (line.strip() for line in dictionary_file if line.strip())
+
+    return build_automaton({category: read_terms(dictionary_path)
+                            for category, dictionary_path in dictionary_paths.items()}, path, require_capitalized)
+
+
+def link_states(children: list, state_patterns: list) -> (list, list):
+    """
+    :param children: the transitions of each state of the trie, dict of word id to state
+    :param state_patterns: the pattern index + 1 of the term ending at each state, 0 if none
+    :return: the failure state of each state, and the next state with a pattern on its failure chain, 0 if none
+    """
+    fail_states = [0] * len(children)
+    output_links = [0] * len(children)
+    queue = list(children[0].values())
+    for state in queue:
+        for word_id, child in children[state].items():
+            queue.append(child)
+            fail_state = fail_states[state]
+            while fail_state and word_id not in children[fail_state]:
+                fail_state = fail_states[fail_state]
+            fail_states[child] = children[fail_state].get(word_id, 0)
+            fail_state = fail_states[child]
+            output_links[child] = fail_state if state_patterns[fail_state] else output_links[fail_state]
+    return fail_states, output_links
+
+
+def serialize_sections(categories: list, vocabulary: dict, children: list, state_patterns: list, patterns: list,
+                       fail_states: list, output_links: list) -> list:
+    """
+    :return: the sections of the automaton file, each padded to a multiple of 4 bytes
+    """
+    encoded_words = [word.encode('utf-8') for word in vocabulary]
+    word_offsets = array.array('I', [0])
+    for encoded_word in encoded_words:
+        word_offsets.append(word_offsets[-1] + len(encoded_word))
+    # open addressing table of the words, at most half full, probed linearly from the crc32 of the word
+    slot_count = 2
+    while slot_count < 2 * len(encoded_words):
+        slot_count *= 2
+    slot_hashes = array.array('I', bytes(slot_count * UINT32_BYTES))
+    slot_words = array.array('I', bytes(slot_count * UINT32_BYTES))
+    for word_id, encoded_word in enumerate(encoded_words):
+        word_hash = zlib.crc32(encoded_word)
+        slot = word_hash & (slot_count - 1)
+        while slot_words[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slot_hashes[slot] = word_hash
+        slot_words[slot] = word_id + 1
+    # the transitions of the root are indexed by word id, the others are sorted by word id for a binary search
+    first_targets = array.array('I', bytes(len(encoded_words) * UINT32_BYTES))
+    for word_id, child in children[0].items():
+        first_targets[word_id] = child
+    edge_starts = array.array('I', [0, 0])
+    edge_words = array.array('I')
+    edge_targets = array.array('I')
+    for edges in children[1:]:
+        for word_id in sorted(edges):
+            edge_words.append(word_id)
+            edge_targets.append(edges[word_id])
+        edge_starts.append(len(edge_words))
+    sections = [pad('\n'.join(categories).encode('utf-8')), word_offsets, pad(b''.join(encoded_words)),
+                slot_hashes, slot_words, first_targets, edge_starts, edge_words, edge_targets,
+                array.array('I', fail_states), array.array('I', state_patterns), array.array('I', output_links),
+                array.array('I', [word_count for word_count, _ in patterns]),
+                array.array('I', [category_index for _, category_index in patterns])]
+    for index, section in enumerate(sections):
+        if isinstance(section, array.array):
+            if sys.byteorder != 'little':
+                section.byteswap()
+            sections[index] = section.tobytes()
+    return sections
+
+
+def pad(blob: bytes) -> bytes:
+    return blob + b'\x00' * (-len(blob) % UINT32_BYTES)
+
+
+class GazetteerAutomaton:
+    """
+    Aho-Corasick automaton over the words of the terms of customer dictionaries, built by build_automaton
+    The file is memory mapped and read in place, opening it does not depend on its size and its pages are shared
+    by the processes of the host
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: the path of the automaton file
+        """
+        self.path = path
+        with open(path, 'rb') as automaton_file:
+            self.mapped = mmap.mmap(automaton_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, format_version, flags, digest, category_count, categories_size, word_count, words_size, slot_count,
+         state_count, edge_count, pattern_count) = HEADER.unpack_from(self.mapped)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self.mapped.close()
+            raise ValueError(f"\'{path}\' is not a gazetteer automaton of format version {FORMAT_VERSION}")
+        self.require_capitalized = bool(flags & FLAG_REQUIRE_CAPITALIZED)
+        # identifies the dictionaries, in the detection cache keys
+        self.fingerprint = digest.hex()
+        self.view = memoryview(self.mapped)
+        self.offset = HEADER.size
+        categories = self.take_bytes(categories_size)
+        self.categories = bytes(categories).decode('utf-8').split('\n') if category_count else []
+        self.word_offsets = self.take_uint32(word_count + 1)
+        self.words = self.take_bytes(words_size)
+        self.slot_hashes = self.take_uint32(slot_count)
+        self.slot_words = self.take_uint32(slot_count)
+        self.slot_mask = slot_count - 1
+        self.first_targets = self.take_uint32(word_count)
+        self.edge_starts = self.take_uint32(state_count + 1)
+        self.edge_words = self.take_uint32(edge_count)
+        self.edge_targets = self.take_uint32(edge_count)
+        self.fail_states = self.take_uint32(state_count)
+        self.state_patterns = self.take_uint32(state_count)
+        self.output_links = self.take_uint32(state_count)
+        self.pattern_words = self.take_uint32(pattern_count)
+        self.pattern_categories = self.take_uint32(pattern_count)
+        self.word_ids = {}
+
+    def take_bytes(self, size: int) -> memoryview:
+        section = self.view[self.offset:self.offset + size]
+        self.offset += size + (-size % UINT32_BYTES)
+        return section
+
+    def take_uint32(self, count: int):
+        section = self.view[self.offset:self.offset + count * UINT32_BYTES].cast('I')
+        self.offset += count * UINT32_BYTES
+        if sys.byteorder != 'little':
+            # the file is little endian, a big endian host reads a swapped copy
+            section = array.array('I', section)
+            section.byteswap()
+        return section
+
+    def lookup_word(self, token: str):
+        """
+        :param token: a word of the text
+        :return: the word id of the case folded token, None if no term has the word
+        """
+        word_id = self.word_ids.get(token, -1)
+        if word_id != -1:
+            return word_id
+        word = token.casefold().encode('utf-8')
+        word_hash = zlib.crc32(word)
+        slot = word_hash & self.slot_mask
+        while True:
+            word_id = self.slot_words[slot]
+            if not word_id:
+                word_id = None
+                break
+            word_id -= 1
+            if (self.slot_hashes[slot] == word_hash
+                    and self.words[self.word_offsets[word_id]:self.word_offsets[word_id + 1]] == word):
+                break
+            slot = (slot + 1) & self.slot_mask
+        if len(self.word_ids) >= WORD_CACHE_MAX_ENTRIES:
+            self.word_ids.clear()
+        self.word_ids[token] = word_id
+        return word_id
+
+    def next_state(self, state: int, word_id: int) -> int:
+        """
+        :return: the state reached from state with the word, following the failure links
+        """
+        while state:
+            low, high = self.edge_starts[state], self.edge_starts[state + 1]
+            if low < high:
+                position = bisect.bisect_left(self.edge_words, word_id, low, high)
+                if position < high and self.edge_words[position] == word_id:
+                    return self.edge_targets[position]
+            state = self.fail_states[state]
+        return self.first_targets[word_id]
+
+    def find(self, text: str) -> list:
+        """
+        Find the terms of the dictionaries in a text, the leftmost and then the longest where they overlap
+        :param text: the text to search
+        :return: list of (begin offset, end offset, category index) of the terms found, ordered by begin offset
+        """
+        spans = []
+        matches = []
+        state = 0
+        for match in TOKEN_PATTERN.finditer(text):
+            spans.append(match.span())
+            word_id = self.lookup_word(match.group())
+            if word_id is None:
+                # no term has the word, no term spans it
+                state = 0
+                continue
+            state = self.next_state(state, word_id)
+            output = state if self.state_patterns[state] else self.output_links[state]
+            while output:
+                pattern = self.state_patterns[output] - 1
+                matches.append((len(spans) - self.pattern_words[pattern], len(spans), pattern))
+                output = self.output_links[output]
+        if self.require_capitalized:
+            matches = [(first, last, pattern) for first, last, pattern in matches
+                       if text[spans[first][0]].isupper()]
+        found = []
+        end = 0
+        for first, last, pattern in sorted(matches, key=lambda x: (x[0], -x[1])):
+            if first >= end:
+                found.append((spans[first][0], spans[last - 1][1], self.pattern_categories[pattern]))
+                end = last
+        return found
+
+    def close(self) -> None:
+        for section in list(vars(self).values()):
+            if isinstance(section, memoryview):
+                section.release()
+        self.mapped.close()
+
+
+class GazetteerDetector:
+    """
+    Local detector of the terms of customer dictionaries, names, organizations and locations, an InferenceFacade
+    backend used alone or merged with the remote detection
+    """
+
+    def __init__(self, automaton: GazetteerAutomaton, language_code='en'):
+        """
+        :param automaton: the automaton of the dictionaries
+        :param language_code: the language code of the texts, selecting the entity types
+        """
+        self.automaton = automaton
+        self.language_code = language_code
+        types = TYPES_BY_LANGUAGE.get(language_code, TYPES_BY_LANGUAGE['en'])
+        self.entity_types = [types.get(category, category) for category in automaton.categories]
+
+    def detect_pii_entities(self, text: str) -> dict:
+        """
+        Get detail on the dictionary entities of the given text
+        :param text: text to detect PII entities
+        :return: dict of PII entities in the InferenceFacade format
+        """
+        return {'Transforms': [{'Type': self.entity_types[category_index],
+                                'BeginOffset': begin_offset,
+                                'EndOffset': end_offset,
+                                'Original': "",
+                                'Anonymized': ""
+                                } for begin_offset, end_offset, category_index in self.automaton.find(text)]}
+
+    def merge_pii_entities(self, text: str, transforms: dict) -> dict:
+        """
+        Add the dictionary entities of a text to the entities detected remotely, those overlapping a remote entity
+        are dropped
+        :param text: the text the entities were detected in
+        :param transforms: dict of PII entities in the InferenceFacade format, updated
+        :return: the updated transforms, ordered by begin offset
+        """
+        detected = transforms['Transforms']
+        spans = sorted((transform['BeginOffset'], transform['EndOffset']) for transform in detected)
+        starts = [begin_offset for begin_offset, _ in spans]
+        # the furthest end offset of the remote entities beginning up to each one
+        max_ends = list(itertools.accumulate((end_offset for _, end_offset in spans), max))
+        added = False
+        for transform in self.detect_pii_entities(text)['Transforms']:
+            # the remote entities beginning before this one ends overlap it if one ends after it begins
+            position = bisect.bisect_left(starts, transform['EndOffset'])
+            if position and max_ends[position - 1] > transform['BeginOffset']:
+                continue
+            detected.append(transform)
+            added = True
+        if added:
+            detected.sort(key=lambda x: x['BeginOffset'])
+        return transforms
+
+
+def from_environment(environ=os.environ):
+    """
+    :param environ: the environment naming the automaton file
+    :return: the GazetteerAutomaton of the file named by GAZETTEER_PATH, None if it is not set
+    """
+    path = environ.get(GAZETTEER_PATH_ENVIRONMENT_VARIABLE)
+    return GazetteerAutomaton(path) if path else None
@@ -2,38 +2,351 @@
 # Inference Facade v1.00
 #######
 
-import boto3
-import json
+import bisect
+import re
+import threading
+import time
+
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.GazetteerDetector as GazetteerDetector
+import anonymizer.JsonCodec as JsonCodec
+import anonymizer.RateLimiter as RateLimiter
 
 # This maps to the sagemaker deployed endpoint name
 END_POINT_FR = "pii-fr-e-endpoint"
 
+# Comprehend detect_pii_entities accepts at most 100 KB of UTF-8 text per request, keep some headroom when packing
+PACKED_MAX_TEXT_BYTES = 90 * 1024
+# Blank lines between packed texts, so entities are not detected across two records
+PACKED_SEPARATOR = "\n\n\n"
+# Number of texts per packed request, adapted to the observed request latency
+PACKED_INITIAL_TEXTS = 16
+PACKED_MIN_TEXTS = 1
+PACKED_MAX_TEXTS = 512
+PACKED_TARGET_LATENCY_SECONDS = 0.5
+# The sagemaker endpoint accepts 6 MB per invocation, texts are batched as an inputs array up to this JSON size
+BATCHED_FR_MAX_PAYLOAD_BYTES = 5 * 1024 * 1024
+
+# Texts over the size limit of a request are detected in chunks overlapping by this many characters, an entity
+# cut at the edge of a chunk is found whole in the next one
+CHUNK_OVERLAP_CHARS = 256
+# Chunks end at a sentence boundary, or else at a whitespace, found in the second half of the chunk
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"[.!?]+[\"')\]]*\s+|\n\s*")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Entities requested from the French model, and the score below which they are dropped
+FR_ENTITIES = ["PERSON", "ORGANIZATION", "EMAIL_ADDRESS", "PHONE_NUMBER", "LOCATION"]
+FR_MIN_SCORE = 0.8
+
+# How the local gazetteer of customer dictionaries is used: not at all, merged with the remote detection, or alone
+# without any remote call
+GAZETTEER_OFF = 'off'
+GAZETTEER_MERGE = 'merge'
+GAZETTEER_ONLY = 'only'
+GAZETTEER_MODES = [GAZETTEER_OFF, GAZETTEER_MERGE, GAZETTEER_ONLY]
+
 
 class InferenceFacade:
 
-    def __init__(self, language_code='en'):
+    def __init__(self, language_code='en', max_pool_connections=10, gazetteer_automaton=None,
+                 gazetteer_mode=GAZETTEER_OFF):
         self.language_code = language_code
+        self.max_pool_connections = max_pool_connections
+        if gazetteer_mode != GAZETTEER_OFF and gazetteer_automaton is None:
+            raise ValueError(f"Gazetteer mode \'{gazetteer_mode}\' needs a gazetteer automaton")
+        self.gazetteer_mode = gazetteer_mode
+        self.gazetteer = GazetteerDetector.GazetteerDetector(gazetteer_automaton, language_code) \
+            if gazetteer_mode != GAZETTEER_OFF else None
         if language_code == 'fr':
             self.end_point_name = END_POINT_FR
-            self.end_point_client = boto3.client('sagemaker-runtime')
             self.ai_detect_facade = self.detect_pii_entities_fr
             self.start_offset = 'start'
             self.end_offset = 'end'
             self.type_keyword = 'entity_type'
+            # the text is sent as UTF-8 JSON, in a payload limited in size
+            self.max_text_size = BATCHED_FR_MAX_PAYLOAD_BYTES
+            self.text_size = self.json_text_size
         else:
-            self.comprehend_client = boto3.client('comprehend')
             self.ai_detect_facade = self.detect_pii_entities_en
             self.start_offset = 'BeginOffset'
             self.end_offset = 'EndOffset'
             self.type_keyword = 'Type'
+            self.max_text_size = PACKED_MAX_TEXT_BYTES
+            self.text_size = self.utf8_text_size
+        # Comprehend takes the texts joined in one text, the sagemaker endpoint takes them as an inputs array
+        self.packing_supported = language_code != 'fr'
+        self.packed_texts_per_request = PACKED_INITIAL_TEXTS
+        # the facade is shared by the detection threads, which adapt the number of texts per request concurrently
+        self.packed_texts_lock = threading.Lock()
+
+    @property
+    def detection_namespace(self) -> str:
+        """
+        The namespace of the detection cache keys, the language code, and the gazetteer mode and dictionaries if used
+        """
+        if self.gazetteer is None:
+            return self.language_code
+        return f"{self.language_code}:gazetteer-{self.gazetteer_mode}:{self.gazetteer.automaton.fingerprint}"
+
+    @property
+    def comprehend_client(self):
+        """
+        The shared comprehend client, created on first use
+        """
+        return ClientRegistry.get_client('comprehend', max_pool_connections=self.max_pool_connections)
+
+    @property
+    def rate_limiter(self):
+        """
+        The rate limiter shared by the calls of the process to the detection service of the language
+        """
+        return RateLimiter.get_limiter('sagemaker-runtime' if self.language_code == 'fr' else 'comprehend')
+
+    @property
+    def end_point_client(self):
+        """
+        The shared sagemaker runtime client, created on first use
+        """
+        return ClientRegistry.get_client('sagemaker-runtime', max_pool_connections=self.max_pool_connections)
 
     def detect_pii_entities(self, text: str) -> dict:
         """
-        Get detail on PII entities in the given text
+        Get detail on PII entities in the given text, with the remote detector, the gazetteer, or both
         :param text: text to detect PII entities
         :return: dict of PII entities with details on their location in the text
         """
-        entities = self.ai_detect_facade(text)
+        if self.gazetteer_mode == GAZETTEER_ONLY:
+            return self.gazetteer.detect_pii_entities(text)
+        transforms = self.detect_pii_entities_remote(text)
+        if self.gazetteer_mode == GAZETTEER_MERGE:
+            return self.gazetteer.merge_pii_entities(text, transforms)
+        return transforms
+
+    def detect_pii_entities_remote(self, text: str) -> dict:
+        """
+        Get detail on PII entities in the given text, with the remote detector of the language
+        :param text: text to detect PII entities
+        :return: dict of PII entities with details on their location in the text
+        """
+        if self.text_size(text) > self.max_text_size:
+            entities = self.detect_pii_entities_chunked(text)
+        else:
+            entities = self.ai_detect_facade(text)
+        return self.build_transforms(entities)
+
+    @staticmethod
+    def utf8_text_size(text: str) -> int:
+        return len(text.encode('utf-8'))
+
+    @staticmethod
+    def json_text_size(text: str) -> int:
+        return len(JsonCodec.dumps(text))
+
+    def detect_pii_entities_chunked(self, text: str) -> list:
+        """
+        Get detail on PII entities in a text over the size limit of a request, detecting overlapping chunks of
+        the text one after the other, the caller already runs as many detections in parallel as its connection pool
+        and the rate limiter allow
+        :param text: text to detect PII entities
+        :return: list of PII entities with their location in the text, as returned by the service for a text
+        """
+        chunks = self.split_text(text)
+        chunk_entities = [self.ai_detect_facade(text[start:end]) for start, end in chunks]
+        return self.merge_chunk_entities(chunks, chunk_entities)
+
+    def split_text(self, text: str) -> list:
+        """
+        Split a text into chunks within the size limit of a request, ending on sentence or whitespace boundaries
+        Each chunk starts up to CHUNK_OVERLAP_CHARS before the end of the previous one, at the start of a word
+        :param text: the text to split
+        :return: list of (start offset, end offset) of the chunks
+        """
+        chunks = []
+        start = 0
+        while True:
+            limit = self.fit_text(text, start)
+            if limit >= len(text):
+                chunks.append((start, len(text)))
+                return chunks
+            middle = start + (limit - start) // 2
+            end = None
+            for pattern in [SENTENCE_BOUNDARY_PATTERN, WHITESPACE_PATTERN]:
+                for match in pattern.finditer(text, middle, limit):
+                    end = match.end()
+                if end is not None:
+                    break
+            end = end or limit
+            chunks.append((start, end))
+            next_start = WHITESPACE_PATTERN.search(text, max(end - CHUNK_OVERLAP_CHARS, start + 1), end)
+            start = next_start.end() if next_start is not None else end
+
+    def fit_text(self, text: str, start: int) -> int:
+        """
+        :param text: the text to split
+        :param start: the start offset of a chunk
+        :return: the largest end offset of a chunk starting at start within the size limit, at least start + 1
+        """
+        low, high = start + 1, min(len(text), start + self.max_text_size)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.text_size(text[start:middle]) <= self.max_text_size:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def merge_chunk_entities(self, chunks: list, chunk_entities: list) -> list:
+        """
+        Shift the entities of the chunks to the offsets of the text, and merge the entities of the same type
+        that overlap across two chunks, an entity detected twice or cut at the edge of a chunk
+        :param chunks: the (start offset, end offset) of each chunk
+        :param chunk_entities: the entities detected in each chunk
+        :return: the entities of the text, ordered by start offset
+        """
+        shifted = []
+        for chunk_index, ((start, _), entities) in enumerate(zip(chunks, chunk_entities)):
+            for entity in entities:
+                entity = dict(entity)
+                entity[self.start_offset] += start
+                entity[self.end_offset] += start
+                shifted.append((chunk_index, entity))
+        shifted.sort(key=lambda x: (x[1][self.start_offset], -x[1][self.end_offset]))
+        merged = []
+        # the last entity kept of each type, and the chunk it was detected in
+        last_by_type = {}
+        for chunk_index, entity in shifted:
+            last_chunk_index, last = last_by_type.get(entity[self.type_keyword], (None, None))
+            if (last is not None and last_chunk_index != chunk_index
+                    and entity[self.start_offset] < last[self.end_offset]):
+                last[self.end_offset] = max(last[self.end_offset], entity[self.end_offset])
+                continue
+            merged.append(entity)
+            last_by_type[entity[self.type_keyword]] = (chunk_index, entity)
+        return merged
+
+    def detect_pii_entities_packed(self, texts: list) -> list:
+        """
+        Get detail on PII entities in many short texts, packing several texts into each service request
+        The returned entities are split back to the text they belong to, with offsets relative to that text.
+        Texts with an entity straddling a separator are detected again on their own. The service sees each text
+        next to others, its model may find slightly different entities than in the text alone, so the result
+        matches calling detect_pii_entities for each text only when the detection does not depend on the context
+        :param texts: the texts to detect PII entities
+        :return: list of dict of PII entities, one per text, in the same order as texts
+        """
+        if self.gazetteer_mode == GAZETTEER_ONLY:
+            return [self.gazetteer.detect_pii_entities(text) for text in texts]
+        results = self.detect_pii_entities_packed_remote(texts)
+        if self.gazetteer_mode == GAZETTEER_MERGE:
+            return [self.gazetteer.merge_pii_entities(text, transforms) for text, transforms in zip(texts, results)]
+        return results
+
+    def detect_pii_entities_packed_remote(self, texts: list) -> list:
+        """
+        :param texts: the texts to detect PII entities
+        :return: list of dict of PII entities detected remotely, one per text, in the same order as texts
+        """
+        if not self.packing_supported:
+            return self.detect_pii_entities_batched_fr(texts)
+        results = [None] * len(texts)
+        for pack in self.generate_packs(texts):
+            if len(pack) == 1:
+                results[pack[0]] = self.detect_pii_entities_remote(texts[pack[0]])
+                continue
+            packed_text, segments = self.pack_texts(texts, pack)
+            start_time = time.perf_counter()
+            entities = self.ai_detect_facade(packed_text)
+            self.adapt_packed_texts_per_request(time.perf_counter() - start_time)
+            for index, entities in self.unpack_entities(entities, segments).items():
+                if entities is None:
+                    results[index] = self.detect_pii_entities_remote(texts[index])
+                else:
+                    results[index] = self.build_transforms(entities)
+        return results
+
+    def generate_packs(self, texts: list):
+        """
+        Group the texts into packs that fit in a single service request
+        :param texts: the texts to pack
+        :return: generator of lists of indexes into texts
+        """
+        separator_size = len(PACKED_SEPARATOR.encode('utf-8'))
+        pack = []
+        pack_size = 0
+        for index, text in enumerate(texts):
+            text_size = len(text.encode('utf-8'))
+            if pack and (pack_size + separator_size + text_size > PACKED_MAX_TEXT_BYTES
+                         or len(pack) >= self.packed_texts_per_request):
+                yield pack
+                pack = []
+                pack_size = 0
+            if pack:
+                pack_size += separator_size
+            pack.append(index)
+            pack_size += text_size
+        if pack:
+            yield pack
+
+    @staticmethod
+    def pack_texts(texts: list, pack: list) -> (str, list):
+        """
+        Join the texts of a pack into one text
+        :param texts: all the texts
+        :param pack: the indexes of the texts to join
+        :return: the packed text, and the (index, start offset, end offset) of each text in the packed text
+        """
+        segments = []
+        offset = 0
+        for index in pack:
+            segments.append((index, offset, offset + len(texts[index])))
+            offset += len(texts[index]) + len(PACKED_SEPARATOR)
+        packed_text = PACKED_SEPARATOR.join(texts[index] for index in pack)
+        return packed_text, segments
+
+    def unpack_entities(self, entities: list, segments: list) -> dict:
+        """
+        Assign the entities detected in a packed text back to the text they were found in
+        :param entities: the entities detected in the packed text, ordered by start offset or not
+        :param segments: the (index, start offset, end offset) of each text in the packed text
+        :return: dict of text index to its entities with shifted offsets, None if an entity straddles its boundary
+        """
+        unpacked = {index: [] for index, _, _ in segments}
+        starts = [start for _, start, _ in segments]
+        for entity in entities:
+            begin, end = entity[self.start_offset], entity[self.end_offset]
+            position = bisect.bisect_right(starts, begin) - 1
+            index, start, stop = segments[max(position, 0)]
+            if begin < start or end > stop:
+                # crosses a separator, detect the texts it touches on their own
+                for other_index, other_start, other_stop in segments:
+                    if other_start < end and begin < other_stop:
+                        unpacked[other_index] = None
+                continue
+            if unpacked[index] is not None:
+                entity = dict(entity)
+                entity[self.start_offset] = begin - start
+                entity[self.end_offset] = end - start
+                unpacked[index].append(entity)
+        return unpacked
+
+    def adapt_packed_texts_per_request(self, elapsed_seconds: float) -> None:
+        """
+        Grow the number of texts per packed request while requests are fast, shrink it when they get slow
+        :param elapsed_seconds: the latency of the last packed request
+        :return: None
+        """
+        with self.packed_texts_lock:
+            if elapsed_seconds < PACKED_TARGET_LATENCY_SECONDS:
+                self.packed_texts_per_request = min(self.packed_texts_per_request * 2, PACKED_MAX_TEXTS)
+            else:
+                self.packed_texts_per_request = max(self.packed_texts_per_request // 2, PACKED_MIN_TEXTS)
+
+    def build_transforms(self, entities: list) -> dict:
+        """
+        Convert the entities returned by the service into transforms
+        :param entities: the entities returned by the service
+        :return: dict of PII entities with details on their location in the text
+        """
         transform_list = []
         for entity in entities:
             transform = {'Type': entity[self.type_keyword],
@@ -52,45 +365,101 @@ class InferenceFacade:
         :param text: text to detect PII entities
         :return: dict of PII entities with details on their location in the text
         """
-        response = self.comprehend_client.detect_pii_entities(Text=text, LanguageCode='en')
+        response = self.rate_limiter.call(self.comprehend_client.detect_pii_entities, Text=text, LanguageCode='en')
         return response['Entities']
 
-    def detect_pii_entities_fr(self, text: str) -> list:
+    def detect_pii_entities_batched_fr(self, texts: list) -> list:
         """
-        Get detail on PII and sensitive entities in the given text
-        There is ad hoc adjustments for the returned entities to make it better match with Comprehend service
-        :param text: text to detect PII entities
-        :return: list of PII entities with details on their location in the text
+        Get detail on PII entities in many texts, sending them to the sagemaker endpoint as an inputs array
+        :param texts: the texts to detect PII entities
+        :return: list of dict of PII entities, one per text, in the same order as texts
+        """
+        results = [None] * len(texts)
+        # texts over the size limit are detected in chunks
+        batched = []
+        for index, text in enumerate(texts):
+            if self.text_size(text) > self.max_text_size:
+                results[index] = self.detect_pii_entities_remote(text)
+            else:
+                batched.append(index)
+        for batch in self.generate_batches_fr([texts[index] for index in batched]):
+            start_time = time.perf_counter()
+            found_lists = self.invoke_endpoint_fr([texts[batched[position]] for position in batch])
+            self.adapt_packed_texts_per_request(time.perf_counter() - start_time)
+            for position, entities in zip(batch, self.adjust_entities_fr(found_lists)):
+                results[batched[position]] = self.build_transforms(entities)
+        return results
+
+    def generate_batches_fr(self, texts: list):
+        """
+        Group the texts into batches that fit in a single invocation of the sagemaker endpoint
+        :param texts: the texts to batch
+        :return: generator of lists of consecutive indexes into texts
+        """
+        batch = []
+        batch_size = 0
+        for index, text in enumerate(texts):
+            # the payload is UTF-8 JSON, its size is the length of the encoded text and its separator
+            text_size = len(JsonCodec.dumps(text)) + 1
+            if batch and (batch_size + text_size > BATCHED_FR_MAX_PAYLOAD_BYTES
+                          or len(batch) >= self.packed_texts_per_request):
+                yield batch
+                batch = []
+                batch_size = 0
+            batch.append(index)
+            batch_size += text_size
+        if batch:
+            yield batch
+
+    def invoke_endpoint_fr(self, inputs):
+        """
+        :param inputs: a text, or a list of texts
+        :return: the entities found in the text, or the list of the entities found in each text
         """
         data = {
-            "inputs": text,
+            "inputs": inputs,
             "parameters": {
-                "entities": ["PERSON", "ORGANIZATION", "EMAIL_ADDRESS", "PHONE_NUMBER", "LOCATION"]
+                "entities": FR_ENTITIES
             }
         }
-        binary_payload = bytes(json.dumps(data), 'utf-8')
-        response = self.end_point_client.invoke_endpoint(EndpointName=self.end_point_name,
-                                                         ContentType='application/json',
-                                                         Body=binary_payload)
-        body = response['Body'].read().decode('utf-8')
-        body = json.loads(body)
-        # order the entities  by start offset
-        entities = body['found']
-        entities.sort(key=lambda x: x['start'])
-        # remove entities with score less than 0.8
-        entities = [entity for entity in entities if entity['score'] > 0.8 or entity['entity_type'] == 'PHONE_NUMBER']
-        # TODO: Filter over lapping entities if they occur
-        for entity in entities:
+        binary_payload = JsonCodec.dumps(data)
+        response = self.rate_limiter.call(self.end_point_client.invoke_endpoint, EndpointName=self.end_point_name,
+                                          ContentType='application/json', Body=binary_payload)
+        body = JsonCodec.loads(response['Body'].read())
+        if isinstance(inputs, list):
+            return [result['found'] for result in body]
+        return body['found']
+
+    @staticmethod
+    def adjust_entities_fr(found_lists: list) -> list:
+        """
+        Ad hoc adjustments of the entities returned by the sagemaker endpoint, to better match with Comprehend
+        The entities of all the texts of a batch are adjusted in a single pass
+        :param found_lists: the entities found in each text
+        :return: the adjusted entities of each text, ordered by start offset
+        """
+        adjusted = [[] for _ in found_lists]
+        # order the entities by text, then by the start offset returned
+        for index, entity in sorted(((index, entity) for index, found in enumerate(found_lists) for entity in found),
+                                    key=lambda x: (x[0], x[1]['start'])):
+            # remove entities with score less than 0.8
+            if entity['score'] <= FR_MIN_SCORE and entity['entity_type'] != 'PHONE_NUMBER':
+                continue
+            # overlapping entities are resolved by ScrubTransforms when the anonymous text is generated
             if entity['entity_type'] not in ['PHONE_NUMBER', 'EMAIL_ADDRESS']:
                 entity['start'] = entity['start'] + 1
             if entity['entity_type'] == 'PHONE_NUMBER':
                 entity['entity_type'] = 'PHONE_NUMBER_FR'
             if entity['entity_type'] == 'PERSON':
                 entity['entity_type'] = 'PERSON_FR'
-        return entities
-
-
-
-
-
+            adjusted[index].append(entity)
+        return adjusted
 
+    def detect_pii_entities_fr(self, text: str) -> list:
+        """
+        Get detail on PII and sensitive entities in the given text
+        There is ad hoc adjustments for the returned entities to make it better match with Comprehend service
+        :param text: text to detect PII entities
+        :return: list of PII entities with details on their location in the text
+        """
+        return self.adjust_entities_fr([self.invoke_endpoint_fr(text)])[0]
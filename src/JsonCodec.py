@@ -0,0 +1,65 @@
+#######
+# Json Codec v1.00
+#######
+
+import json
+
+# orjson encodes and decodes several times faster than the json module, straight to and from UTF-8 bytes. It is
+# optional, the json module is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODER_ORJSON = 'orjson'
+ENCODER_STDLIB = 'json'
+ENCODER = ENCODER_ORJSON if orjson is not None else ENCODER_STDLIB
+
+# The json module writes compact UTF-8 documents like orjson, so a document does not depend on the encoder, but for
+# the exponent of very small or large floats. A text with a lone surrogate is not valid UTF-8, orjson rejects it and
+# the json module escapes the document to ASCII
+STDLIB_SEPARATORS = (',', ':')
+# orjson encodes datetimes and dataclasses itself, they are passed to default like the json module does
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson is not None else 0
+
+
+def dumps(value, default=None) -> bytes:
+    """
+    :param value: the value to encode, made of dicts, lists, strings, numbers, booleans and None
+    :param default: called with a value of another type, returns a value to encode in its place, e.g. str, None
+    to raise TypeError
+    :return: the compact JSON document, UTF-8 encoded
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=default, option=ORJSON_OPTIONS)
+        except TypeError:
+            # orjson only takes string keys and 64 bit integers, the json module handles the rest
+            pass
+    try:
+        return json.dumps(value, separators=STDLIB_SEPARATORS, ensure_ascii=False, default=default).encode('utf-8')
+    except UnicodeEncodeError:
+        return json.dumps(value, separators=STDLIB_SEPARATORS, default=default).encode('ascii')
+
+
+def dumps_text(value, default=None) -> str:
+    """
+    :param value: the value to encode
+    :param default: called with a value of another type, returns a value to encode in its place
+    :return: the compact JSON document, as a string
+    """
+    return dumps(value, default).decode('utf-8')
+
+
+def loads(document):
+    """
+    :param document: a JSON document, as UTF-8 bytes or as a string
+    :return: the decoded value
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(document)
+        except ValueError:
+            # the json module also accepts NaN and Infinity, or raises the error
+            pass
+    return json.loads(document)
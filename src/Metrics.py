@@ -0,0 +1,273 @@
+#######
+# Metrics v1.00
+#######
+
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+
+# CloudWatch namespace of the metrics, emitted as embedded metric format log lines
+NAMESPACE = 'PiiScrubService'
+
+# Stages of the processing, each with a latency histogram
+STAGE_CONTROL = 'control'
+STAGE_DETECT = 'detect'
+STAGE_REWRITE = 'rewrite'
+STAGE_PERSIST = 'persist'
+STAGE_FETCH = 'fetch'
+STAGE_OUTPUT = 'output'
+STAGE_INVOCATION = 'invocation'
+
+# Counters
+RECORDS = 'records'
+BYTES_IN = 'bytes_in'
+BYTES_OUT = 'bytes_out'
+FAILED_RECORDS = 'failed_records'
+SPILLED_RESPONSES = 'spilled_responses'
+DETECTION_CACHE_HITS = 'detection_cache_hits'
+DETECTION_CACHE_MISSES = 'detection_cache_misses'
+DETECTION_CACHE_ERRORS = 'detection_cache_errors'
+REMOTE_CALLS_AVOIDED = 'remote_calls_avoided'
+THROTTLED_CALLS = 'throttled_calls'
+ENTITIES_PREFIX = 'entities_'
+
+# Upper bounds of the latency histogram buckets, in milliseconds, the last bucket has no upper bound
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, adding a value is a bisect and a few additions
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+    def to_dict(self) -> dict:
+        """
+        :return: the count, sum, min and max, and the count of each non empty bucket by its upper bound
+        """
+        bounds = [str(bound) for bound in self.buckets] + ['inf']
+        return {'count': self.count,
+                'sum': round(self.total, 3),
+                'min': round(self.minimum, 3) if self.minimum is not None else None,
+                'max': round(self.maximum, 3) if self.maximum is not None else None,
+                'buckets': {bound: count for bound, count in zip(bounds, self.counts) if count}}
+
+    def merge(self, other) -> None:
+        """
+        Add the values of another histogram with the same buckets
+        :param other: the histogram to add
+        :return: None
+        """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+
+
+class StageTimer:
+    """
+    Time of a stage, less the time spent waiting on the iterables it pulls from
+    """
+
+    def __init__(self):
+        self.excluded_seconds = 0.0
+
+    def exclude(self, iterable):
+        """
+        :param iterable: the iterable the stage consumes, lazily produced by the other stages
+        :return: generator of the items of iterable, the time to produce them is not counted in the stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.excluded_seconds += time.perf_counter() - start
+                return
+            self.excluded_seconds += time.perf_counter() - start
+            yield item
+
+
+class MetricsRecorder:
+    """
+    Latency histograms by stage and counters of an invocation, or of a batch of a server, shared by the threads
+    processing it
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def record_latency(self, stage: str, milliseconds: float) -> None:
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].add(milliseconds)
+
+    def increment(self, name: str, value=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_entities(self, counts_by_type: dict) -> None:
+        """
+        :param counts_by_type: dict of entity type to the number of entities detected
+        :return: None
+        """
+        with self.lock:
+            for entity_type, count in counts_by_type.items():
+                name = ENTITIES_PREFIX + entity_type
+                self.counters[name] = self.counters.get(name, 0) + count
+
+    def merge(self, other) -> None:
+        """
+        Add the latencies and counters of another recorder, a batch into the recorder of a server for example
+        :param other: the recorder to add, no longer updated
+        :return: None
+        """
+        with other.lock:
+            histograms = dict(other.histograms)
+            counters = dict(other.counters)
+        with self.lock:
+            for stage, histogram in histograms.items():
+                if stage not in self.histograms:
+                    self.histograms[stage] = Histogram(histogram.buckets)
+                self.histograms[stage].merge(histogram)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """
+        Record the latency of the block in the histogram of the stage
+        :param stage: the stage the block belongs to
+        :return: context of a StageTimer, to exclude the time spent in the iterables of the other stages
+        """
+        stage_timer = StageTimer()
+        start = time.perf_counter()
+        try:
+            yield stage_timer
+        finally:
+            self.record_latency(stage, (time.perf_counter() - start - stage_timer.excluded_seconds) * 1000)
+
+    def to_emf(self, dimensions: dict, timestamp_ms: int = None) -> dict:
+        """
+        :param dimensions: dict of dimension name to value, the metrics are emitted for these dimensions
+        :param timestamp_ms: the timestamp of the metrics, now by default
+        :return: the metrics as a CloudWatch embedded metric format document
+        """
+        with self.lock:
+            histograms = {stage: histogram.to_dict() for stage, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        metrics = [{'Name': f"{stage}_ms", 'Unit': 'Milliseconds'} for stage in histograms]
+        metrics.extend({'Name': name, 'Unit': 'Bytes' if name.startswith('bytes') else 'Count'} for name in counters)
+        document = {
+            '_aws': {
+                'Timestamp': timestamp_ms if timestamp_ms is not None else int(time.time() * 1000),
+                'CloudWatchMetrics': [{'Namespace': NAMESPACE,
+                                       'Dimensions': [list(dimensions)],
+                                       'Metrics': metrics}]
+            },
+            # the latency histograms are kept in the log line for queries on the log group
+            'latency_histograms_ms': histograms
+        }
+        document.update(dimensions)
+        document.update((f"{stage}_ms", histogram['sum']) for stage, histogram in histograms.items())
+        document.update(counters)
+        return document
+
+    def emit(self, dimensions: dict) -> None:
+        """
+        Print the metrics as a single embedded metric format log line
+        :param dimensions: dict of dimension name to value
+        :return: None
+        """
+        print(json.dumps(self.to_emf(dimensions), separators=(',', ':')))
+
+
+# The recorder of the current invocation is local to the context, so the concurrent requests of a server do not
+# share it. The work an invocation hands to a thread pool runs in a copy of its context, see in_current_context
+_current_recorder = contextvars.ContextVar('metrics_recorder')
+# The recorder of the contexts that did not start one
+_default_recorder = MetricsRecorder()
+
+
+def current() -> MetricsRecorder:
+    """
+    :return: the recorder of the current context
+    """
+    return _current_recorder.get(_default_recorder)
+
+
+def reset() -> MetricsRecorder:
+    """
+    Start recording a new invocation, in the current context
+    :return: the new recorder
+    """
+    recorder = MetricsRecorder()
+    _current_recorder.set(recorder)
+    return recorder
+
+
+def in_current_context(function):
+    """
+    :param function: a function to run on another thread, a thread of a pool for example
+    :return: function calling the given function in a copy of the current context, so it records its metrics in
+    the current recorder
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # a context can not be entered by two threads at once, each call runs in a copy of its own
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+
+def timed(stage: str):
+    """
+    Decorator recording the latency of each call of a function, or coroutine function, in the recorder of the
+    context of the call
+    :param stage: the stage the function belongs to
+    """
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    current().record_latency(stage, (time.perf_counter() - start) * 1000)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                current().record_latency(stage, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
@@ -0,0 +1,150 @@
+#######
+# Micro Batcher v1.00
+#######
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# A batch is processed once it has this many records, or once its first records waited this long
+DEFAULT_MAX_BATCH_RECORDS = 500
+DEFAULT_MAX_WAIT_SECONDS = 0.01
+# Batches processed at once
+DEFAULT_WORKERS = 4
+
+
+class PendingBatch:
+    """
+    The requests coalesced in a batch not dispatched yet
+    """
+
+    def __init__(self, created: float):
+        self.created = created
+        self.requests = []
+        self.record_count = 0
+
+
+class MicroBatcher:
+    """
+    Coalesces the records of concurrent requests into shared batches, processed by a pool of workers
+    Only requests with the same key, the processing options of their records, share a batch. A batch is dispatched
+    when it reaches max_batch_records, or when its first request waited max_wait_seconds, so a request waits at most
+    that long for others to join it. Each request gets the results of its own records back
+    """
+
+    def __init__(self, process_batch, max_batch_records: int = DEFAULT_MAX_BATCH_RECORDS,
+                 max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS, workers: int = DEFAULT_WORKERS):
+        """
+        :param process_batch: function of the key and the records of a batch, returning one result per record in
+        the same order
+        :param max_batch_records: the number of records over which a batch is dispatched without waiting
+        :param max_wait_seconds: the longest time a request waits for other requests to join its batch
+        :param workers: the number of batches processed at once
+        """
+        self.process_batch = process_batch
+        self.max_batch_records = max_batch_records
+        self.max_wait_seconds = max_wait_seconds
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.condition = threading.Condition()
+        # pending batches by key, in the order they were created, so the first one has the nearest deadline
+        self.pending = {}
+        self.closed = False
+        self.requests = 0
+        self.records = 0
+        self.batches = 0
+        self.dispatcher = threading.Thread(target=self.dispatch_expired_batches, name='micro-batcher', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, key, records: list) -> Future:
+        """
+        :param key: the processing options of the records, hashable, only requests with the same key share a batch
+        :param records: the records of the request
+        :return: future of the results of the records, in the same order
+        """
+        future = Future()
+        if not records:
+            future.set_result([])
+            return future
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The micro batcher is closed')
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = PendingBatch(time.monotonic())
+                # a new deadline for the dispatcher
+                self.condition.notify()
+            batch.requests.append((records, future))
+            batch.record_count += len(records)
+            self.requests += 1
+            self.records += len(records)
+            if batch.record_count >= self.max_batch_records:
+                self.dispatch(key, self.pending.pop(key))
+        return future
+
+    def process(self, key, records: list) -> list:
+        """
+        :return: the results of the records, once their batch is processed
+        """
+        return self.submit(key, records).result()
+
+    def dispatch_expired_batches(self) -> None:
+        """
+        Dispatch the pending batches as their wait time expires, and all of them once the batcher is closed
+        :return: None
+        """
+        with self.condition:
+            while not self.closed or self.pending:
+                now = time.monotonic()
+                for key in [key for key, batch in self.pending.items()
+                            if self.closed or now - batch.created >= self.max_wait_seconds]:
+                    self.dispatch(key, self.pending.pop(key))
+                if not self.closed:
+                    timeout = next(iter(self.pending.values())).created + self.max_wait_seconds - now \
+                        if self.pending else None
+                    self.condition.wait(timeout)
+
+    def dispatch(self, key, batch: PendingBatch) -> None:
+        self.batches += 1
+        self.executor.submit(self.run_batch, key, batch)
+
+    def run_batch(self, key, batch: PendingBatch) -> None:
+        """
+        Process the records of the requests of a batch together, and give each request the results of its records
+        A batch that fails fails all its requests, the processing isolates the failures of single records
+        :return: None
+        """
+        records = [record for request_records, _ in batch.requests for record in request_records]
+        try:
+            results = self.process_batch(key, records)
+            if len(results) != len(records):
+                raise ValueError(f"{len(results)} results for a batch of {len(records)} records")
+        except Exception as error:
+            for _, future in batch.requests:
+                future.set_exception(error)
+            return
+        offset = 0
+        for request_records, future in batch.requests:
+            future.set_result(results[offset:offset + len(request_records)])
+            offset += len(request_records)
+
+    def stats(self) -> dict:
+        """
+        :return: the counters of the batcher, and the average numbers of requests and records per batch
+        """
+        with self.condition:
+            return {'requests': self.requests,
+                    'records': self.records,
+                    'batches': self.batches,
+                    'requests_per_batch': self.requests / self.batches if self.batches else 0.0,
+                    'records_per_batch': self.records / self.batches if self.batches else 0.0}
+
+    def close(self) -> None:
+        """
+        Dispatch the pending batches, and wait for all the batches to be processed
+        :return: None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
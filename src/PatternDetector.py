@@ -0,0 +1,126 @@
+#######
+# Pattern Detector v1.00
+#######
+
+import re
+import threading
+
+import anonymizer.Metrics as Metrics
+import anonymizer.ScrubTransforms as ScrubTransforms
+
+# Policies deciding when the local detection is enough and the remote call can be skipped
+POLICY_OFF = 'off'
+# skip when every word of the rest of the text is a stopword, and it has no digit
+POLICY_CONSERVATIVE = 'conservative'
+# skip when every word of the rest of the text is a stopword, and its numbers are short, as quantities are
+POLICY_AGGRESSIVE = 'aggressive'
+POLICIES = [POLICY_OFF, POLICY_CONSERVATIVE, POLICY_AGGRESSIVE]
+
+EMAIL_PATTERN = re.compile(r"(?<![\w.+-])[\w.%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,}(?![\w-])")
+PHONE_PATTERN = re.compile(r"(?<![\w+])(?:\+?1[ .-]?)?(?:\(\d{3}\)|\d{3})[ .-]?\d{3}[ .-]?\d{4}(?!\w)")
+PHONE_FR_PATTERN = re.compile(r"(?<![\w+])(?:(?:\+|00)33 ?[1-9]|0[1-9])(?:[ .-]?\d{2}){4}(?!\w)")
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+# digits with the separators of identifiers and account numbers between them, counted as one number
+NUMBER_PATTERN = re.compile(r"\d(?:[\s./-]*\d)*")
+# the longest number the aggressive policy accepts, an SSN or a card number is longer
+AGGRESSIVE_MAX_NUMBER_DIGITS = 3
+
+# Function words that are not names in any context. Words that are also first names or places, as will, may, bill
+# or nice, are left out so they are detected remotely
+STOPWORDS_BY_LANGUAGE = {
+    'en': frozenset('''
+        a about above after again against all am an and any are as at be because been before being below between
+        both but by can could did do does doing done down during each few for from further had has have having he
+        her here hers herself him himself his how i if in into is it its itself just me more most my myself no nor
+        not now of off on once only or other our ours ourselves out over own same she should so some such than that
+        the their theirs them themselves then there these they this those through to too under until up very was we
+        were what when where which while who whom why with would you your yours yourself yourselves
+        please thanks thank hello hi dear regards yes ok okay
+        '''.split()),
+    'fr': frozenset('''
+        à au aux avec ce ces cet cette dans de des du elle elles en est et eux il ils je la le les leur leurs lui ma
+        mais me même mes moi mon ne nos notre nous on ou où par pas pour qu que qui sa se ses si son sont sur ta te
+        tes toi ton tu un une vos votre vous y été être avoir ai as avons avez ont était c d j l m n s t
+        merci bonjour bonsoir salut cordialement oui non
+        '''.split())
+}
+
+# Entity types as returned by the remote detector of each language
+PATTERNS_BY_LANGUAGE = {
+    'en': [('EMAIL', EMAIL_PATTERN), ('PHONE', PHONE_PATTERN)],
+    'fr': [('EMAIL_ADDRESS', EMAIL_PATTERN), ('PHONE_NUMBER_FR', PHONE_FR_PATTERN)]
+}
+
+
+class PatternDetector:
+    """
+    Local detector of email addresses and phone numbers, run ahead of InferenceFacade
+    It decides per text whether the patterns found everything there is to find, so the remote call can be skipped
+    """
+
+    def __init__(self, language_code='en', policy=POLICY_OFF):
+        self.language_code = language_code
+        self.policy = policy
+        self.patterns = PATTERNS_BY_LANGUAGE.get(language_code, PATTERNS_BY_LANGUAGE['en'])
+        self.stopwords = STOPWORDS_BY_LANGUAGE.get(language_code, STOPWORDS_BY_LANGUAGE['en'])
+        self.lock = threading.Lock()
+        self.texts_seen = 0
+        self.remote_calls_avoided = 0
+
+    def detect_pii_entities(self, text: str):
+        """
+        Get detail on the PII entities of the given text, if the policy allows to skip the remote call
+        :param text: text to detect PII entities
+        :return: dict of PII entities in the InferenceFacade format, or None if the text needs the remote call
+        """
+        if self.policy == POLICY_OFF:
+            return None
+        transform_list = []
+        covered = []
+        for entity_type, pattern in self.patterns:
+            for match in pattern.finditer(text):
+                if any(match.start() < end and begin < match.end() for begin, end in covered):
+                    continue
+                covered.append((match.start(), match.end()))
+                transform_list.append({'Type': entity_type,
+                                       'BeginOffset': match.start(),
+                                       'EndOffset': match.end(),
+                                       'Original': "",
+                                       'Anonymized': ""
+                                       })
+        masked_text, _ = ScrubTransforms.rewrite_spans(text, [(begin, end, ' ' * (end - begin))
+                                                              for begin, end in sorted(covered)])
+        needs_remote = self.needs_remote_detection(masked_text)
+        with self.lock:
+            self.texts_seen += 1
+            if not needs_remote:
+                self.remote_calls_avoided += 1
+        if needs_remote:
+            return None
+        Metrics.current().increment(Metrics.REMOTE_CALLS_AVOIDED)
+        transform_list.sort(key=lambda x: x['BeginOffset'])
+        return {'Transforms': transform_list}
+
+    def needs_remote_detection(self, masked_text: str) -> bool:
+        """
+        Only a text made of stopwords once the entities found are masked skips the remote detection, whatever the
+        case and the position of its words, so names starting a sentence or written in lower case are detected.
+        The skip still loses recall on entities that are neither patterns nor words, as a digit only identifier
+        under the aggressive policy
+        :param masked_text: the text with the entities found replaced by spaces
+        :return: True if the text may have entities the patterns do not find
+        """
+        for match in NUMBER_PATTERN.finditer(masked_text):
+            if self.policy == POLICY_CONSERVATIVE or \
+                    sum(character.isdigit() for character in match.group()) > AGGRESSIVE_MAX_NUMBER_DIGITS:
+                return True
+        return any(word.lower() not in self.stopwords for word in WORD_PATTERN.findall(masked_text))
+
+    def stats(self) -> dict:
+        """
+        :return: the counters of the detector, and the fraction of remote calls avoided
+        """
+        with self.lock:
+            return {'texts_seen': self.texts_seen,
+                    'remote_calls_avoided': self.remote_calls_avoided,
+                    'avoided_fraction': self.remote_calls_avoided / self.texts_seen if self.texts_seen else 0.0}
@@ -1,5 +1,7 @@
 from typing import Final
 
+import anonymizer.ScrubTransforms as ScrubTransforms
+
 
 class PiiAnonymizer(object):
 
@@ -99,18 +101,7 @@ class PiiAnonymizer(object):
         :return anonymous_text: the anonymous text
         :return transform_as_dict: the updated transform dict - for reverse transform
         """
-        anonymous_text = ""
-        offset = 0
-        for transform in transform_as_dict['Transforms']:
-            anonymous_text += text[offset:transform['BeginOffset']]
-            transform['AnonBeginOffset'] = len(anonymous_text)
-            anonymous_text += transform['Anonymized']
-            transform['AnonEndOffset'] = len(anonymous_text)-1
-            offset = transform['EndOffset']
-
-        anonymous_text += text[offset:len(text)]
-
-        return anonymous_text, transform_as_dict
+        return ScrubTransforms.ScrubTransforms.generate_anonymous_text(text, transform_as_dict)
 
     @staticmethod
     def generate_original_text(text: str, transform_as_dict: dict) -> str:
@@ -120,16 +111,7 @@ class PiiAnonymizer(object):
         :param transform_as_dict: the transforms, maintained in a dictionary
         :return original_text: the original text
         """
-        original_text = ""
-        offset = 0
-        for transform in transform_as_dict['Transforms']:
-            original_text += text[offset:transform['AnonBeginOffset']]
-            original_text += transform['Original']
-            offset = transform['AnonEndOffset'] + 1
-
-        original_text += text[offset:len(text)]
-
-        return original_text
+        return ScrubTransforms.ScrubTransforms.generate_original_text(text, transform_as_dict)
 
 
 ANONYMIZER_FUNCTIONS: Final[dict] = {
@@ -0,0 +1,215 @@
+#######
+# Rate Limiter v1.00
+#######
+
+import collections
+import random
+import threading
+import time
+
+import anonymizer.Metrics as Metrics
+
+# Error codes of the services telling the caller to slow down
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'Throttling', 'ThrottledException', 'TooManyRequestsException',
+                          'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'SlowDown',
+                          'RequestThrottled', 'RequestThrottledException'}
+
+# Retries of a throttled call, sleeping a random time up to an exponentially growing bound
+MAX_RETRIES = 8
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 5.0
+
+# The rate is unbounded until more than THROTTLE_TOLERANCE of the units of the last window are throttled, it is then
+# cut to a fraction of the rate observed over the window, and grows back by RATE_GROWTH_PER_SECOND of itself every
+# second the service accepts the calls. Windows with fewer than MIN_WINDOW_CALLS calls
+# are too small to tell a sustained throttling from a sporadic one, their throttled calls are only retried
+RATE_WINDOW_SECONDS = 1.0
+MIN_WINDOW_CALLS = 4
+THROTTLE_TOLERANCE = 0.2
+RATE_DECREASE_FACTOR = 0.7
+RATE_GROWTH_PER_SECOND = 0.2
+MIN_RATE = 1.0
+# The bucket holds up to this many seconds of requests, the burst allowed after an idle period
+BURST_SECONDS = 0.2
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """
+    :param error: an error raised by a client call
+    :return: True if the service throttled the call
+    """
+    response = getattr(error, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    :param attempt: the number of retries so far
+    :return: the full jitter delay before the next retry, in seconds
+    """
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared by the callers of a service, its rate adapts to the throttling the service signals
+    The rate is in units per second, a unit is a request, or an item of a batch request when the service throttles
+    items like DynamoDB
+    """
+
+    def __init__(self, rate: float = None):
+        """
+        :param rate: the initial rate in units per second, None for unbounded until the service throttles
+        """
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = self.capacity()
+        self.refilled_at = time.monotonic()
+        self.decreased_at = None
+        # (time, units) of the calls, and of the throttled units, over the last window
+        self.recent_calls = collections.deque()
+        self.recent_units = 0.0
+        self.recent_throttles = collections.deque()
+        self.recent_throttled_units = 0.0
+        self.calls = 0
+        self.throttled = 0
+
+    def capacity(self) -> float:
+        return max(1.0, self.rate * BURST_SECONDS) if self.rate is not None else 1.0
+
+    def expire(self, now: float) -> None:
+        while self.recent_calls and self.recent_calls[0][0] < now - RATE_WINDOW_SECONDS:
+            self.recent_units -= self.recent_calls.popleft()[1]
+        while self.recent_throttles and self.recent_throttles[0][0] < now - RATE_WINDOW_SECONDS:
+            self.recent_throttled_units -= self.recent_throttles.popleft()[1]
+
+    def observed_rate(self, now: float) -> float:
+        """
+        :param now: the current time
+        :return: the units per second of the calls of the last window, over the part of the window since the
+        first of them
+        """
+        if not self.recent_calls:
+            return 0.0
+        return self.recent_units / max(now - self.recent_calls[0][0], RATE_WINDOW_SECONDS / MIN_WINDOW_CALLS)
+
+    def acquire(self, units: float = 1.0) -> None:
+        """
+        Wait until the rate allows one more request
+        :param units: the units of the request
+        :return: None
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.rate is not None:
+                    self.tokens = min(self.capacity(), self.tokens + (now - self.refilled_at) * self.rate)
+                    self.refilled_at = now
+                # a request larger than the bucket goes when it is full, and leaves it in debt
+                if self.rate is None or self.tokens >= min(units, self.capacity()):
+                    if self.rate is not None:
+                        self.tokens -= units
+                    self.calls += 1
+                    self.recent_calls.append((now, units))
+                    self.recent_units += units
+                    self.expire(now)
+                    return
+                wait_seconds = (min(units, self.capacity()) - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def on_throttle(self, units: float = 1.0) -> None:
+        """
+        Cut the rate if too many units of the window are throttled, at most once per window as the calls in
+        flight are throttled together
+        :param units: the throttled units, fewer than the units of the call when a batch is partially processed
+        :return: None
+        """
+        Metrics.current().increment(Metrics.THROTTLED_CALLS)
+        with self.lock:
+            now = time.monotonic()
+            self.throttled += 1
+            self.recent_throttles.append((now, units))
+            self.recent_throttled_units += units
+            self.expire(now)
+            if len(self.recent_calls) < MIN_WINDOW_CALLS or \
+                    self.recent_throttled_units <= THROTTLE_TOLERANCE * self.recent_units:
+                return
+            if self.decreased_at is not None and now - self.decreased_at < RATE_WINDOW_SECONDS:
+                return
+            observed_rate = self.observed_rate(now)
+            current_rate = self.rate if self.rate is not None else observed_rate
+            self.rate = max(MIN_RATE, min(current_rate, observed_rate) * RATE_DECREASE_FACTOR)
+            self.tokens = min(self.tokens, self.capacity())
+            self.decreased_at = now
+
+    def on_success(self, units: float = 1.0) -> None:
+        """
+        Grow the rate back while the service accepts the requests
+        :param units: the units of the request
+        :return: None
+        """
+        if self.rate is None:
+            return
+        with self.lock:
+            if self.rate is None:
+                return
+            # about rate units a second, each adding 1 / rate of the growth of a second, so the rate only grows
+            # while the callers use it
+            self.rate += RATE_GROWTH_PER_SECOND * units
+
+    def call(self, function, *args, units: float = 1.0, **kwargs):
+        """
+        Call a client function within the rate, retrying with jittered backoff while it is throttled
+        :param function: the client function
+        :param units: the units of the request
+        :return: the result of the call
+        """
+        attempt = 0
+        while True:
+            self.acquire(units)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if not is_throttling_error(error) or attempt >= MAX_RETRIES:
+                    raise
+                self.on_throttle(units)
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+                continue
+            self.on_success(units)
+            return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'rate': self.rate, 'calls': self.calls, 'throttled': self.throttled}
+
+
+def get_limiter(service_name: str) -> AdaptiveRateLimiter:
+    """
+    :param service_name: the name of the service, e.g. 'comprehend'
+    :return: the limiter shared by the callers of the service in the process
+    """
+    limiter = _limiters.get(service_name)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.setdefault(service_name, AdaptiveRateLimiter())
+    return limiter
+
+
+def stats() -> dict:
+    """
+    :return: the rate, calls and throttled calls of each limiter
+    """
+    return {service_name: limiter.stats() for service_name, limiter in list(_limiters.items())}
+
+
+def reset() -> None:
+    """
+    Forget the limiters, the next callers start unbounded
+    :return: None
+    """
+    with _lock:
+        _limiters.clear()
@@ -0,0 +1,150 @@
+#######
+# Revert Tokens v1.00
+#######
+
+import base64
+import hashlib
+import os
+
+import anonymizer.TransformCodec as TransformCodec
+
+# Keys as comma separated '<version>:<base64 key>' entries, the version used to encrypt is
+# REVERT_TOKEN_KEY_VERSION, or the first entry. Older versions are kept to decrypt tokens issued before a rotation
+KEYS_ENVIRONMENT_VARIABLE = 'REVERT_TOKEN_KEYS'
+KEY_VERSION_ENVIRONMENT_VARIABLE = 'REVERT_TOKEN_KEY_VERSION'
+
+# Token layout: '<format>.<key version>.<base64url of nonce + AES-GCM ciphertext of the TransformCodec encoding>'
+# The associated data authenticates the format, the key version, and the binding of the token to the text fields of
+# its record, see record_binding
+TOKEN_FORMAT_1 = 'rt1'
+TOKEN_SEPARATOR = '.'
+NONCE_BYTES = 12
+KEY_BYTES = 32
+
+
+def load_aesgcm():
+    """
+    Import AES-GCM on first use, cryptography is only needed when revert tokens are enabled
+    :return: the AESGCM class
+    """
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError as error:
+        raise ImportError("Revert tokens need the 'cryptography' package") from error
+    return AESGCM
+
+
+def encode_base64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_base64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def record_binding(field_texts: dict) -> bytes:
+    """
+    The digest of the names and anonymized texts of the text fields of a record, so a token only decrypts for the
+    record and fields it was issued for, not once copied to another record or field, or once the text is edited
+    :param field_texts: dict of the name of each text field of the record to its anonymized text
+    :return: the binding of the record, authenticated with the token
+    """
+    digest = hashlib.sha256()
+    for field_name in sorted(field_texts):
+        for value in (field_name, field_texts[field_name]):
+            encoded = value.encode('utf-8')
+            digest.update(len(encoded).to_bytes(8, 'little'))
+            digest.update(encoded)
+    return digest.digest()
+
+
+class RevertTokenKeyring:
+    """
+    Encrypts scrub transforms into revert tokens carried by the records, so they can be reverted without storage
+    Each token names the version of the key it was encrypted with, so keys can be rotated without breaking the
+    tokens already issued
+    """
+
+    def __init__(self, keys: dict, current_version: str = None):
+        """
+        :param keys: dict of key version to 32 bytes AES key
+        :param current_version: the version of the key encrypting new tokens, the first one by default
+        """
+        if not keys:
+            raise ValueError("No revert token key provided")
+        for version, key in keys.items():
+            if not version or TOKEN_SEPARATOR in version:
+                raise ValueError(f"Invalid revert token key version \'{version}\'")
+            if len(key) != KEY_BYTES:
+                raise ValueError(f"Revert token key \'{version}\' must be {KEY_BYTES} bytes")
+        self.current_version = current_version if current_version is not None else next(iter(keys))
+        if self.current_version not in keys:
+            raise ValueError(f"Unknown revert token key version \'{self.current_version}\'")
+        aesgcm = load_aesgcm()
+        self.ciphers = {version: aesgcm(key) for version, key in keys.items()}
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        """
+        :param environ: the environment holding the keys
+        :return: the keyring, or None if no key is configured
+        """
+        entries = [entry.strip() for entry in environ.get(KEYS_ENVIRONMENT_VARIABLE, '').split(',') if entry.strip()]
+        if not entries:
+            return None
+        keys = {}
+        for entry in entries:
+            version, _, key = entry.partition(':')
+            keys[version] = decode_base64(key)
+        return cls(keys, environ.get(KEY_VERSION_ENVIRONMENT_VARIABLE) or None)
+
+    @staticmethod
+    def generate_key() -> str:
+        """
+        :return: a new random key, base64 encoded as expected in REVERT_TOKEN_KEYS
+        """
+        return encode_base64(os.urandom(KEY_BYTES))
+
+    @staticmethod
+    def associated_data(version: str, binding: bytes) -> bytes:
+        # the format, key version and record binding are authenticated with the ciphertext
+        return f"{TOKEN_FORMAT_1}{TOKEN_SEPARATOR}{version}{TOKEN_SEPARATOR}".encode('utf-8') + binding
+
+    def encrypt(self, scrub_xform: dict, binding: bytes) -> str:
+        """
+        :param scrub_xform: dict with the 'Transforms' list, as returned by ScrubTransforms.generate_anonymous_text
+        :param binding: the record_binding of the record the token is issued for
+        :return: the revert token
+        """
+        nonce = os.urandom(NONCE_BYTES)
+        ciphertext = self.ciphers[self.current_version].encrypt(
+            nonce, TransformCodec.encode(scrub_xform), self.associated_data(self.current_version, binding))
+        return TOKEN_SEPARATOR.join([TOKEN_FORMAT_1, self.current_version, encode_base64(nonce + ciphertext)])
+
+    def decrypt(self, token: str, binding: bytes) -> dict:
+        """
+        :param token: a revert token returned by encrypt
+        :param binding: the record_binding of the record carrying the token
+        :return: dict with the 'Transforms' list
+        """
+        _, version, payload = self.split_token(token)
+        if version not in self.ciphers:
+            raise KeyError(f"Unknown revert token key version \'{version}\'")
+        data = decode_base64(payload)
+        try:
+            encoded = self.ciphers[version].decrypt(data[:NONCE_BYTES], data[NONCE_BYTES:],
+                                                    self.associated_data(version, binding))
+        except Exception as error:
+            raise ValueError("Revert token could not be authenticated") from error
+        return TransformCodec.decode(encoded)
+
+    @staticmethod
+    def split_token(token: str) -> (str, str, str):
+        """
+        :param token: a revert token
+        :return: the format, key version and payload of the token
+        """
+        parts = token.split(TOKEN_SEPARATOR) if isinstance(token, str) else []
+        if len(parts) != 3 or parts[0] != TOKEN_FORMAT_1:
+            raise ValueError("Malformed revert token")
+        return parts[0], parts[1], parts[2]
@@ -2,11 +2,16 @@
 # DESTINATION_S3 Facade v1.00
 #######
 
-import boto3
-import json
+import codecs
+import csv
+import importlib.util
+import itertools
 import datetime
 import uuid
 
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.JsonCodec as JsonCodec
+
 ANONYMIZER_MODE = 'ANONYMIZER'
 REVERT_MODE = 'REVERT'
 
@@ -14,32 +19,453 @@ ANONYMIZER_ROOT_PATH = "data/anonymized/"
 REVERT_ROOT_PATH = "data/reverted/"
 DEFAULT_TABLE_NAME = 'default'
 
-s3_client = boto3.client('s3')
+INPUT_FORMAT_JSON_LINES = 'jsonl'
+INPUT_FORMAT_CSV = 'csv'
+
+OUTPUT_FORMAT_JSON_LINES = 'jsonl'
+OUTPUT_FORMAT_PARQUET = 'parquet'
+OUTPUT_FORMAT_ARROW = 'arrow'
+OUTPUT_FORMATS = [OUTPUT_FORMAT_JSON_LINES, OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW]
+# Columnar formats need pyarrow, their compression codecs, the first one is the default
+COLUMNAR_OUTPUT_FORMATS = [OUTPUT_FORMAT_PARQUET, OUTPUT_FORMAT_ARROW]
+OUTPUT_COMPRESSION_NONE = 'none'
+OUTPUT_COMPRESSIONS = {
+    OUTPUT_FORMAT_PARQUET: ['snappy', 'zstd', 'gzip', 'brotli', 'lz4', OUTPUT_COMPRESSION_NONE],
+    OUTPUT_FORMAT_ARROW: ['zstd', 'lz4', OUTPUT_COMPRESSION_NONE]
+}
+OUTPUT_FILE_EXTENSIONS = {OUTPUT_FORMAT_PARQUET: '.parquet', OUTPUT_FORMAT_ARROW: '.arrow'}
+
+JSON_CONTENT_TYPE = 'application/json'
+JSON_LINES_CONTENT_TYPE = 'application/x-ndjson'
+OUTPUT_CONTENT_TYPES = {
+    OUTPUT_FORMAT_JSON_LINES: JSON_LINES_CONTENT_TYPE,
+    OUTPUT_FORMAT_PARQUET: 'application/vnd.apache.parquet',
+    OUTPUT_FORMAT_ARROW: 'application/vnd.apache.arrow.file'
+}
+# Every part of a multipart upload but the last must be at least 5 MiB, this also bounds the buffered output
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+# Records are converted to columns this many at a time, and written as a row group once the columns reach
+# ROW_GROUP_TARGET_BYTES in memory, so a row group is large enough to scan efficiently whatever the record size
+COLUMNAR_BATCH_RECORDS = 1000
+ROW_GROUP_TARGET_BYTES = 32 * 1024 * 1024
+
+
+def columnar_output_supported() -> bool:
+    """
+    :return: True if pyarrow is installed, without importing it
+    """
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def load_pyarrow():
+    """
+    Import pyarrow on first use, it is only needed for the columnar output formats, from a layer for example
+    :return: the pyarrow module, with its ipc and parquet modules loaded
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Parquet and Arrow output need the 'pyarrow' package") from error
+    return pyarrow
+
+
+class MultipartUploadWriter:
+    """
+    Binary file-like writer to an S3 object, buffering at most one part in memory
+    The multipart upload is started when the first part is full, smaller objects are written with one put_object.
+    The upload is aborted if the writer is used as a context manager and an exception is raised
+    """
+
+    def __init__(self, s3_client, bucket_name: str, s3_key: str, content_type: str,
+                 part_size: int = MULTIPART_PART_SIZE):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.content_type = content_type
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data: bytes) -> int:
+        """
+        Buffer data, and upload a part each time the buffer reaches the part size
+        :param data: the bytes to write
+        :return: the number of bytes written
+        """
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def flush(self) -> None:
+        # parts are uploaded when full, the rest is written on close
+        pass
+
+    def upload_part(self, body: bytes) -> None:
+        """
+        Upload one part, starting the multipart upload if needed
+        :param body: the content of the part
+        :return: None
+        """
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key,
+                                                              ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+                                              PartNumber=part_number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    def close(self) -> None:
+        """
+        Write the buffered data and complete the upload
+        :return: None
+        """
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.s3_key, Body=bytes(self.buffer),
+                                      ContentType=self.content_type)
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key,
+                                                     UploadId=self.upload_id,
+                                                     MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+        self.closed = True
+
+    def abort(self) -> None:
+        """
+        Abort the upload, so no partial object is left behind
+        :return: None
+        """
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        self.closed = True
+
+
+class ColumnarRecordWriter:
+    """
+    Writes records to binary file-like objects as Parquet, or as Arrow IPC files, a row group at a time as the records
+    arrive, so at most one row group is held in memory
+    The schema of a part is fixed when it is opened, declared or taken from its first records, with the fields always
+    null so far as strings. Later records are conformed to it: a missing field is null, an integer in a float field is
+    a float, and a value in a string field that is not a string is written as JSON. Records needing a wider schema, a
+    new field, or a type the schema does not hold, complete the part, and the next part is written with the widened
+    schema: a field of integers and floats is a float, and a field of other conflicting types is a string
+    """
+
+    def __init__(self, open_sink, output_format: str, compression: str = None, nullable_fields: list = None,
+                 row_group_target_bytes: int = ROW_GROUP_TARGET_BYTES, schema=None):
+        """
+        :param open_sink: function of the number of a part, from 1, returning the binary file-like object the part is
+        written to, the writer closes it once the part is complete
+        :param output_format: OUTPUT_FORMAT_PARQUET or OUTPUT_FORMAT_ARROW
+        :param compression: one of the OUTPUT_COMPRESSIONS of the format, the first one by default
+        :param nullable_fields: string fields in the schema even if no record has them
+        :param row_group_target_bytes: the size of the columns in memory at which a row group is written
+        :param schema: the pyarrow schema of the first part, None to take it from the first records
+        """
+        self.pyarrow = load_pyarrow()
+        self.open_sink = open_sink
+        self.output_format = output_format
+        self.compression = compression if compression is not None else OUTPUT_COMPRESSIONS[output_format][0]
+        self.nullable_fields = nullable_fields or []
+        self.row_group_target_bytes = row_group_target_bytes
+        # the type of each field of the current part, in the order of its schema
+        self.field_types = {} if schema is None else {field.name: field.type for field in schema}
+        self.schema = None
+        self.sink = None
+        self.writer = None
+        self.pending_batches = []
+        self.pending_bytes = 0
+        self.parts = 0
+        self.row_groups = 0
+
+    def records_to_batch(self, records: list):
+        """
+        :param records: the records to convert
+        :return: the record batch of the records, with the fields of all the records
+        """
+        names = list(dict.fromkeys(name for record in records for name in record))
+        return self.pyarrow.RecordBatch.from_arrays(
+            [self.values_to_array([record.get(name) for record in records]) for name in names], names=names)
+
+    def values_to_array(self, values: list):
+        """
+        :param values: the values of a field
+        :return: the array of the values, of strings if the values have conflicting types
+        """
+        try:
+            return self.pyarrow.array(values)
+        except (self.pyarrow.ArrowInvalid, self.pyarrow.ArrowTypeError, OverflowError):
+            return self.pyarrow.array([value if value is None or isinstance(value, str) else
+                                       JsonCodec.dumps_text(value) for value in values], self.pyarrow.string())
+
+    def widen_type(self, current_type, new_type):
+        """
+        :param current_type: the type of a field so far, None for a new field
+        :param new_type: the type of the field in a new batch
+        :return: the type holding the values of both types
+        """
+        types = self.pyarrow.types
+        if current_type is None or types.is_null(current_type) or current_type == new_type:
+            return new_type
+        if types.is_null(new_type):
+            return current_type
+        if (types.is_integer(current_type) or types.is_floating(current_type)) and \
+                (types.is_integer(new_type) or types.is_floating(new_type)):
+            return self.pyarrow.float64()
+        return self.pyarrow.string()
+
+    def widen_field_types(self, batch) -> dict:
+        """
+        :param batch: a new record batch
+        :return: the types of the fields of the current part, widened to hold the batch
+        """
+        field_types = dict(self.field_types)
+        for field in batch.schema:
+            if field.name not in field_types and self.pyarrow.types.is_null(field.type) and self.writer is not None:
+                # a new field without values is null in the current part, like a missing field
+                continue
+            field_types[field.name] = self.widen_type(field_types.get(field.name), field.type)
+        return field_types
+
+    def conform_column(self, column, field_type):
+        """
+        :param column: a column of a batch
+        :param field_type: the type of the field in the schema of the output
+        :return: the column converted to the type
+        """
+        if column.type == field_type:
+            return column
+        if self.pyarrow.types.is_string(field_type) and not self.pyarrow.types.is_null(column.type):
+            return self.pyarrow.array([value if value is None or isinstance(value, str) else
+                                       JsonCodec.dumps_text(value) for value in column.to_pylist()],
+                                      self.pyarrow.string())
+        return column.cast(field_type)
+
+    def conform_batch(self, batch):
+        """
+        :param batch: a record batch with some of the fields of the output
+        :return: the batch with the schema of the output, the missing fields are null
+        """
+        columns = []
+        for field in self.schema:
+            index = batch.schema.get_field_index(field.name)
+            columns.append(self.pyarrow.nulls(batch.num_rows, field.type) if index < 0
+                           else self.conform_column(batch.column(index), field.type))
+        return self.pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+
+    def write_records(self, records: list) -> None:
+        """
+        Convert records to columns, and write a row group once the columns reach the target size
+        :param records: the records to write
+        :return: None
+        """
+        batch = self.records_to_batch(records)
+        field_types = self.widen_field_types(batch)
+        if self.writer is not None and field_types != self.field_types:
+            self.close_part()
+        self.field_types = field_types
+        if self.writer is None:
+            self.open_part()
+        batch = self.conform_batch(batch)
+        self.pending_batches.append(batch)
+        self.pending_bytes += batch.nbytes
+        if self.pending_bytes >= self.row_group_target_bytes:
+            self.write_row_group()
+
+    def write_row_group(self) -> None:
+        """
+        Write the pending batches as one row group
+        :return: None
+        """
+        table = self.pyarrow.Table.from_batches(self.pending_batches, schema=self.schema).combine_chunks()
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            self.writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            self.writer.write_table(table)
+        self.row_groups += 1
+        self.pending_batches = []
+        self.pending_bytes = 0
+
+    def open_part(self) -> None:
+        """
+        Fix the schema of the next part, fields always null so far are strings, and open its writer
+        :return: None
+        """
+        for name in self.nullable_fields:
+            self.field_types.setdefault(name, self.pyarrow.string())
+        self.field_types = {name: self.pyarrow.string() if self.pyarrow.types.is_null(field_type) else field_type
+                            for name, field_type in self.field_types.items()}
+        self.schema = self.pyarrow.schema([self.pyarrow.field(name, field_type)
+                                           for name, field_type in self.field_types.items()])
+        self.parts += 1
+        self.sink = self.open_sink(self.parts)
+        output = self.pyarrow.PythonFile(self.sink, mode='w')
+        if self.output_format == OUTPUT_FORMAT_PARQUET:
+            self.writer = self.pyarrow.parquet.ParquetWriter(output, self.schema, compression=self.compression)
+        else:
+            options = self.pyarrow.ipc.IpcWriteOptions(
+                compression=None if self.compression == OUTPUT_COMPRESSION_NONE else self.compression)
+            self.writer = self.pyarrow.ipc.new_file(output, self.schema, options=options)
+
+    def close_part(self) -> None:
+        """
+        Write the pending batches and the footer of the current part, and close its sink
+        :return: None
+        """
+        if self.pending_batches:
+            self.write_row_group()
+        self.writer.close()
+        self.sink.close()
+        self.writer = None
+        self.sink = None
+
+    def close(self) -> None:
+        """
+        Complete the last part, an output without records is one part with the nullable fields
+        :return: None
+        """
+        if self.writer is None:
+            self.open_part()
+        self.close_part()
 
 
 class S3Facade:
 
-    def __init__(self, bucket_name, anon_path_root=ANONYMIZER_ROOT_PATH, revert_path_root=REVERT_ROOT_PATH):
+    def __init__(self, bucket_name, anon_path_root=ANONYMIZER_ROOT_PATH, revert_path_root=REVERT_ROOT_PATH,
+                 s3_client=None, part_size=MULTIPART_PART_SIZE):
         self.anon_path_root = anon_path_root
         self.revert_path_root = revert_path_root
         self.bucket_name = bucket_name
+        # the client can be replaced, for example by a local S3 stand-in
+        self._s3_client = s3_client
+        self.part_size = part_size
+
+    @property
+    def s3_client(self):
+        """
+        The given s3 client, or the shared s3 client created on first use
+        """
+        if self._s3_client is not None:
+            return self._s3_client
+        return ClientRegistry.get_client('s3')
 
     def write_json_to_s3(self, json_doc: str, s3_key: str) -> None:
         """
         Write a json document to Amazon DESTINATION_S3
-        :param json_doc: json content to write to DESTINATION_S3
+        :param json_doc: json content to write to DESTINATION_S3, as a string or UTF-8 bytes
         :param s3_key: the key to write to on DESTINATION_S3
         :return None
-        """
-        s3_client.put_object(Body="hello world", Bucket=self.bucket_name, Key="aa")
-
         """
         self.s3_client.put_object(
             Bucket=self.bucket_name,
             Key=s3_key,
-            Body=json_doc
+            Body=json_doc,
+            ContentType=JSON_CONTENT_TYPE
         )
+
+    def write_records_as_json_lines_to_s3(self, records, s3_key: str) -> int:
+        """
+        Write records to DESTINATION_S3 in a JSON Lines format, one record per line
+        Records are serialized as they are produced and uploaded in parts, so memory stays bounded by the part size
+        :param records: iterable of the records to write
+        :param s3_key: the key to write to on DESTINATION_S3
+        :return: the number of records written
+        """
+        return self.write_json_lines_to_s3((JsonCodec.dumps(record) for record in records), s3_key)
+
+    def write_json_lines_to_s3(self, lines, s3_key: str) -> int:
+        """
+        Write records already serialized as JSON to DESTINATION_S3 in a JSON Lines format
+        :param lines: iterable of the UTF-8 JSON documents of the records, without line ends
+        :param s3_key: the key to write to on DESTINATION_S3
+        :return: the number of records written
+        """
+        record_count = 0
+        with MultipartUploadWriter(self.s3_client, self.bucket_name, s3_key, JSON_LINES_CONTENT_TYPE,
+                                   self.part_size) as writer:
+            for line in lines:
+                writer.write(line + b'\n')
+                record_count += 1
+        return record_count
+
+    def write_records_as_columnar_to_s3(self, records, s3_key: str, output_format: str, compression: str = None,
+                                        nullable_fields: list = None) -> list:
         """
+        Write records to DESTINATION_S3 as Parquet or as Arrow IPC files
+        Records are converted to columns as they are produced, and uploaded in parts a row group at a time. Records
+        needing a wider schema than the first ones start a new file, see ColumnarRecordWriter
+        :param records: iterable of the records to write
+        :param s3_key: the key of the first file, without the extension of the format
+        :param output_format: OUTPUT_FORMAT_PARQUET or OUTPUT_FORMAT_ARROW
+        :param compression: one of the OUTPUT_COMPRESSIONS of the format, the first one by default
+        :param nullable_fields: string fields in the schema even if no record has them
+        :return: the keys of the files written
+        """
+        uploads = []
+
+        def open_upload(part: int) -> MultipartUploadWriter:
+            # the first file has the key of the output, the files of the widened schemas are numbered after it
+            part_key = s3_key if part == 1 else f"{s3_key}-{part:04d}"
+            uploads.append(MultipartUploadWriter(self.s3_client, self.bucket_name,
+                                                 part_key + OUTPUT_FILE_EXTENSIONS[output_format],
+                                                 OUTPUT_CONTENT_TYPES[output_format], self.part_size))
+            return uploads[-1]
+
+        try:
+            columnar_writer = ColumnarRecordWriter(open_upload, output_format, compression, nullable_fields)
+            iterator = iter(records)
+            batch = list(itertools.islice(iterator, COLUMNAR_BATCH_RECORDS))
+            while batch:
+                columnar_writer.write_records(batch)
+                batch = list(itertools.islice(iterator, COLUMNAR_BATCH_RECORDS))
+            columnar_writer.close()
+        except Exception:
+            # no partial file is left behind, the completed files of the output are kept
+            for upload in uploads:
+                if not upload.closed:
+                    upload.abort()
+            raise
+        return [upload.s3_key for upload in uploads]
+
+    def write_records_to_s3(self, records, s3_key: str, output_format: str = OUTPUT_FORMAT_JSON_LINES,
+                            compression: str = None, nullable_fields: list = None) -> list:
+        """
+        Write records to DESTINATION_S3 in the output format
+        :param records: iterable of the records to write
+        :param s3_key: the key to write to on DESTINATION_S3, the extension of a columnar format is appended
+        :param output_format: one of OUTPUT_FORMATS
+        :param compression: the compression of a columnar format, the first of its OUTPUT_COMPRESSIONS by default
+        :param nullable_fields: string fields always in the schema of a columnar format
+        :return: the keys written, more than one if the schema of a columnar format had to be widened
+        """
+        if output_format in COLUMNAR_OUTPUT_FORMATS:
+            return self.write_records_as_columnar_to_s3(records=records, s3_key=s3_key, output_format=output_format,
+                                                        compression=compression, nullable_fields=nullable_fields)
+        self.write_records_as_json_lines_to_s3(records=records, s3_key=s3_key)
+        return [s3_key]
 
     def write_dict_as_json_to_s3(self, output_dict: dict, s3_key: str) -> None:
         """
@@ -49,7 +475,7 @@ class S3Facade:
         :return: None
         """
         # json_doc = json.dumps(output_dict, indent=2, default=str)
-        json_doc = json.dumps(output_dict)
+        json_doc = JsonCodec.dumps(output_dict)
         self.write_json_to_s3(json_doc=json_doc, s3_key=s3_key)
 
     def read_json_from_s3(self, s3_key: str) -> dict:
@@ -59,10 +485,25 @@ class S3Facade:
         :return: JSON document as a string
         """
         s3_object = self.s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
-        file_content = s3_object["Body"].read().decode('utf-8')
-        json_content = json.loads(file_content)
+        json_content = JsonCodec.loads(s3_object["Body"].read())
         return json_content
 
+    def read_records_from_s3(self, s3_key: str, input_format: str = INPUT_FORMAT_JSON_LINES):
+        """
+        Read records from a DESTINATION_S3 object in JSON Lines or CSV format, streaming the object line by line
+        :param s3_key: the key of the object to read
+        :param input_format: INPUT_FORMAT_JSON_LINES or INPUT_FORMAT_CSV, the csv header gives the field names
+        :return: generator of the records as dicts
+        """
+        s3_object = self.s3_client.get_object(Bucket=self.bucket_name, Key=s3_key)
+        lines = s3_object["Body"].iter_lines(keepends=True)
+        if input_format == INPUT_FORMAT_CSV:
+            yield from csv.DictReader(codecs.iterdecode(lines, 'utf-8'))
+        else:
+            for line in lines:
+                if line.strip():
+                    yield JsonCodec.loads(line)
+
     def generate_s3_key_for_table(self, table_name: str, mode=None) -> str:
         """
         Create a DESTINATION_S3 key for a table
@@ -84,23 +525,36 @@ class S3Facade:
         key += str(uuid.uuid4())[-8:]
         return key
 
-    def write_anonymized_records(self, records, table_name: str = DEFAULT_TABLE_NAME) -> str:
+    def write_anonymized_records(self, records, table_name: str = DEFAULT_TABLE_NAME,
+                                 output_format: str = OUTPUT_FORMAT_JSON_LINES, compression: str = None,
+                                 nullable_fields: list = None) -> str:
         """
-        Write anonymized records to DESTINATION_S3
-        :param records: the records to write to DESTINATION_S3
+        Write anonymized records to DESTINATION_S3, as JSON Lines by default
+        :param records: iterable of the records to write to DESTINATION_S3
         :param table_name: the name of the table being processed
-        :return: None
+        :param output_format: one of OUTPUT_FORMATS
+        :param compression: the compression of a columnar format, the first of its OUTPUT_COMPRESSIONS by default
+        :param nullable_fields: string fields always in the schema of a columnar format
+        :return: the location of the object written, the locations of the files of a columnar format separated by
+        commas
         """
         s3_key = self.generate_s3_key_for_table(table_name=table_name, mode=ANONYMIZER_MODE)
-        self.write_dict_as_json_to_s3(output_dict=records, s3_key=s3_key)
-        return f"{self.bucket_name}/{s3_key}"
+        s3_keys = self.write_records_to_s3(records, s3_key, output_format, compression, nullable_fields)
+        return ", ".join(f"{self.bucket_name}/{key}" for key in s3_keys)
 
-    def write_reverted_records(self, records, table_name: str = DEFAULT_TABLE_NAME) -> None:
+    def write_reverted_records(self, records, table_name: str = DEFAULT_TABLE_NAME,
+                               output_format: str = OUTPUT_FORMAT_JSON_LINES, compression: str = None,
+                               nullable_fields: list = None) -> str:
         """
-        Write reverted records to DESTINATION_S3
-        :param records: the records to write to DESTINATION_S3
+        Write reverted records to DESTINATION_S3, as JSON Lines by default
+        :param records: iterable of the records to write to DESTINATION_S3
         :param table_name: the name of the table being processed
-        :return: None
+        :param output_format: one of OUTPUT_FORMATS
+        :param compression: the compression of a columnar format, the first of its OUTPUT_COMPRESSIONS by default
+        :param nullable_fields: string fields always in the schema of a columnar format
+        :return: the location of the object written, the locations of the files of a columnar format separated by
+        commas
         """
         s3_key = self.generate_s3_key_for_table(table_name=table_name, mode=REVERT_MODE)
-        self.write_dict_as_json_to_s3(output_dict=records, s3_key=s3_key)
+        s3_keys = self.write_records_to_s3(records, s3_key, output_format, compression, nullable_fields)
+        return ", ".join(f"{self.bucket_name}/{key}" for key in s3_keys)
@@ -135,23 +135,46 @@ class ScrubTransforms(object):
     def generate_anonymous_text(text: str, transform_as_dict: dict) -> (str, dict):
         """
         Generate anonymous text
+        Overlapping or nested transforms are resolved first, only the kept transforms remain in the dict
         :param text: the original text
         :param transform_as_dict: the transforms, maintained in a dictionary
         :return anonymous_text: the anonymous text
         :return transform_as_dict: the updated transform dict - for reverse transform
         """
-        anonymous_text = ""
+        pieces = []
         offset = 0
+        anon_offset = 0
         for transform in transform_as_dict['Transforms']:
-            anonymous_text += text[offset:transform['BeginOffset']]
-            transform['AnonBeginOffset'] = len(anonymous_text)
-            anonymous_text += transform['Anonymized']
-            transform['AnonEndOffset'] = len(anonymous_text)-1
+            begin_offset = transform['BeginOffset']
+            if begin_offset < offset:
+                # overlapping or unordered transforms, resolve them and start over
+                transform_as_dict['Transforms'] = resolve_overlapping_transforms(transform_as_dict['Transforms'])
+                return ScrubTransforms.generate_anonymous_text(text, transform_as_dict)
+            pieces.append(text[offset:begin_offset])
+            anon_offset += begin_offset - offset
+            anonymized = transform['Anonymized']
+            pieces.append(anonymized)
+            transform['AnonBeginOffset'] = anon_offset
+            anon_offset += len(anonymized)
+            transform['AnonEndOffset'] = anon_offset - 1
             offset = transform['EndOffset']
+        pieces.append(text[offset:])
 
-        anonymous_text += text[offset:len(text)]
+        return ''.join(pieces), transform_as_dict
 
-        return anonymous_text, transform_as_dict
+    @staticmethod
+    def generate_irreversible_text(text: str, transform_as_dict: dict) -> str:
+        """
+        Generate anonymous text without the offsets needed to revert it
+        :param text: the original text
+        :param transform_as_dict: the transforms, maintained in a dictionary
+        :return anonymous_text: the anonymous text
+        """
+        anonymous_text, _ = rewrite_spans(
+            text, [(transform['BeginOffset'], transform['EndOffset'], transform['Anonymized'])
+                   for transform in resolve_overlapping_transforms(transform_as_dict['Transforms'])])
+
+        return anonymous_text
 
     @staticmethod
     def generate_original_text(text: str, transform_as_dict: dict) -> str:
@@ -161,18 +184,62 @@ class ScrubTransforms(object):
         :param transform_as_dict: the transforms, maintained in a dictionary
         :return original_text: the original text
         """
-        original_text = ""
+        spans = []
         offset = 0
         for transform in transform_as_dict['Transforms']:
-            original_text += text[offset:transform['AnonBeginOffset']]
-            original_text += transform['Original']
-            offset = transform['AnonEndOffset'] + 1
-
-        original_text += text[offset:len(text)]
+            # skip a transform overlapping the previous one, it can not be applied
+            if transform['AnonBeginOffset'] >= offset:
+                offset = transform['AnonEndOffset'] + 1
+                spans.append((transform['AnonBeginOffset'], offset, transform['Original']))
+        original_text, _ = rewrite_spans(text, spans)
 
         return original_text
 
 
+def resolve_overlapping_transforms(transforms: list) -> list:
+    """
+    Resolve overlapping or nested transforms deterministically
+    Transforms are ordered by begin offset, the longest first on the same begin offset, then by type.
+    A transform that begins before the end of the previous kept transform is dropped
+    :param transforms: the transforms, with BeginOffset and EndOffset
+    :return: the kept transforms, ordered by begin offset
+    """
+    ordered = all(previous['EndOffset'] <= transform['BeginOffset']
+                  for previous, transform in zip(transforms, transforms[1:]))
+    if ordered:
+        return list(transforms)
+    resolved = []
+    end_offset = 0
+    for transform in sorted(transforms, key=lambda x: (x['BeginOffset'], x['BeginOffset'] - x['EndOffset'],
+                                                       x['Type'])):
+        if transform['BeginOffset'] >= end_offset:
+            resolved.append(transform)
+            end_offset = transform['EndOffset']
+    return resolved
+
+
+def rewrite_spans(text: str, spans: list) -> (str, list):
+    """
+    Replace spans of the text in a single pass, joining slices of the text and the replacements once
+    :param text: the text to rewrite
+    :param spans: (begin offset, end offset, replacement) of each span, ordered and not overlapping
+    :return: the rewritten text, and the (begin offset, end offset) of each replacement in the rewritten text
+    """
+    pieces = []
+    new_offsets = []
+    offset = 0
+    new_offset = 0
+    for begin_offset, end_offset, replacement in spans:
+        pieces.append(text[offset:begin_offset])
+        new_offset += begin_offset - offset
+        pieces.append(replacement)
+        new_offsets.append((new_offset, new_offset + len(replacement)))
+        new_offset += len(replacement)
+        offset = end_offset
+    pieces.append(text[offset:])
+    return ''.join(pieces), new_offsets
+
+
 EMAIL_KEY = 'EMAIL'
 EMAIL_ADDRESS_KEY = 'EMAIL_ADDRESS'
 PERSON_KEY = 'PERSON'
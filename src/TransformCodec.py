@@ -0,0 +1,155 @@
+#######
+# Transform Codec v1.00
+#######
+
+import array
+import struct
+import sys
+import zlib
+
+# Version 1 layout, little endian:
+#   header: version (B), transform count (I)
+#   type codes: one byte per transform, CUSTOM_TYPE_CODE for a type missing from ENTITY_TYPES
+#   offsets: BeginOffset, EndOffset, AnonBeginOffset, AnonEndOffset of each transform (i)
+#   zlib compressed strings: byte lengths (I) of every Original, Anonymized and custom type,
+#   followed by the UTF-8 strings themselves
+# Version 2 holds the transforms of several fields of a record, concatenated in the order of the fields:
+#   the header is followed by the field count (H) and the transform count of each field (I), and the UTF-8 field
+#   names are compressed after the custom types
+VERSION_1 = 1
+VERSION_2 = 2
+HEADER = struct.Struct('<BI')
+FIELD_COUNT = struct.Struct('<H')
+# Key of the transforms by field name in a multi-field scrub transform
+FIELDS_KEY = 'Fields'
+OFFSET_KEYS = ['BeginOffset', 'EndOffset', 'AnonBeginOffset', 'AnonEndOffset']
+CUSTOM_TYPE_CODE = 255
+COMPRESSION_LEVEL = 6
+
+# Codes are stored, append new types at the end and never reorder
+ENTITY_TYPES = [
+    'EMAIL', 'EMAIL_ADDRESS', 'PERSON', 'NAME', 'PHONE', 'LOCATION', 'ORGANIZATION', 'PHONE_NUMBER_FR',
+    'PERSON_FR', 'ADDRESS', 'AGE', 'USERNAME', 'PASSWORD', 'URL', 'IP_ADDRESS', 'MAC_ADDRESS', 'DATE_TIME',
+    'SSN', 'PASSPORT_NUMBER', 'DRIVER_ID', 'BANK_ACCOUNT_NUMBER', 'BANK_ROUTING', 'CREDIT_DEBIT_NUMBER',
+    'CREDIT_DEBIT_CVV', 'CREDIT_DEBIT_EXPIRY', 'PIN', 'AWS_ACCESS_KEY', 'AWS_SECRET_KEY', 'LICENSE_PLATE',
+    'VEHICLE_IDENTIFICATION_NUMBER', 'INTERNATIONAL_BANK_ACCOUNT_NUMBER', 'SWIFT_CODE', 'PHONE_NUMBER'
+]
+TYPE_CODES = {entity_type: code for code, entity_type in enumerate(ENTITY_TYPES)}
+
+
+def to_little_endian(values: array.array) -> bytes:
+    """
+    :param values: the packed integers
+    :return: their bytes in little endian order
+    """
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def from_little_endian(typecode: str, data: bytes) -> array.array:
+    """
+    :param typecode: the array typecode of the integers
+    :param data: their bytes in little endian order
+    :return: the packed integers
+    """
+    values = array.array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def encoding_version(scrub_xform: dict) -> int:
+    """
+    :param scrub_xform: a scrub transform, of one text or of several fields
+    :return: the version of the format encode writes it in
+    """
+    return VERSION_2 if FIELDS_KEY in scrub_xform else VERSION_1
+
+
+def encode(scrub_xform: dict) -> bytes:
+    """
+    Encode the transforms of a scrub transform in the compact binary format
+    :param scrub_xform: dict with the 'Transforms' list, as returned by ScrubTransforms.generate_anonymous_text,
+    or with the 'Fields' dict of field name to such a dict
+    :return: the encoded transforms
+    """
+    version = encoding_version(scrub_xform)
+    if version == VERSION_2:
+        fields = scrub_xform[FIELDS_KEY]
+        transforms = [transform for field in fields.values() for transform in field['Transforms']]
+        field_counts = array.array('I', [len(field['Transforms']) for field in fields.values()])
+        field_section = FIELD_COUNT.pack(len(fields)) + to_little_endian(field_counts)
+        field_names = [field_name.encode('utf-8') for field_name in fields]
+    else:
+        transforms = scrub_xform['Transforms']
+        field_section = b''
+        field_names = []
+    type_codes = bytearray()
+    offsets = array.array('i')
+    originals, anonymized, custom_types = [], [], []
+    for transform in transforms:
+        code = TYPE_CODES.get(transform['Type'], CUSTOM_TYPE_CODE)
+        if code == CUSTOM_TYPE_CODE:
+            custom_types.append(transform['Type'].encode('utf-8'))
+        type_codes.append(code)
+        offsets.extend(transform[key] for key in OFFSET_KEYS)
+        originals.append(transform['Original'].encode('utf-8'))
+        anonymized.append(transform['Anonymized'].encode('utf-8'))
+    strings = originals + anonymized + custom_types + field_names
+    lengths = array.array('I', [len(string) for string in strings])
+    compressed = zlib.compress(to_little_endian(lengths) + b''.join(strings), COMPRESSION_LEVEL)
+    return HEADER.pack(version, len(transforms)) + field_section + bytes(type_codes) + to_little_endian(offsets) + \
+        compressed
+
+
+def decode(data: bytes) -> dict:
+    """
+    Decode transforms encoded by encode, in a single pass over the transforms
+    :param data: the encoded transforms
+    :return: dict with the 'Transforms' list, or with the 'Fields' dict of field name to such a dict
+    """
+    version, count = HEADER.unpack_from(data)
+    if version not in [VERSION_1, VERSION_2]:
+        raise ValueError(f"Unsupported transform encoding version {version}")
+    position = HEADER.size
+    field_counts = []
+    if version == VERSION_2:
+        field_count, = FIELD_COUNT.unpack_from(data, position)
+        position += FIELD_COUNT.size
+        field_counts = from_little_endian('I', data[position:position + 4 * field_count])
+        position += 4 * field_count
+    type_codes = data[position:position + count]
+    position += count
+    offsets = from_little_endian('i', data[position:position + 16 * count])
+    position += 16 * count
+    strings_section = zlib.decompress(data[position:])
+    custom_count = type_codes.count(CUSTOM_TYPE_CODE)
+    string_count = 2 * count + custom_count + len(field_counts)
+    lengths = from_little_endian('I', strings_section[:4 * string_count])
+    strings = []
+    position = 4 * string_count
+    for length in lengths:
+        strings.append(strings_section[position:position + length].decode('utf-8'))
+        position += length
+    custom_types = iter(strings[2 * count:2 * count + custom_count])
+    transforms = []
+    for index, code in enumerate(type_codes):
+        base = 4 * index
+        transforms.append({'Type': next(custom_types) if code == CUSTOM_TYPE_CODE else ENTITY_TYPES[code],
+                           'BeginOffset': offsets[base],
+                           'EndOffset': offsets[base + 1],
+                           'Original': strings[index],
+                           'Anonymized': strings[count + index],
+                           'AnonBeginOffset': offsets[base + 2],
+                           'AnonEndOffset': offsets[base + 3]})
+    if version == VERSION_1:
+        return {'Transforms': transforms}
+    fields = {}
+    start = 0
+    for field_name, field_count in zip(strings[2 * count + custom_count:], field_counts):
+        fields[field_name] = {'Transforms': transforms[start:start + field_count]}
+        start += field_count
+    return {FIELDS_KEY: fields}
@@ -0,0 +1,183 @@
+#######
+# Transform Store v1.00
+#######
+
+import abc
+import os
+import sqlite3
+import threading
+import uuid
+
+import anonymizer.DynamoDBFacade as DynamoDBFacade
+import anonymizer.TransformCodec as TransformCodec
+
+# Backend of the store, selected with the TRANSFORM_STORE environment variable
+STORE_ENVIRONMENT_VARIABLE = 'TRANSFORM_STORE'
+STORE_PATH_ENVIRONMENT_VARIABLE = 'TRANSFORM_STORE_PATH'
+STORE_DYNAMODB = 'dynamodb'
+STORE_MEMORY = 'memory'
+STORE_SQLITE = 'sqlite'
+STORES = [STORE_DYNAMODB, STORE_MEMORY, STORE_SQLITE]
+DEFAULT_SQLITE_PATH = 'scrub_transforms.db'
+
+# The local stores take the transforms of a whole pipeline chunk in one batch, a transaction for SQLite
+LOCAL_BATCH_ITEMS = 500
+# Keys per SELECT, below the SQLite limit on the number of parameters of a statement
+SQLITE_MAX_PARAMETERS = 500
+
+
+class TransformStore(abc.ABC):
+    """
+    Persists the scrub transforms of the anonymized records under a guid, the revert_key of the records
+    A backend implements put_many and get_many, the pipeline calls them with batches of at most write_batch_size
+    transforms and read_batch_size guids
+    """
+
+    write_batch_size = LOCAL_BATCH_ITEMS
+    read_batch_size = LOCAL_BATCH_ITEMS
+
+    @staticmethod
+    def create_guid() -> str:
+        return str(uuid.uuid4())
+
+    @abc.abstractmethod
+    def put_many(self, scrub_xforms: list) -> list:
+        """
+        :param scrub_xforms: the scrub transforms to persist, each one gets its 'guid'
+        :return: the guids of the scrub transforms, in the same order as scrub_xforms
+        """
+
+    @abc.abstractmethod
+    def get_many(self, guids: list) -> list:
+        """
+        :param guids: the guids of the scrub transforms
+        :return: the scrub transforms in the same order as guids, None for a guid that is not in the store
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class DynamoDBTransformStore(TransformStore):
+    """
+    Transforms in the scrub transforms ddb table, written and read with batch requests
+    """
+
+    write_batch_size = DynamoDBFacade.BATCH_WRITE_MAX_ITEMS
+    read_batch_size = DynamoDBFacade.BATCH_GET_MAX_KEYS
+
+    def __init__(self, dynamo):
+        """
+        :param dynamo: the DynamoDBFacade of the table
+        """
+        self.dynamo = dynamo
+
+    def put_many(self, scrub_xforms: list) -> list:
+        return self.dynamo.put_scrub_xforms(scrub_xforms)
+
+    def get_many(self, guids: list) -> list:
+        return self.dynamo.get_scrub_xforms(guids)
+
+
+class InMemoryTransformStore(TransformStore):
+    """
+    Transforms in a dict of the process, in the TransformCodec encoding, for tests, benchmarks and short jobs
+    reverted by the same process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.encoded_transforms = {}
+
+    def put_many(self, scrub_xforms: list) -> list:
+        guids = []
+        encoded_transforms = {}
+        for scrub_xform in scrub_xforms:
+            guid = self.create_guid()
+            scrub_xform['guid'] = guid
+            guids.append(guid)
+            encoded_transforms[guid] = TransformCodec.encode(scrub_xform)
+        with self.lock:
+            self.encoded_transforms.update(encoded_transforms)
+        return guids
+
+    def get_many(self, guids: list) -> list:
+        with self.lock:
+            found = [self.encoded_transforms.get(guid) for guid in guids]
+        return [TransformCodec.decode(encoded) if encoded is not None else None for encoded in found]
+
+
+class SQLiteTransformStore(TransformStore):
+    """
+    Transforms in an embedded SQLite database file, keyed by guid, for batch runs outside AWS
+    Each batch is written in one transaction, the WAL journal makes commits sequential appends to the log
+    """
+
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, table_name: str = DynamoDBFacade.SCRUB_TRANSFORMS_TABLE):
+        """
+        :param path: the path of the database file, created if missing, or ':memory:'
+        :param table_name: the name of the table, created if missing
+        """
+        self.path = path
+        self.table_name = table_name
+        # the connection is shared by the threads of the pipeline, the lock serializes its statements
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # a commit survives a crash of the process, the last ones may be lost on a power failure
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # the guid is the primary key of a table without rowid, the table is the index on guid
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table_name} ('
+                                f'guid TEXT PRIMARY KEY, encoding_version INTEGER NOT NULL, '
+                                f'encoded_transforms BLOB NOT NULL) WITHOUT ROWID')
+
+    def put_many(self, scrub_xforms: list) -> list:
+        guids = []
+        rows = []
+        for scrub_xform in scrub_xforms:
+            guid = self.create_guid()
+            scrub_xform['guid'] = guid
+            guids.append(guid)
+            rows.append((guid, TransformCodec.encoding_version(scrub_xform), TransformCodec.encode(scrub_xform)))
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(f'INSERT INTO {self.table_name} '
+                                            f'(guid, encoding_version, encoded_transforms) VALUES (?, ?, ?)', rows)
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return guids
+
+    def get_many(self, guids: list) -> list:
+        unique_guids = list(dict.fromkeys(guids))
+        encoded_transforms = {}
+        with self.lock:
+            for start in range(0, len(unique_guids), SQLITE_MAX_PARAMETERS):
+                keys = unique_guids[start:start + SQLITE_MAX_PARAMETERS]
+                encoded_transforms.update(self.connection.execute(
+                    f'SELECT guid, encoded_transforms FROM {self.table_name} '
+                    f'WHERE guid IN ({", ".join("?" * len(keys))})', keys))
+        return [TransformCodec.decode(encoded_transforms[guid]) if guid in encoded_transforms else None
+                for guid in guids]
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def from_environment(dynamo, environ=os.environ) -> TransformStore:
+    """
+    :param dynamo: the DynamoDBFacade of the dynamodb store
+    :param environ: the environment selecting the store
+    :return: the store named by TRANSFORM_STORE, the dynamodb store by default
+    """
+    store = environ.get(STORE_ENVIRONMENT_VARIABLE, STORE_DYNAMODB).lower()
+    if store == STORE_MEMORY:
+        return InMemoryTransformStore()
+    if store == STORE_SQLITE:
+        return SQLiteTransformStore(environ.get(STORE_PATH_ENVIRONMENT_VARIABLE, DEFAULT_SQLITE_PATH))
+    if store != STORE_DYNAMODB:
+        raise ValueError(f"Unknown transform store \'{store}\', expected one of {STORES}")
+    return DynamoDBTransformStore(dynamo)
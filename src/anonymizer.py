@@ -1,12 +1,41 @@
-import json
+import contextlib
+import functools
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import anonymizer.ScrubTransforms as ScrubTransforms
 import anonymizer.InferenceFacade as ComprehendFacade
+import anonymizer.JsonCodec as JsonCodec
 import anonymizer.DynamoDBFacade as DynamoDBFacade
 import anonymizer.S3Facade as S3Facade
+import anonymizer.DetectionCache as DetectionCache
+import anonymizer.GazetteerDetector as GazetteerDetector
+import anonymizer.PatternDetector as PatternDetector
+import anonymizer.RevertTokens as RevertTokens
+import anonymizer.TransformCodec as TransformCodec
+import anonymizer.TransformStore as TransformStore
+import anonymizer.Metrics as Metrics
 
-my_dynamo = DynamoDBFacade.DynamoDBFacade(region="us-east-1")
+# Records are processed in chunks of this size, so the output can be streamed while later records are processed
+PIPELINE_CHUNK_SIZE = 500
+# Upper limit of the concurrency option, the connection pools of the clients are sized to match
+MAX_CONCURRENCY = 32
+
+my_dynamo = DynamoDBFacade.DynamoDBFacade(region="us-east-1", max_pool_connections=MAX_CONCURRENCY)
 my_s3 = S3Facade.S3Facade(bucket_name="pii-scrub-service.poc.ab3.ai")
+# Detection results are cached for the life of the container, and shared through ddb if a cache table is set
+detection_cache = DetectionCache.DetectionCache(
+    persistent_tier=DetectionCache.DynamoDBCacheTier(my_dynamo, os.environ['DETECTION_CACHE_TABLE'])
+    if os.environ.get('DETECTION_CACHE_TABLE') else None)
+# Store of the transforms of the reversible records, DynamoDB unless TRANSFORM_STORE selects a local one
+transform_store = TransformStore.from_environment(my_dynamo)
+# Keys of the revert tokens, None if REVERT_TOKEN_KEYS is not set
+revert_token_keyring = RevertTokens.RevertTokenKeyring.from_environment()
+# Pattern detectors by language code and policy, their counters cover the life of the container
+pattern_detectors = {}
+# Automaton of the customer dictionaries, memory mapped from the file named by GAZETTEER_PATH, None if it is not set
+gazetteer_automaton = GazetteerDetector.from_environment()
 
 
 # Output Destination Options
@@ -17,13 +46,55 @@ DESTINATION_S3 = 's3'
 ANONYMIZER_MODE = 'ANONYMIZER'
 REVERT_MODE = 'REVERT'
 
+# Processing options, set through the control parameters of the request
+PACKED_DETECTION_OPTION = 'packed_detection'
+CONCURRENCY_OPTION = 'concurrency'
+INPUT_S3_KEY_OPTION = 'input_s3_key'
+INPUT_FORMAT_OPTION = 'input_format'
+PRE_DETECTION_OPTION = 'pre_detection'
+REVERSIBLE_OPTION = 'reversible'
+REVERT_MODE_OPTION = 'revert_mode'
+OUTPUT_FORMAT_OPTION = 'output_format'
+OUTPUT_COMPRESSION_OPTION = 'output_compression'
+MAX_RESPONSE_BYTES_OPTION = 'max_response_bytes'
+GAZETTEER_OPTION = 'gazetteer'
+# How reversible records are reverted: transforms persisted in the transform store, or an encrypted token in each record
+REVERT_MODE_STORAGE = 'storage'
+REVERT_MODE_TOKEN = 'token'
+# A synchronous lambda response is limited to 6 MB, a larger client output is spilled to s3 and the response points to
+# it. The default keeps some room for the rest of the response
+LAMBDA_MAX_RESPONSE_BYTES = 6 * 1024 * 1024
+DEFAULT_MAX_RESPONSE_BYTES = 6 * 1000 * 1000
+MIN_MAX_RESPONSE_BYTES = 1024
+NON_ASCII_BYTES = bytes(range(0x80, 0x100))
+# Field reporting why a record failed, the record is returned without its text field
+ERROR_FIELD_NAME = 'error'
+DEFAULT_CONTROL_OPTIONS = {
+    PACKED_DETECTION_OPTION: False,
+    CONCURRENCY_OPTION: 1,
+    INPUT_S3_KEY_OPTION: None,
+    INPUT_FORMAT_OPTION: None,
+    PRE_DETECTION_OPTION: PatternDetector.POLICY_OFF,
+    REVERSIBLE_OPTION: True,
+    REVERT_MODE_OPTION: REVERT_MODE_STORAGE,
+    OUTPUT_FORMAT_OPTION: S3Facade.OUTPUT_FORMAT_JSON_LINES,
+    OUTPUT_COMPRESSION_OPTION: None,
+    MAX_RESPONSE_BYTES_OPTION: DEFAULT_MAX_RESPONSE_BYTES,
+    GAZETTEER_OPTION: ComprehendFacade.GAZETTEER_OFF
+}
+
 
-def output_results_to_client(records) -> dict:
+def output_results_to_client(records, max_response_bytes: int = None, mode: str = ANONYMIZER_MODE,
+                             table_name: str = S3Facade.DEFAULT_TABLE_NAME) -> dict:
     """
     Output the response to the calling client
     :param records: the processed record set, anonymized or reverted or null if the records output is
     directed to persistent storage
-    :return: dict that includes status, headers, and body if records is not None
+    :param max_response_bytes: the size of the response over which the records are spilled to s3, None for no limit
+    :param mode: anonymize or revert - used in the s3 key of spilled records
+    :param table_name: the name of the table being processed - used in the s3 key of spilled records
+    :return: dict that includes status, headers, and body if records is not None, the body points to the s3
+    output if the records were spilled
     """
     output = {
         'statusCode': 200,
@@ -32,16 +103,70 @@ def output_results_to_client(records) -> dict:
             'Access-Control-Allow-Origin': '*'
         },
     }
-    if records is not None:
+    if records is not None and max_response_bytes is None:
         # output['body'] = json.dumps(records, sort_keys=True, indent=4)
         # output['body'] = json.dumps(records, sort_keys=False, indent=4)
-        output['body'] = json.dumps(records)
+        output['body'] = JsonCodec.dumps_text(list(records))
+    elif records is not None:
+        # serialize the records as they are produced, the body is the same as JsonCodec.dumps of the list
+        serialized_records = []
+        # the brackets, and the body is escaped once more in the lambda response
+        response_bytes = 2
+        records = iter(records)
+        for record in records:
+            serialized_record = JsonCodec.dumps(record)
+            serialized_records.append(serialized_record)
+            response_bytes += estimate_escaped_size(serialized_record) + 1
+            if response_bytes > max_response_bytes:
+                output['body'] = spill_results_to_s3(serialized_records, records, mode, table_name)
+                return output
+        output['body'] = (b'[' + b','.join(serialized_records) + b']').decode('utf-8')
     return output
 
 
-def output_results_to_s3(records, mode, table_name) -> dict:
+def estimate_escaped_size(document: bytes) -> int:
+    """
+    :param document: a JSON document, UTF-8 encoded
+    :return: an upper bound of its size once escaped as a JSON string, each quote and backslash gets a backslash,
+    and a non-ascii character takes up to three times its UTF-8 bytes if it is escaped, like the 6 of \\u00e9
+    """
+    size = len(document) + document.count(b'"') + document.count(b'\\')
+    if not document.isascii():
+        size += 2 * (len(document) - len(document.translate(None, NON_ASCII_BYTES)))
+    return size
+
+
+def spill_results_to_s3(serialized_records: list, records, mode: str, table_name: str) -> str:
+    """
+    Stream the records of a response too large for the client to s3, as JSON Lines
+    :param serialized_records: the records serialized so far, as UTF-8 JSON documents
+    :param records: iterator of the records not serialized yet, consumed as they are written
+    :param mode: anonymize or revert
+    :param table_name: the name of the table being processed - used in the s3 key
+    :return: the body of the response, the location of the output and its number of records
+    """
+    Metrics.current().increment(Metrics.SPILLED_RESPONSES)
+    s3_key = my_s3.generate_s3_key_for_table(table_name=table_name, mode=mode)
+    record_count = my_s3.write_json_lines_to_s3(
+        itertools.chain(serialized_records, (JsonCodec.dumps(record) for record in records)), s3_key)
+    return JsonCodec.dumps_text({'output_location': f"{my_s3.bucket_name}/{s3_key}", 'record_count': record_count})
+
+
+def output_results_to_s3(records, mode, table_name, output_format=S3Facade.OUTPUT_FORMAT_JSON_LINES,
+                         compression=None) -> dict:
+    """
+    Stream the records to S3, as JSON Lines by default
+    :param records: iterable of the processed records, consumed as they are written
+    :param mode: anonymize or revert
+    :param table_name: the name of the table being processed - used in the s3 key
+    :param output_format: one of S3Facade.OUTPUT_FORMATS
+    :param compression: the compression of a columnar output format, its default if None
+    :return: dict that includes status, headers, and the location of the output in the body
+    """
     if mode == ANONYMIZER_MODE:
-        s3_location = my_s3.write_anonymized_records(records, table_name)
+        # failed records only have the error field, it is in the schema of a columnar output from the start
+        s3_location = my_s3.write_anonymized_records(records, table_name, output_format, compression,
+                                                     nullable_fields=[ERROR_FIELD_NAME])
     else:
         raise ValueError('Not supported yet')
     output = dict(statusCode=200, headers={
@@ -52,76 +177,746 @@ def output_results_to_s3(records, mode, table_name) -> dict:
     return output
 
 
-def output_results(records: list, destination: str, mode: str, table_name: str):
+def output_results(records, destination: str, mode: str, table_name: str,
+                   output_format=S3Facade.OUTPUT_FORMAT_JSON_LINES, compression=None, max_response_bytes=None):
     """
     Output the processed records to the appropriate destination
-    :param records: the processed record set, anonymized or reverted
+    :param records: the processed record set, anonymized or reverted, a list or a generator
     :param destination: the destination to output the processed records - the client app or s3
     :param mode: anonymize or revert - needed for s3 output
     :param table_name: the name of the table being processed - used for s3 output
+    :param output_format: the format of the s3 output, one of S3Facade.OUTPUT_FORMATS
+    :param compression: the compression of a columnar s3 output, its default if None
+    :param max_response_bytes: the size of the client response over which the records are spilled to s3 as
+    JSON Lines, None for no limit
     :return: dict that includes status, headers, and body with the records if destination is client
     """
     if destination == DESTINATION_CLIENT:
-        return output_results_to_client(records)
+        return output_results_to_client(records, max_response_bytes, mode, table_name)
     elif destination == DESTINATION_S3:
-        return output_results_to_s3(records, mode, table_name)
+        return output_results_to_s3(records, mode, table_name, output_format, compression)
     else:
         raise ValueError('Invalid output destination')
 
 
-def anonymize_records(records_to_process: list, text_field_name: str, language_code='en') -> list:
+def create_inference_facade(language_code: str, max_pool_connections: int, gazetteer: str):
+    """
+    :param language_code: language code for the text to be anonymized
+    :param max_pool_connections: the number of detection requests run in parallel
+    :param gazetteer: the InferenceFacade gazetteer mode, using the automaton of the container
+    :return: the InferenceFacade detecting the PII entities
+    """
+    return ComprehendFacade.InferenceFacade(language_code=language_code, max_pool_connections=max_pool_connections,
+                                            gazetteer_automaton=gazetteer_automaton, gazetteer_mode=gazetteer)
+
+
+def get_pattern_detector(language_code: str, policy: str):
+    """
+    :param language_code: language code for the text to be anonymized
+    :param policy: the PatternDetector policy
+    :return: the shared PatternDetector of the language and policy
+    """
+    key = (language_code, policy)
+    if key not in pattern_detectors:
+        pattern_detectors[key] = PatternDetector.PatternDetector(language_code=language_code, policy=policy)
+    return pattern_detectors[key]
+
+
+def pattern_detector_stats() -> dict:
+    """
+    :return: the counters of the pattern detectors summed, and the fraction of remote calls avoided
+    """
+    texts_seen = remote_calls_avoided = 0
+    for my_pattern_detector in list(pattern_detectors.values()):
+        stats = my_pattern_detector.stats()
+        texts_seen += stats['texts_seen']
+        remote_calls_avoided += stats['remote_calls_avoided']
+    return {'texts_seen': texts_seen,
+            'remote_calls_avoided': remote_calls_avoided,
+            'avoided_fraction': remote_calls_avoided / texts_seen if texts_seen else 0.0}
+
+
+def create_executor(concurrency: int):
+    """
+    :param concurrency: the number of tasks to run in parallel
+    :return: context of a thread pool for the concurrency, or a context of None to process serially
+    """
+    if concurrency > 1:
+        return ThreadPoolExecutor(max_workers=concurrency)
+    return contextlib.nullcontext()
+
+
+def map_concurrently(function, items: list, executor) -> list:
+    """
+    Apply a function to every item, on the thread pool if there is one, in the metrics context of the caller
+    :param function: the function to apply
+    :param items: the items to apply the function to
+    :param executor: the thread pool, or None to apply the function serially
+    :return: list of the results, in the same order as items
+    """
+    if executor is None:
+        return [function(item) for item in items]
+    return list(executor.map(Metrics.in_current_context(function), items))
+
+
+def call_isolated(function, item):
+    """
+    :param function: the function to apply
+    :param item: the item to apply the function to
+    :return: the result of the function, or the exception it raised
+    """
+    try:
+        return function(item)
+    except Exception as error:
+        return error
+
+
+def map_isolated(function, items: list, executor) -> list:
+    """
+    Apply a function to every item like map_concurrently, a failure only affects the result of its item
+    :param function: the function to apply
+    :param items: the items to apply the function to
+    :param executor: the thread pool, or None to apply the function serially
+    :return: list of the results, or of the exceptions raised, in the same order as items
+    """
+    return map_concurrently(functools.partial(call_isolated, function), items, executor)
+
+
+def run_calls(calls, executor):
+    """
+    Run the service calls of a pipeline step, the steps are shared with anonymizer_async, which runs their calls on
+    its event loop instead
+    :param calls: generator of the step, yielding (function, items) and sent the results of map_isolated for them
+    :param executor: the thread pool, or None to process serially
+    :return: the value the generator returns
+    """
+    try:
+        function, items = next(calls)
+        while True:
+            function, items = calls.send(map_isolated(function, items, executor))
+    except StopIteration as stop:
+        return stop.value
+
+
+def flatten_chunk_results(item_chunks: list, result_chunks: list) -> list:
+    """
+    :param item_chunks: the chunks of items a function was applied to
+    :param result_chunks: the list of results of each chunk, or the exception it failed with
+    :return: list of the results of the items, the exception of its chunk for the items of a failed chunk
+    """
+    return [result for item_chunk, result_chunk in zip(item_chunks, result_chunks)
+            for result in ([result_chunk] * len(item_chunk) if isinstance(result_chunk, Exception) else result_chunk)]
+
+
+def describe_error(error: Exception) -> str:
+    """
+    :param error: the exception a record failed with
+    :return: the description of the error reported in the record
+    """
+    return f"{type(error).__name__}: {error}"
+
+
+def split_into_chunks(items: list, chunk_size: int) -> list:
+    """
+    :param items: the items to split
+    :param chunk_size: the maximum number of items in a chunk
+    :return: list of chunks of consecutive items
+    """
+    return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+
+def iterate_chunks(items, chunk_size: int):
+    """
+    :param items: iterable of the items to split, consumed lazily
+    :param chunk_size: the maximum number of items in a chunk
+    :return: generator of lists of consecutive items
+    """
+    iterator = iter(items)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+def anonymize_records(records_to_process: list, text_field_name, language_code='en',
+                      packed_detection=False, concurrency=1, pre_detection=PatternDetector.POLICY_OFF,
+                      reversible=True, revert_mode=REVERT_MODE_STORAGE,
+                      gazetteer=ComprehendFacade.GAZETTEER_OFF) -> list:
     """
     :param records_to_process set of records to process
-    :param text_field_name: name of the field containing the text to be anonymized
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together under one revert key
     :param language_code: language code for the text to be anonymized
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the number of detection and persistence requests to run in parallel
+    :param pre_detection: the PatternDetector policy deciding when the remote detection can be skipped
+    :param reversible: persist the transforms and add a revert_key to the records, so they can be reverted
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :param gazetteer: the InferenceFacade gazetteer mode, detecting the terms of the customer dictionaries
     :return: list of anonymized records
     """
-    my_comprehend = ComprehendFacade.InferenceFacade(language_code=language_code)
+    return list(generate_anonymized_records(records_to_process=records_to_process, text_field_name=text_field_name,
+                                            language_code=language_code, packed_detection=packed_detection,
+                                            concurrency=concurrency, pre_detection=pre_detection,
+                                            reversible=reversible, revert_mode=revert_mode, gazetteer=gazetteer))
+
+
+def generate_anonymized_records(records_to_process, text_field_name, language_code='en',
+                                packed_detection=False, concurrency=1, pre_detection=PatternDetector.POLICY_OFF,
+                                reversible=True, revert_mode=REVERT_MODE_STORAGE, chunk_size=PIPELINE_CHUNK_SIZE,
+                                gazetteer=ComprehendFacade.GAZETTEER_OFF):
+    """
+    Anonymize the records chunk by chunk, so the output can be written while the next records are processed
+    :param records_to_process: iterable of the records to process
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together under one revert key
+    :param language_code: language code for the text to be anonymized
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the number of detection and persistence requests to run in parallel
+    :param pre_detection: the PatternDetector policy deciding when the remote detection can be skipped
+    :param reversible: persist the transforms and add a revert_key to the records, so they can be reverted
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :param chunk_size: the number of records processed together
+    :param gazetteer: the InferenceFacade gazetteer mode, detecting the terms of the customer dictionaries
+    :return: generator of the anonymized records, in the same order as records_to_process
+    """
+    my_comprehend = create_inference_facade(language_code, concurrency, gazetteer)
+    my_pattern_detector = get_pattern_detector(language_code, pre_detection)
     my_scrub_xform = ScrubTransforms.ScrubTransforms(language_code=language_code)
-    anonymized_records = []
+    with create_executor(concurrency) as executor:
+        for chunk in iterate_chunks(records_to_process, chunk_size):
+            yield from anonymize_chunk(chunk, text_field_name, my_comprehend, my_pattern_detector, my_scrub_xform,
+                                       packed_detection, concurrency, executor, reversible, revert_mode)
+
+
+def pop_field_texts(records_to_process: list, text_field_name) -> (list, list):
+    """
+    Remove the texts to anonymize from the records
+    :param records_to_process: the records, their text fields are removed
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together
+    :return: the texts of all the records, and the names of the fields each record gave, in the order of the texts
+    A record without the text field gets a placeholder text, a record without some of the listed fields, or with
+    a value that is not a string, only has its other fields anonymized
+    """
+    if isinstance(text_field_name, str):
+        return [record.pop(text_field_name, "No text provided") for record in records_to_process], \
+            [[text_field_name]] * len(records_to_process)
+    texts, record_fields = [], []
     for record in records_to_process:
-        text = record.pop(text_field_name, "No text provided")
+        field_names = [field_name for field_name in text_field_name if isinstance(record.get(field_name), str)]
+        texts.extend(record.pop(field_name) for field_name in field_names)
+        record_fields.append(field_names)
+    return texts, record_fields
+
+
+def group_by_record(values: list, record_fields: list) -> list:
+    """
+    :param values: one value per text, in the order of the texts returned by pop_field_texts
+    :param record_fields: the names of the fields of each record, as returned by pop_field_texts
+    :return: list of the values of each record
+    """
+    iterator = iter(values)
+    return [list(itertools.islice(iterator, len(field_names))) for field_names in record_fields]
+
+
+def group_texts_by_record(texts: list, record_fields: list, missing_texts: list) -> list:
+    """
+    :param texts: the texts of the records, as returned by pop_field_texts
+    :param record_fields: the names of the fields of each record, as returned by pop_field_texts
+    :param missing_texts: the distinct texts to detect remotely, in the order they first appear in texts
+    :return: list of lists of the missing texts, the texts first found in the same record are grouped together
+    """
+    first_records = {}
+    for text, record in zip(texts, (record for record, field_names in enumerate(record_fields)
+                                    for _ in field_names)):
+        first_records.setdefault(text, record)
+    return [list(group) for _, group in itertools.groupby(missing_texts, key=first_records.get)]
+
+
+def as_field_names(text_field_name) -> list:
+    """
+    :param text_field_name: the name of the text field, or list of the names of the text fields
+    :return: list of the names of the text fields
+    """
+    return [text_field_name] if isinstance(text_field_name, str) else list(text_field_name)
+
+
+@Metrics.timed(Metrics.STAGE_DETECT)
+def detect_texts(texts: list, my_comprehend, my_pattern_detector, packed_detection: bool, concurrency: int,
+                 executor, record_fields: list = None) -> list:
+    """
+    Detect the PII entities of the texts, once per distinct text
+    Texts are first given to the local pattern detector, the remaining ones are looked up in the cache, and only
+    the texts missing from the cache are sent to the remote detector
+    :param texts: the texts to detect PII entities
+    :param my_comprehend: the InferenceFacade detecting the PII entities
+    :param my_pattern_detector: the PatternDetector skipping the remote call when it is enough
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the number of detection requests to run in parallel
+    :param executor: the thread pool, or None to process serially
+    :param record_fields: the names of the fields of each record the texts come from, as returned by
+    pop_field_texts, the texts of a record with several fields are packed into one detection request
+    :return: list of dict of PII entities, or of the exception the detection failed with, one per text
+    """
+    unique_texts, detected, missing, missing_keys = lookup_detections(texts, my_comprehend.detection_namespace,
+                                                                      my_pattern_detector)
+    missing_texts = [unique_texts[position] for position in missing]
+    remote_detected = run_calls(remote_detection_calls(texts, record_fields, missing_texts, my_comprehend,
+                                                       packed_detection, concurrency), executor)
+    return store_detections(texts, unique_texts, detected, missing, missing_keys, remote_detected)
+
+
+def remote_detection_calls(texts: list, record_fields: list, missing_texts: list, my_comprehend,
+                           packed_detection: bool, slice_count: int):
+    """
+    Step detecting the texts missing from the cache, its calls are run by run_calls
+    :param texts: the texts to detect PII entities
+    :param record_fields: the names of the fields of each record the texts come from, or None, the texts of a
+    record with several fields are packed into one detection request
+    :param missing_texts: the distinct texts to detect remotely, as returned by lookup_detections
+    :param my_comprehend: the InferenceFacade detecting the PII entities
+    :param packed_detection: pack the texts of many records into each detection request
+    :param slice_count: the number of packed requests the texts are split into
+    :return: list of dict of PII entities, or of the exception the detection failed with, one per missing text
+    """
+    if packed_detection:
+        # give each worker a contiguous slice of the texts to pack
+        text_slices = split_into_chunks(missing_texts, max(1, -(-len(missing_texts) // slice_count)))
+    elif record_fields is not None and len(texts) > len(record_fields):
+        text_slices = group_texts_by_record(texts, record_fields, missing_texts)
+    else:
+        return (yield my_comprehend.detect_pii_entities, missing_texts)
+    slice_results = yield my_comprehend.detect_pii_entities_packed, text_slices
+    remote_detected = []
+    for text_slice, base_transforms_slice in zip(text_slices, slice_results):
+        if isinstance(base_transforms_slice, Exception):
+            # detect the texts of a failed slice one by one, so only the failing texts fail
+            base_transforms_slice = yield my_comprehend.detect_pii_entities, text_slice
+        remote_detected.extend(base_transforms_slice)
+    return remote_detected
+
+
+def lookup_detections(texts: list, language_code: str, my_pattern_detector) -> (list, list, list, list):
+    """
+    Detect the PII entities of the distinct texts locally, with the pattern detector and the cache
+    :param texts: the texts to detect PII entities
+    :param language_code: language code of the texts, or the InferenceFacade detection_namespace, the cache keys
+    are made with
+    :param my_pattern_detector: the PatternDetector skipping the remote call when it is enough
+    :return: the distinct texts, their PII entities or None, the positions and cache keys of the None
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    detected = [my_pattern_detector.detect_pii_entities(text) for text in unique_texts]
+    remote = [position for position, transforms in enumerate(detected) if transforms is None]
+    keys = [DetectionCache.DetectionCache.make_key(language_code, unique_texts[position]) for position in remote]
+    cached = detection_cache.get_many(keys)
+    missing = [position for position, transforms in zip(remote, cached) if transforms is None]
+    missing_keys = [key for key, transforms in zip(keys, cached) if transforms is None]
+    for position, transforms in zip(remote, cached):
+        detected[position] = transforms
+    return unique_texts, detected, missing, missing_keys
+
+
+def store_detections(texts: list, unique_texts: list, detected: list, missing: list, missing_keys: list,
+                     remote_detected: list) -> list:
+    """
+    Cache the PII entities detected remotely, and complete the detection of the texts
+    :param texts: the texts to detect PII entities
+    :param unique_texts: the distinct texts, as returned by lookup_detections
+    :param detected: the PII entities of the distinct texts, as returned by lookup_detections
+    :param missing: the positions of the distinct texts detected remotely
+    :param missing_keys: the cache keys of the distinct texts detected remotely
+    :param remote_detected: the PII entities detected remotely, or the exception raised, in the order of missing
+    :return: list of dict of PII entities, or of the exception the detection failed with, one per text
+    """
+    # failures are not cached, the texts are detected again by the next request
+    succeeded = [position for position, base_transforms in enumerate(remote_detected)
+                 if not isinstance(base_transforms, Exception)]
+    detection_cache.put_many([missing_keys[position] for position in succeeded],
+                             [remote_detected[position] for position in succeeded])
+    for position, base_transforms in zip(missing, remote_detected):
+        detected[position] = base_transforms
+    entries = {text: base_transforms if isinstance(base_transforms, Exception)
+               else DetectionCache.DetectionCache.transforms_to_entry(base_transforms)
+               for text, base_transforms in zip(unique_texts, detected)}
+    return [entries[text] if isinstance(entries[text], Exception)
+            else DetectionCache.DetectionCache.entry_to_transforms(entries[text]) for text in texts]
+
+
+def anonymize_chunk(records_to_process: list, text_field_name, my_comprehend, my_pattern_detector,
+                    my_scrub_xform, packed_detection: bool, concurrency: int, executor, reversible=True,
+                    revert_mode=REVERT_MODE_STORAGE) -> list:
+    """
+    :param records_to_process: the chunk of records to process
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together under one revert key
+    :param my_comprehend: the InferenceFacade detecting the PII entities
+    :param my_pattern_detector: the PatternDetector skipping the remote call when it is enough
+    :param my_scrub_xform: the ScrubTransforms anonymizing the text
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the number of detection and persistence requests to run in parallel
+    :param executor: the thread pool, or None to process serially
+    :param reversible: persist the transforms and add a revert_key to the records, so they can be reverted
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :return: list of anonymized records
+    """
+    texts, record_fields = pop_field_texts(records_to_process, text_field_name)
+    base_transforms_list = detect_texts(texts, my_comprehend, my_pattern_detector, packed_detection, concurrency,
+                                        executor, record_fields)
+    anonymized_texts, complete_transforms = rewrite_texts(texts, base_transforms_list, my_scrub_xform, reversible)
+    if not reversible:
+        # no reversal metadata and no persistence, only the text rewriting
+        return build_anonymized_records(records_to_process, record_fields, anonymized_texts)
+    revert_field_name, revert_values = persist_transforms(complete_transforms, record_fields, anonymized_texts,
+                                                          text_field_name, revert_mode, executor)
+    return build_anonymized_records(records_to_process, record_fields, anonymized_texts, revert_field_name,
+                                    revert_values)
+
+
+def combine_field_transforms(complete_transforms: list, record_fields: list, text_field_name) -> list:
+    """
+    :param complete_transforms: the complete transform of each text, or the exception it failed with
+    :param record_fields: the names of the fields of each record, as returned by pop_field_texts
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :return: the complete transform of each record, or the exception it failed with, the transforms of a list of
+    fields are kept by field name in one transform, so they are reverted with one revert key
+    """
+    if isinstance(text_field_name, str):
+        return complete_transforms
+    record_transforms = []
+    for field_names, field_transforms in zip(record_fields, group_by_record(complete_transforms, record_fields)):
+        error = next((value for value in field_transforms if isinstance(value, Exception)), None)
+        record_transforms.append(error if error is not None
+                                 else {TransformCodec.FIELDS_KEY: dict(zip(field_names, field_transforms))})
+    return record_transforms
+
+
+@Metrics.timed(Metrics.STAGE_PERSIST)
+def persist_transforms(complete_transforms: list, record_fields: list, anonymized_texts: list, text_field_name,
+                       revert_mode: str, executor) -> (str, list):
+    """
+    :param complete_transforms: the complete transform of each text, or the exception it failed with
+    :param record_fields: the names of the text fields of each record, as returned by pop_field_texts
+    :param anonymized_texts: the anonymized text of each text field, or the exception it failed with
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :param executor: the thread pool, or None to process serially
+    :return: the name of the revert field, and its value, or the exception it failed with, for each record
+    """
+    return run_calls(persistence_calls(complete_transforms, record_fields, anonymized_texts, text_field_name,
+                                       revert_mode), executor)
+
+
+def persistence_calls(complete_transforms: list, record_fields: list, anonymized_texts: list, text_field_name,
+                      revert_mode: str):
+    """
+    Step making the revert field of the records, its calls are run by run_calls
+    :param complete_transforms: the complete transform of each text, or the exception it failed with
+    :param record_fields: the names of the text fields of each record, as returned by pop_field_texts
+    :param anonymized_texts: the anonymized text of each text field, or the exception it failed with
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :return: the name of the revert field, and its value, or the exception it failed with, for each record
+    """
+    record_transforms = combine_field_transforms(complete_transforms, record_fields, text_field_name)
+    if revert_mode == REVERT_MODE_TOKEN:
+        # the encrypted transforms travel with the records, nothing is persisted
+        return 'revert_token', create_revert_tokens(record_transforms,
+                                                    group_field_texts(record_fields, anonymized_texts))
+    # persist the transforms to the transform store, a failed batch write fails the records of its chunk
+    persisted = [position for position, record_transform in enumerate(record_transforms)
+                 if not isinstance(record_transform, Exception)]
+    transform_chunks = split_into_chunks([record_transforms[position] for position in persisted],
+                                         transform_store.write_batch_size)
+    guid_chunks = yield transform_store.put_many, transform_chunks
+    guids = list(record_transforms)
+    for position, guid in zip(persisted, flatten_chunk_results(transform_chunks, guid_chunks)):
+        guids[position] = guid
+    return 'revert_key', guids
+
+
+@Metrics.timed(Metrics.STAGE_REWRITE)
+def rewrite_texts(texts: list, base_transforms_list: list, my_scrub_xform, reversible=True) -> (list, list):
+    """
+    :param texts: the texts to anonymize
+    :param base_transforms_list: the PII entities of each text
+    :param my_scrub_xform: the ScrubTransforms anonymizing the text
+    :param reversible: also return the transforms needed to revert the texts
+    :return: the anonymized texts, and the complete transform of each text, or None if not reversible
+    A failed detection is passed through as the anonymized text and complete transform of its text
+    """
+    anonymized_texts, complete_transforms = [], []
+    entity_counts = {}
+    for text, base_transforms in zip(texts, base_transforms_list):
+        if isinstance(base_transforms, Exception):
+            anonymized_texts.append(base_transforms)
+            complete_transforms.append(base_transforms)
+            continue
+        for transform in base_transforms['Transforms']:
+            entity_counts[transform['Type']] = entity_counts.get(transform['Type'], 0) + 1
         # anonymize the text
-        base_transforms = my_comprehend.detect_pii_entities(text)
         anon_transforms = my_scrub_xform.anonymize_text(text, base_transforms)
+        if not reversible:
+            anonymized_texts.append(my_scrub_xform.generate_irreversible_text(text, anon_transforms))
+            continue
         anonymized_text, complete_transform = my_scrub_xform.generate_anonymous_text(text, anon_transforms)
-        # persist anon_dict to DynamoDB
-        guid = my_dynamo.put_scrub_xform(complete_transform)
+        anonymized_texts.append(anonymized_text)
+        complete_transforms.append(complete_transform)
+    count_texts(texts, anonymized_texts)
+    Metrics.current().count_entities(entity_counts)
+    return anonymized_texts, complete_transforms if reversible else None
+
+
+def count_texts(texts: list, rewritten_texts: list) -> None:
+    """
+    Count the bytes of the texts before and after the rewrite, the failed texts are skipped
+    :param texts: the texts of the records
+    :param rewritten_texts: the rewritten texts, or the exceptions the texts failed with
+    :return: None
+    """
+    succeeded = [(text, rewritten_text) for text, rewritten_text in zip(texts, rewritten_texts)
+                 if not isinstance(rewritten_text, Exception)]
+    Metrics.current().increment(Metrics.BYTES_IN, sum(len(text.encode('utf-8')) for text, _ in succeeded))
+    Metrics.current().increment(Metrics.BYTES_OUT, sum(len(text.encode('utf-8')) for _, text in succeeded))
+
+
+def create_revert_tokens(complete_transforms: list, record_texts: list) -> list:
+    """
+    :param complete_transforms: the complete transform of each record, or the exception it failed with
+    :param record_texts: dict of the name of each text field to its anonymized text, for each record
+    :return: the revert token of each record, or the exception it failed with
+    """
+    return [complete_transform if isinstance(complete_transform, Exception)
+            else call_isolated(create_revert_token, (complete_transform, field_texts))
+            for complete_transform, field_texts in zip(complete_transforms, record_texts)]
+
+
+def create_revert_token(item: tuple) -> str:
+    """
+    :param item: the complete transform of a record, and the anonymized texts of its text fields by name
+    :return: the revert token of the record, bound to its anonymized texts
+    """
+    complete_transform, field_texts = item
+    return revert_token_keyring.encrypt(complete_transform, RevertTokens.record_binding(field_texts))
+
+
+def group_field_texts(record_fields: list, anonymized_texts: list) -> list:
+    """
+    :param record_fields: the names of the text fields of each record, as returned by pop_field_texts
+    :param anonymized_texts: the anonymized text of each text field, or the exception it failed with
+    :return: dict of the name of each text field to its anonymized text, for each record
+    """
+    return [dict(zip(field_names, field_texts))
+            for field_names, field_texts in zip(record_fields, group_by_record(anonymized_texts, record_fields))]
+
+
+def build_anonymized_records(records_to_process: list, record_fields: list, anonymized_texts: list,
+                             revert_field_name: str = None, revert_values: list = None) -> list:
+    """
+    :param records_to_process: the records, without their text fields
+    :param record_fields: the names of the text fields of each record, as returned by pop_field_texts
+    :param anonymized_texts: the anonymized text of each text field, or the exception it failed with
+    :param revert_field_name: 'revert_key' or 'revert_token', None if the records are not reversible
+    :param revert_values: the value of the revert field of each record, or the exception it failed with
+    :return: list of anonymized records, a failed record has an error field instead of its text fields
+    """
+    anonymized_records = []
+    succeeded = 0
+    for position, (record, field_names, field_texts) in enumerate(zip(
+            records_to_process, record_fields, group_by_record(anonymized_texts, record_fields))):
+        revert_value = revert_values[position] if revert_field_name is not None else None
+        error = next((value for value in field_texts + [revert_value] if isinstance(value, Exception)), None)
+        if error is not None:
+            anonymized_records.append(build_failed_record(record, error))
+            continue
         # create the anonymized record
-        anonymized_record = {
-            text_field_name: anonymized_text,
-            'revert_key': guid
-        }
+        anonymized_record = dict(zip(field_names, field_texts))
+        if revert_field_name is not None:
+            anonymized_record[revert_field_name] = revert_value
         # merge anonymized_record and record
         anonymized_record.update(record)
         # add the anonymized record to the records
         anonymized_records.append(anonymized_record)
+        succeeded += 1
+    Metrics.current().increment(Metrics.RECORDS, succeeded)
     return anonymized_records
 
 
-def revert_records(records_to_process: list, text_field_name: str) -> list:
+def build_failed_record(record: dict, error: Exception) -> dict:
+    """
+    :param record: the record, without its text field
+    :param error: the exception the record failed with
+    :return: the record with the error field, the text is left out so no original text is returned
+    """
+    Metrics.current().increment(Metrics.FAILED_RECORDS)
+    failed_record = {ERROR_FIELD_NAME: describe_error(error)}
+    failed_record.update(record)
+    return failed_record
+
+
+def revert_records(records_to_process: list, text_field_name, concurrency=1) -> list:
     """
     Revert the anonymized records back to their original
     :param records_to_process: the records to revert
-    :param text_field_name: the name of the field containing the text to be anonymized
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together
+    :param concurrency: the number of transform store requests to run in parallel
     :return: list of anonymized records
     """
+    return list(generate_reverted_records(records_to_process=records_to_process, text_field_name=text_field_name,
+                                          concurrency=concurrency))
+
+
+def generate_reverted_records(records_to_process, text_field_name, concurrency=1,
+                              chunk_size=PIPELINE_CHUNK_SIZE):
+    """
+    Revert the anonymized records back to their original, chunk by chunk
+    :param records_to_process: iterable of the records to revert
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together
+    :param concurrency: the number of transform store requests to run in parallel
+    :param chunk_size: the number of records processed together
+    :return: generator of the reverted records, in the same order as records_to_process
+    """
     my_pii_anon = ScrubTransforms.ScrubTransforms()
+    with create_executor(concurrency) as executor:
+        for chunk in iterate_chunks(records_to_process, chunk_size):
+            yield from revert_chunk(chunk, text_field_name, my_pii_anon, executor)
+
+
+def decrypt_revert_token(item: tuple) -> dict:
+    """
+    :param item: the revert_token of a record, and the anonymized texts of its text fields by name
+    :return: the scrub transform encrypted in the token
+    """
+    token, field_texts = item
+    if revert_token_keyring is None:
+        raise KeyError(f"No revert token key configured, set {RevertTokens.KEYS_ENVIRONMENT_VARIABLE}")
+    return revert_token_keyring.decrypt(token, RevertTokens.record_binding(field_texts))
+
+
+def get_field_texts(record: dict, text_field_name) -> dict:
+    """
+    :param record: an anonymized record
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :return: dict of the name of each text field of the record to its text, the fields pop_field_texts takes
+    """
+    if isinstance(text_field_name, str):
+        return {text_field_name: record.get(text_field_name, "No text provided")}
+    return {field_name: record[field_name] for field_name in text_field_name
+            if isinstance(record.get(field_name), str)}
+
+
+def revert_chunk(records_to_process: list, text_field_name, my_pii_anon, executor) -> list:
+    """
+    :param records_to_process: the chunk of records to revert
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together
+    :param my_pii_anon: the ScrubTransforms reverting the text
+    :param executor: the thread pool, or None to process serially
+    :return: list of reverted records
+    """
+    saved_transforms = fetch_revert_transforms(records_to_process, text_field_name, executor)
+    return build_reverted_records(records_to_process, text_field_name, saved_transforms, my_pii_anon)
+
+
+@Metrics.timed(Metrics.STAGE_FETCH)
+def fetch_revert_transforms(records_to_process: list, text_field_name, executor) -> list:
+    """
+    :param records_to_process: the records to revert, their revert field is removed
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :param executor: the thread pool, or None to process serially
+    :return: the transforms of each record, or the exception it failed with
+    """
+    return run_calls(fetch_calls(records_to_process, text_field_name), executor)
+
+
+def fetch_calls(records_to_process: list, text_field_name):
+    """
+    Step getting the transforms of the records to revert, its calls are run by run_calls
+    :param records_to_process: the records to revert, their revert field is removed
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together
+    :return: the transforms of each record, or the exception it failed with
+    """
+    saved_transforms, stored, guids = read_revert_references(records_to_process, text_field_name)
+    # get the transforms of the records without a revert token from the transform store, a failed batch read fails
+    # the records of its chunk
+    guid_chunks = split_into_chunks(guids, transform_store.read_batch_size)
+    stored_transforms = flatten_chunk_results(guid_chunks, (yield transform_store.get_many, guid_chunks))
+    merge_stored_transforms(saved_transforms, stored, guids, stored_transforms)
+    return saved_transforms
+
+
+def read_revert_references(records_to_process: list, text_field_name) -> (list, list, list):
+    """
+    Decrypt the revert tokens of the records, and collect the revert keys of the others
+    :param records_to_process: the records to revert, their revert field is removed
+    :param text_field_name: name of the text field, or list of the names of the fields anonymized together, a token
+    only decrypts with the anonymized texts of the fields it was issued for
+    :return: the transforms of each record, None, or the exception the decryption failed with, the positions and
+    revert keys of the None
+    """
+    tokens = [record.pop('revert_token', None) for record in records_to_process]
+    stored = [position for position, token in enumerate(tokens) if token is None]
+    guids = [records_to_process[position].pop('revert_key', "No guid provided") for position in stored]
+    saved_transforms = [None if token is None
+                        else call_isolated(decrypt_revert_token, (token, get_field_texts(record, text_field_name)))
+                        for record, token in zip(records_to_process, tokens)]
+    return saved_transforms, stored, guids
+
+
+def merge_stored_transforms(saved_transforms: list, stored: list, guids: list, stored_transforms: list) -> None:
+    """
+    :param saved_transforms: the transforms of each record, completed in place
+    :param stored: the positions of the records with a revert key
+    :param guids: the revert keys of those records
+    :param stored_transforms: the transforms read from the store for those records, or the exception it failed with
+    :return: None
+    """
+    for position, guid, saved_transform in zip(stored, guids, stored_transforms):
+        if saved_transform is None:
+            saved_transform = KeyError(f"No scrub transform found for revert_key \'{guid}\'")
+        saved_transforms[position] = saved_transform
+
+
+@Metrics.timed(Metrics.STAGE_REWRITE)
+def build_reverted_records(records_to_process: list, text_field_name, saved_transforms: list,
+                           my_pii_anon) -> list:
+    """
+    :param records_to_process: the records to revert, without their revert field
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together, the fields of a multi-field transform are the ones it was created for
+    :param saved_transforms: the transforms of each record, or the exception it failed with
+    :param my_pii_anon: the ScrubTransforms reverting the text
+    :return: list of reverted records, a failed record has an error field instead of its text fields
+    """
+    field_names = as_field_names(text_field_name)
     reverted_records = []
-    for record in records_to_process:
-        guid = record.pop('revert_key', "No guid provided")
-        anon_text = record.pop(text_field_name, "No text provided")
-        # get the transform used from  DynamoDB
-        saved_transform = my_dynamo.get_scrub_xform(guid)
-        original_text = my_pii_anon.generate_original_text(anon_text, saved_transform)
+    anon_texts, original_texts = [], []
+    for record, saved_transform in zip(records_to_process, saved_transforms):
+        if isinstance(saved_transform, Exception):
+            for field_name in field_names:
+                record.pop(field_name, None)
+            reverted_records.append(build_failed_record(record, saved_transform))
+            continue
+        field_transforms = saved_transform[TransformCodec.FIELDS_KEY] if TransformCodec.FIELDS_KEY in saved_transform \
+            else {field_names[0]: saved_transform}
         # create the original record
-        original_record = {
-            text_field_name: original_text
-        }
+        original_record = {}
+        for field_name, field_transform in field_transforms.items():
+            anon_text = record.pop(field_name, "No text provided")
+            original_text = my_pii_anon.generate_original_text(anon_text, field_transform)
+            anon_texts.append(anon_text)
+            original_texts.append(original_text)
+            original_record[field_name] = original_text
         # merge original_record and record
         original_record.update(record)
         # add the original record to the records
         reverted_records.append(original_record)
+    count_texts(anon_texts, original_texts)
+    Metrics.current().increment(Metrics.RECORDS, sum(1 for saved_transform in saved_transforms
+                                                    if not isinstance(saved_transform, Exception)))
     return reverted_records
 
 
@@ -202,6 +997,29 @@ def sanitize_field_name(field_name: str, default: str) -> (str, str):
     return field_name, warning
 
 
+def sanitize_field_names(field_names) -> (list, str):
+    """
+    :param field_names: the names of the fields anonymized together, a list or a comma separated string
+    :return: the sanitized field names, None if not set or unusable, warning message if appropriate
+    """
+    if field_names is None:
+        return None, None
+    orig_field_names = field_names
+    if isinstance(field_names, str):
+        field_names = [field_name.strip() for field_name in field_names.split(',')]
+    if not isinstance(field_names, list) or not all(isinstance(field_name, str) for field_name in field_names):
+        return None, f"\'field_names\' parameter \'{orig_field_names}\' is not a list of field names. Ignored"
+    sanitized = list(dict.fromkeys(field_name for field_name in
+                                   (sanitize_field_name(field_name, None)[0] for field_name in field_names)
+                                   if field_name))
+    if len(sanitized) == 0:
+        return None, f"\'field_names\' parameter \'{orig_field_names}\' has no field name. Ignored"
+    if sanitized != field_names:
+        return sanitized, f"\'field_names\' parameter \'{orig_field_names}\' contains unacceptable field names. " \
+                          f"Sanitized to \'{sanitized}\'"
+    return sanitized, None
+
+
 def sanitize_language_code(language_code: str, default: str = 'en') -> (str, str):
     """
     :param language_code: the language code to sanitize
@@ -235,10 +1053,151 @@ def sanitize_results_destination(destination: str, default=DESTINATION_CLIENT) -
     return destination, warning
 
 
+def sanitize_boolean_option(value, option_name: str, default: bool) -> (bool, str):
+    """
+    :param value: the option value to sanitize, a boolean or a 'true'/'false' string
+    :param option_name: the name of the option, used in the warning
+    :param default: the default value
+    :return: the sanitized option value, warning message if appropriate
+    """
+    if value is None:
+        return default, None
+    if isinstance(value, bool):
+        return value, None
+    if isinstance(value, str) and value.lower() in ['true', 'false']:
+        return value.lower() == 'true', None
+    return default, f"\'{option_name}\' parameter \'{value}\' is not a boolean. Sanitized to \'{default}\'"
+
+
+def sanitize_integer_option(value, option_name: str, default: int, minimum: int, maximum: int) -> (int, str):
+    """
+    :param value: the option value to sanitize, an integer or a string of digits
+    :param option_name: the name of the option, used in the warning
+    :param default: the default value
+    :param minimum: the smallest value accepted
+    :param maximum: the largest value accepted, larger values are capped
+    :return: the sanitized option value, warning message if appropriate
+    """
+    if value is None:
+        return default, None
+    if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and value.isdigit())):
+        return default, f"\'{option_name}\' parameter \'{value}\' is not an integer. Sanitized to \'{default}\'"
+    sanitized = min(max(int(value), minimum), maximum)
+    if sanitized != int(value):
+        return sanitized, f"\'{option_name}\' parameter \'{value}\' is out of range. Sanitized to \'{sanitized}\'"
+    return sanitized, None
+
+
+def sanitize_choice_option(value, option_name: str, choices: list, default):
+    """
+    :param value: the option value to sanitize, one of the choices in any case
+    :param option_name: the name of the option, used in the warning
+    :param choices: the accepted values, in lower case
+    :param default: the default value
+    :return: the sanitized option value, warning message if appropriate
+    """
+    if value is None:
+        return default, None
+    if isinstance(value, str) and value.lower() in choices:
+        return value.lower(), None
+    return default, f"\'{option_name}\' parameter \'{value}\' is not one of {choices}. Sanitized to \'{default}\'"
+
+
+def sanitize_s3_key(s3_key, option_name: str) -> (str, str):
+    """
+    :param s3_key: the key of an object in the service bucket
+    :param option_name: the name of the option, used in the warning
+    :return: the sanitized key, warning message if appropriate
+    """
+    if s3_key is None:
+        return None, None
+    if not isinstance(s3_key, str) or len(s3_key.strip('/')) == 0:
+        return None, f"\'{option_name}\' parameter \'{s3_key}\' is not an s3 key. Ignored"
+    return s3_key.lstrip('/'), None
+
+
+def get_client_control_options(control_args: dict) -> (dict, list):
+    """
+    :param control_args: the control parameters of the request
+    :return: the processing options, and warnings
+    """
+    warnings = []
+    options = dict(DEFAULT_CONTROL_OPTIONS)
+    options[PACKED_DETECTION_OPTION], warning = sanitize_boolean_option(
+        control_args.get(PACKED_DETECTION_OPTION, None), PACKED_DETECTION_OPTION,
+        DEFAULT_CONTROL_OPTIONS[PACKED_DETECTION_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    options[CONCURRENCY_OPTION], warning = sanitize_integer_option(
+        control_args.get(CONCURRENCY_OPTION, None), CONCURRENCY_OPTION,
+        DEFAULT_CONTROL_OPTIONS[CONCURRENCY_OPTION], 1, MAX_CONCURRENCY)
+    if warning is not None:
+        warnings.append(warning)
+    options[INPUT_S3_KEY_OPTION], warning = sanitize_s3_key(control_args.get(INPUT_S3_KEY_OPTION, None),
+                                                            INPUT_S3_KEY_OPTION)
+    if warning is not None:
+        warnings.append(warning)
+    options[INPUT_FORMAT_OPTION], warning = sanitize_choice_option(
+        control_args.get(INPUT_FORMAT_OPTION, None), INPUT_FORMAT_OPTION,
+        [S3Facade.INPUT_FORMAT_JSON_LINES, S3Facade.INPUT_FORMAT_CSV], DEFAULT_CONTROL_OPTIONS[INPUT_FORMAT_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    options[PRE_DETECTION_OPTION], warning = sanitize_choice_option(
+        control_args.get(PRE_DETECTION_OPTION, None), PRE_DETECTION_OPTION, PatternDetector.POLICIES,
+        DEFAULT_CONTROL_OPTIONS[PRE_DETECTION_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    options[REVERSIBLE_OPTION], warning = sanitize_boolean_option(
+        control_args.get(REVERSIBLE_OPTION, None), REVERSIBLE_OPTION, DEFAULT_CONTROL_OPTIONS[REVERSIBLE_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    options[REVERT_MODE_OPTION], warning = sanitize_choice_option(
+        control_args.get(REVERT_MODE_OPTION, None), REVERT_MODE_OPTION, [REVERT_MODE_STORAGE, REVERT_MODE_TOKEN],
+        DEFAULT_CONTROL_OPTIONS[REVERT_MODE_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    if options[REVERT_MODE_OPTION] == REVERT_MODE_TOKEN and revert_token_keyring is None:
+        options[REVERT_MODE_OPTION] = REVERT_MODE_STORAGE
+        warnings.append(f"{REVERT_MODE_OPTION} parameter \'{REVERT_MODE_TOKEN}\' needs revert token keys. "
+                        f"Sanitized to \'{REVERT_MODE_STORAGE}\'")
+    options[OUTPUT_FORMAT_OPTION], warning = sanitize_choice_option(
+        control_args.get(OUTPUT_FORMAT_OPTION, None), OUTPUT_FORMAT_OPTION, S3Facade.OUTPUT_FORMATS,
+        DEFAULT_CONTROL_OPTIONS[OUTPUT_FORMAT_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    if options[OUTPUT_FORMAT_OPTION] in S3Facade.COLUMNAR_OUTPUT_FORMATS and not S3Facade.columnar_output_supported():
+        warnings.append(f"{OUTPUT_FORMAT_OPTION} parameter \'{options[OUTPUT_FORMAT_OPTION]}\' needs the pyarrow "
+                        f"package. Sanitized to \'{S3Facade.OUTPUT_FORMAT_JSON_LINES}\'")
+        options[OUTPUT_FORMAT_OPTION] = S3Facade.OUTPUT_FORMAT_JSON_LINES
+    if options[OUTPUT_FORMAT_OPTION] in S3Facade.COLUMNAR_OUTPUT_FORMATS:
+        compressions = S3Facade.OUTPUT_COMPRESSIONS[options[OUTPUT_FORMAT_OPTION]]
+        options[OUTPUT_COMPRESSION_OPTION], warning = sanitize_choice_option(
+            control_args.get(OUTPUT_COMPRESSION_OPTION, None), OUTPUT_COMPRESSION_OPTION, compressions,
+            compressions[0])
+        if warning is not None:
+            warnings.append(warning)
+    options[MAX_RESPONSE_BYTES_OPTION], warning = sanitize_integer_option(
+        control_args.get(MAX_RESPONSE_BYTES_OPTION, None), MAX_RESPONSE_BYTES_OPTION,
+        DEFAULT_CONTROL_OPTIONS[MAX_RESPONSE_BYTES_OPTION], MIN_MAX_RESPONSE_BYTES, LAMBDA_MAX_RESPONSE_BYTES)
+    if warning is not None:
+        warnings.append(warning)
+    options[GAZETTEER_OPTION], warning = sanitize_choice_option(
+        control_args.get(GAZETTEER_OPTION, None), GAZETTEER_OPTION, ComprehendFacade.GAZETTEER_MODES,
+        DEFAULT_CONTROL_OPTIONS[GAZETTEER_OPTION])
+    if warning is not None:
+        warnings.append(warning)
+    if options[GAZETTEER_OPTION] != ComprehendFacade.GAZETTEER_OFF and gazetteer_automaton is None:
+        warnings.append(f"{GAZETTEER_OPTION} parameter \'{options[GAZETTEER_OPTION]}\' needs a gazetteer automaton. "
+                        f"Sanitized to \'{ComprehendFacade.GAZETTEER_OFF}\'")
+        options[GAZETTEER_OPTION] = ComprehendFacade.GAZETTEER_OFF
+    return options, warnings
+
+
 def get_client_control_args(event):
     """
     :param event: the event to process
-    :return: the language code, table name, field name, results destination, and warnings
+    :return: the language code, table name, field name, or list of field names, results destination, processing
+    options, and warnings
     """
     warnings = []
     if event.get('metadata', {}).get('control', {}) and type(event['metadata']['control']) is dict:
@@ -249,18 +1208,38 @@ def get_client_control_args(event):
         table_name, warning = sanitize_table_name(control_args.get('table_name', None), 'default')
         if warning is not None:
             warnings.append(warning)
-        field_name, warning = sanitize_field_name(control_args.get('field_name', None), 'text')
+        # a list of field names is anonymized together, in place of the single field
+        field_name, warning = sanitize_field_names(control_args.get('field_names', None))
         if warning is not None:
             warnings.append(warning)
+        if field_name is None:
+            field_name, warning = sanitize_field_name(control_args.get('field_name', None), 'text')
+            if warning is not None:
+                warnings.append(warning)
         destination, warning = sanitize_results_destination(control_args.get('destination', None), DESTINATION_CLIENT)
         if warning is not None:
             warnings.append(warning)
+        options, option_warnings = get_client_control_options(control_args)
+        warnings.extend(option_warnings)
     else:
         language_code, table_name, field_name, destination = 'en', 'default', 'text', DESTINATION_CLIENT
+        options = dict(DEFAULT_CONTROL_OPTIONS)
         warnings.append("No control parameters in request. Using default values.")
     if len(warnings) == 0:
         warnings = None
-    return language_code, table_name, field_name, destination, warnings
+    return language_code, table_name, field_name, destination, options, warnings
+
+
+def get_records_from_s3(s3_key: str, input_format: str = None):
+    """
+    :param s3_key: the key of the input object in the service bucket
+    :param input_format: the format of the input object, by default guessed from the key extension
+    :return: generator of the records read lazily from the object, and any warnings
+    """
+    if input_format is None:
+        input_format = S3Facade.INPUT_FORMAT_CSV if s3_key.lower().endswith('.csv') \
+            else S3Facade.INPUT_FORMAT_JSON_LINES
+    return my_s3.read_records_from_s3(s3_key=s3_key, input_format=input_format), None
 
 
 def get_records_from_event(event):
@@ -0,0 +1,363 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.InferenceFacade as ComprehendFacade
+import anonymizer.Metrics as Metrics
+import anonymizer.PatternDetector as PatternDetector
+import anonymizer.ScrubTransforms as ScrubTransforms
+
+# Records flow between the stages in batches of this size
+PIPELINE_BATCH_SIZE = 100
+# Each queue between two stages holds this many batches per worker of the next stage
+QUEUE_BATCHES_PER_WORKER = 2
+# Batches the pipeline runs ahead of a synchronous consumer, while the consumer handles a batch
+OUTPUT_QUEUE_BATCHES = 4
+
+# Stages of the pipelines, their concurrency limits can be set with the stage_limits parameter
+STAGE_DETECT = 'detect'
+STAGE_REWRITE = 'rewrite'
+STAGE_PERSIST = 'persist'
+STAGE_FETCH = 'fetch'
+
+
+def get_stage_limits(stages: list, concurrency: int, stage_limits: dict = None) -> dict:
+    """
+    :param stages: the stages of the pipeline
+    :param concurrency: the default limit of the stages waiting on the network
+    :param stage_limits: dict of stage to the number of batches it processes at once, overriding the defaults
+    :return: dict of stage to its limit
+    """
+    # rewriting runs on the event loop, a single worker is enough
+    limits = {stage: 1 if stage == STAGE_REWRITE else max(1, concurrency) for stage in stages}
+    limits.update((stage, max(1, int(limit))) for stage, limit in (stage_limits or {}).items() if stage in limits)
+    return limits
+
+
+async def call_limited(semaphore: asyncio.Semaphore, executor, function, *args):
+    """
+    Run a blocking call on the thread pool, in the metrics context of the task, once the semaphore of its stage
+    allows it
+    :return: the result of the call
+    """
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(executor, Metrics.in_current_context(function), *args)
+
+
+async def run_calls(calls, semaphore: asyncio.Semaphore, executor):
+    """
+    Run the service calls of a pipeline step shared with the synchronous pipeline, see anonymizer.run_calls, the
+    calls of each round run concurrently, within the limit of the semaphore of the stage
+    :param calls: generator of the step, yielding (function, items) and sent the results or the exceptions raised
+    :return: the value the generator returns
+    """
+    try:
+        function, items = next(calls)
+        while True:
+            results = await asyncio.gather(*(call_limited(semaphore, executor, function, item) for item in items),
+                                           return_exceptions=True)
+            function, items = calls.send(list(results))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def feed_batches(records_to_process, batch_size: int, output_queue: asyncio.Queue, downstream_workers: int,
+                       executor) -> None:
+    """
+    Read the records in batches, on the thread pool as the records may be streamed from s3
+    """
+    batches = anonymizer.iterate_chunks(records_to_process, batch_size)
+    loop = asyncio.get_running_loop()
+    next_batch = Metrics.in_current_context(next)
+    index = 0
+    batch = await loop.run_in_executor(executor, next_batch, batches, None)
+    while batch is not None:
+        await output_queue.put((index, batch))
+        index += 1
+        batch = await loop.run_in_executor(executor, next_batch, batches, None)
+    for _ in range(downstream_workers):
+        await output_queue.put(None)
+
+
+async def run_stage(stage, input_queue: asyncio.Queue, output_queue: asyncio.Queue, workers: int,
+                    downstream_workers: int) -> None:
+    """
+    Process the batches of the input queue with workers running the stage, until each of them gets a None
+    """
+    async def work():
+        item = await input_queue.get()
+        while item is not None:
+            index, batch = item
+            await output_queue.put((index, await stage(batch)))
+            item = await input_queue.get()
+
+    await asyncio.gather(*(work() for _ in range(workers)))
+    for _ in range(downstream_workers):
+        await output_queue.put(None)
+
+
+async def run_pipeline(records_to_process, stages: list, executor, batch_size=PIPELINE_BATCH_SIZE):
+    """
+    Run the batches of records through stages connected by bounded queues, a full queue holds back the previous
+    stage so the batches in flight stay bounded
+    :param records_to_process: iterable of the records to process
+    :param stages: list of (coroutine function processing a batch, number of workers)
+    :param executor: the thread pool of the blocking calls
+    :param batch_size: the number of records in a batch
+    :return: async generator of the processed batches, in the same order as records_to_process
+    """
+    queues = [asyncio.Queue(maxsize=QUEUE_BATCHES_PER_WORKER * workers) for _, workers in stages]
+    emit_queue = asyncio.Queue(maxsize=QUEUE_BATCHES_PER_WORKER)
+    queues.append(emit_queue)
+    running = {asyncio.ensure_future(feed_batches(records_to_process, batch_size, queues[0], stages[0][1],
+                                                  executor))}
+    for position, (stage, workers) in enumerate(stages):
+        downstream_workers = stages[position + 1][1] if position + 1 < len(stages) else 1
+        running.add(asyncio.ensure_future(run_stage(stage, queues[position], queues[position + 1], workers,
+                                                     downstream_workers)))
+    pending_batches = {}
+    next_index = 0
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(emit_queue.get())
+            done, _ = await asyncio.wait(running | {getter}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done - {getter}:
+                running.discard(task)
+                # raises the error of a failed stage
+                task.result()
+            if getter not in done:
+                continue
+            item = getter.result()
+            getter = None
+            if item is None:
+                break
+            # batches are processed out of order by concurrent workers, emit them in order
+            index, batch = item
+            pending_batches[index] = batch
+            while next_index in pending_batches:
+                yield pending_batches.pop(next_index)
+                next_index += 1
+    finally:
+        if getter is not None:
+            running.add(getter)
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+
+async def generate_anonymized_batches_async(records_to_process, text_field_name, language_code='en',
+                                            packed_detection=False, concurrency=1,
+                                            pre_detection=PatternDetector.POLICY_OFF, reversible=True,
+                                            revert_mode=anonymizer.REVERT_MODE_STORAGE, stage_limits: dict = None,
+                                            batch_size=PIPELINE_BATCH_SIZE,
+                                            gazetteer=ComprehendFacade.GAZETTEER_OFF):
+    """
+    Anonymize the records through the detect, rewrite, persist and emit stages
+    :param records_to_process: iterable of the records to process
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together under one revert key
+    :param language_code: language code for the text to be anonymized
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the default number of batches the detect and persist stages process at once
+    :param pre_detection: the PatternDetector policy deciding when the remote detection can be skipped
+    :param reversible: persist the transforms and add a revert_key to the records, so they can be reverted
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :param stage_limits: dict of stage to the number of batches it processes at once, overriding concurrency
+    :param batch_size: the number of records in a batch
+    :param gazetteer: the InferenceFacade gazetteer mode, detecting the terms of the customer dictionaries
+    :return: async generator of lists of anonymized records, in the same order as records_to_process
+    """
+    limits = get_stage_limits([STAGE_DETECT, STAGE_REWRITE, STAGE_PERSIST], concurrency, stage_limits)
+    my_comprehend = anonymizer.create_inference_facade(language_code, limits[STAGE_DETECT], gazetteer)
+    my_pattern_detector = anonymizer.get_pattern_detector(language_code, pre_detection)
+    my_scrub_xform = ScrubTransforms.ScrubTransforms(language_code=language_code)
+    detect_semaphore = asyncio.Semaphore(limits[STAGE_DETECT])
+    persist_semaphore = asyncio.Semaphore(limits[STAGE_PERSIST])
+    executor = ThreadPoolExecutor(max_workers=limits[STAGE_DETECT] + limits[STAGE_PERSIST] + 1)
+
+    @Metrics.timed(Metrics.STAGE_DETECT)
+    async def detect(records):
+        texts, record_fields = anonymizer.pop_field_texts(records, text_field_name)
+        # the cache may have a DynamoDB tier, the lookups and stores run on the thread pool
+        unique_texts, detected, missing, missing_keys = await call_limited(
+            detect_semaphore, executor, anonymizer.lookup_detections, texts, my_comprehend.detection_namespace,
+            my_pattern_detector)
+        missing_texts = [unique_texts[position] for position in missing]
+        # with packed detection, the batches in flight give the concurrency, each one is packed in one slice
+        remote_detected = await run_calls(anonymizer.remote_detection_calls(
+            texts, record_fields, missing_texts, my_comprehend, packed_detection, 1), detect_semaphore, executor)
+        base_transforms_list = await call_limited(detect_semaphore, executor, anonymizer.store_detections, texts,
+                                                  unique_texts, detected, missing, missing_keys, remote_detected)
+        return records, record_fields, texts, base_transforms_list
+
+    async def rewrite(item):
+        records, record_fields, texts, base_transforms_list = item
+        return (records, record_fields) + anonymizer.rewrite_texts(texts, base_transforms_list, my_scrub_xform,
+                                                                   reversible)
+
+    @Metrics.timed(Metrics.STAGE_PERSIST)
+    async def persist(item):
+        records, record_fields, anonymized_texts, complete_transforms = item
+        if not reversible:
+            return anonymizer.build_anonymized_records(records, record_fields, anonymized_texts)
+        revert_field_name, revert_values = await run_calls(anonymizer.persistence_calls(
+            complete_transforms, record_fields, anonymized_texts, text_field_name, revert_mode), persist_semaphore,
+            executor)
+        return anonymizer.build_anonymized_records(records, record_fields, anonymized_texts, revert_field_name,
+                                                   revert_values)
+
+    batches = run_pipeline(records_to_process, [(detect, limits[STAGE_DETECT]), (rewrite, limits[STAGE_REWRITE]),
+                                                (persist, limits[STAGE_PERSIST])], executor, batch_size)
+    try:
+        async for batch in batches:
+            yield batch
+    finally:
+        await batches.aclose()
+        executor.shutdown(wait=False)
+
+
+async def generate_reverted_batches_async(records_to_process, text_field_name, concurrency=1,
+                                          stage_limits: dict = None, batch_size=PIPELINE_BATCH_SIZE):
+    """
+    Revert the records through the fetch, rewrite and emit stages
+    :param records_to_process: iterable of the records to revert
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together
+    :param concurrency: the default number of batches the fetch stage processes at once
+    :param stage_limits: dict of stage to the number of batches it processes at once, overriding concurrency
+    :param batch_size: the number of records in a batch
+    :return: async generator of lists of reverted records, in the same order as records_to_process
+    """
+    limits = get_stage_limits([STAGE_FETCH, STAGE_REWRITE], concurrency, stage_limits)
+    my_pii_anon = ScrubTransforms.ScrubTransforms()
+    fetch_semaphore = asyncio.Semaphore(limits[STAGE_FETCH])
+    executor = ThreadPoolExecutor(max_workers=limits[STAGE_FETCH] + 1)
+
+    @Metrics.timed(Metrics.STAGE_FETCH)
+    async def fetch(records):
+        return records, await run_calls(anonymizer.fetch_calls(records, text_field_name), fetch_semaphore, executor)
+
+    async def rewrite(item):
+        records, saved_transforms = item
+        return anonymizer.build_reverted_records(records, text_field_name, saved_transforms, my_pii_anon)
+
+    batches = run_pipeline(records_to_process, [(fetch, limits[STAGE_FETCH]), (rewrite, limits[STAGE_REWRITE])],
+                           executor, batch_size)
+    try:
+        async for batch in batches:
+            yield batch
+    finally:
+        await batches.aclose()
+        executor.shutdown(wait=False)
+
+
+async def anonymize_records_async(records_to_process: list, text_field_name, language_code='en',
+                                  packed_detection=False, concurrency=1, pre_detection=PatternDetector.POLICY_OFF,
+                                  reversible=True, revert_mode=anonymizer.REVERT_MODE_STORAGE,
+                                  stage_limits: dict = None, gazetteer=ComprehendFacade.GAZETTEER_OFF) -> list:
+    """
+    :param records_to_process: set of records to process
+    :param text_field_name: name of the field containing the text to be anonymized, or list of the names of the
+    fields anonymized together under one revert key
+    :param language_code: language code for the text to be anonymized
+    :param packed_detection: pack the texts of many records into each detection request
+    :param concurrency: the default number of batches the detect and persist stages process at once
+    :param pre_detection: the PatternDetector policy deciding when the remote detection can be skipped
+    :param reversible: persist the transforms and add a revert_key to the records, so they can be reverted
+    :param revert_mode: REVERT_MODE_STORAGE, or REVERT_MODE_TOKEN to add a revert_token instead of persisting
+    :param stage_limits: dict of stage to the number of batches it processes at once, overriding concurrency
+    :param gazetteer: the InferenceFacade gazetteer mode, detecting the terms of the customer dictionaries
+    :return: list of anonymized records
+    """
+    anonymized_records = []
+    async for batch in generate_anonymized_batches_async(
+            records_to_process, text_field_name, language_code=language_code, packed_detection=packed_detection,
+            concurrency=concurrency, pre_detection=pre_detection, reversible=reversible, revert_mode=revert_mode,
+            stage_limits=stage_limits, gazetteer=gazetteer):
+        anonymized_records.extend(batch)
+    return anonymized_records
+
+
+async def revert_records_async(records_to_process: list, text_field_name, concurrency=1,
+                               stage_limits: dict = None) -> list:
+    """
+    :param records_to_process: the records to revert
+    :param text_field_name: the name of the field containing the text to be anonymized, or list of the names of
+    the fields anonymized together
+    :param concurrency: the default number of batches the fetch stage processes at once
+    :param stage_limits: dict of stage to the number of batches it processes at once, overriding concurrency
+    :return: list of reverted records
+    """
+    reverted_records = []
+    async for batch in generate_reverted_batches_async(records_to_process, text_field_name,
+                                                       concurrency=concurrency, stage_limits=stage_limits):
+        reverted_records.extend(batch)
+    return reverted_records
+
+
+def iterate_batches(batches, max_queued_batches: int = OUTPUT_QUEUE_BATCHES):
+    """
+    Drive an async generator of batches from synchronous code, on an event loop of its own thread
+    The pipeline keeps running while the caller handles a batch, its batches wait in a bounded queue
+    :param batches: async generator of lists of records
+    :param max_queued_batches: the number of batches the pipeline runs ahead of the caller
+    :return: generator of the records
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='pipeline', daemon=True)
+    thread.start()
+    output_queue = asyncio.Queue(maxsize=max_queued_batches)
+
+    async def produce():
+        # the end of the batches is a None, a failure of the pipeline is handed to the caller
+        try:
+            async for batch in batches:
+                await output_queue.put(batch)
+        except Exception as error:
+            await output_queue.put(error)
+            return
+        await output_queue.put(None)
+
+    async def start():
+        return asyncio.ensure_future(produce())
+
+    async def stop(producer):
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        await batches.aclose()
+        await loop.shutdown_asyncgens()
+
+    # the tasks run in the context of the caller, recording in its metrics
+    producer = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    try:
+        while True:
+            batch = asyncio.run_coroutine_threadsafe(output_queue.get(), loop).result()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        asyncio.run_coroutine_threadsafe(stop(producer), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def generate_anonymized_records(records_to_process, text_field_name, **kwargs):
+    """
+    Synchronous wrapper of generate_anonymized_batches_async, with the same parameters
+    :return: generator of the anonymized records, in the same order as records_to_process
+    """
+    return iterate_batches(generate_anonymized_batches_async(records_to_process, text_field_name, **kwargs))
+
+
+def generate_reverted_records(records_to_process, text_field_name, **kwargs):
+    """
+    Synchronous wrapper of generate_reverted_batches_async, with the same parameters
+    :return: generator of the reverted records, in the same order as records_to_process
+    """
+    return iterate_batches(generate_reverted_batches_async(records_to_process, text_field_name, **kwargs))
@@ -1,7 +1,35 @@
 import json
+import os
+import random
+import time
 import anonymizer.anonymizer as anonymizer
+import anonymizer.anonymizer_async as anonymizer_async
+import anonymizer.Metrics as Metrics
 
 VERBOSE = True
+# Emit the metrics of each invocation as an embedded metric format log line
+EMIT_METRICS = True
+# Fraction of the events logged, with at most LOG_SAMPLE_MAX_RECORDS of their records
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+LOG_SAMPLE_MAX_RECORDS = 3
+# Response header with the number of records that failed, the records themselves have an error field
+FAILED_RECORDS_HEADER = 'X-Failed-Records'
+
+
+def log_sampled_event(event) -> None:
+    """
+    Log a sample of the events, truncated to their first records, so large requests are not slowed down
+    :param event: the lambda event
+    :return: None
+    """
+    if random.random() >= LOG_SAMPLE_RATE:
+        return
+    records = event.get('records') if isinstance(event, dict) else None
+    sample = {key: value for key, value in event.items() if key != 'records'} if isinstance(event, dict) else {}
+    if isinstance(records, list):
+        sample['records'] = records[:LOG_SAMPLE_MAX_RECORDS]
+        sample['record_count'] = len(records)
+    print("Sampled event: " + json.dumps(sample, default=str))
 
 
 def lambda_handler(event, context):
@@ -13,27 +41,59 @@ def lambda_handler(event, context):
     :return: status of processing, and, if specified in the request, the transformed records
     """
 
+    start_time = time.perf_counter()
+    metrics = Metrics.reset()
+    log_sampled_event(event)
+
     # Access and validate the control parameters embedded in the event (event->metadata->controls)
-    language_code, table_name, field_name, destination, warnings = anonymizer.get_client_control_args(event)
+    with metrics.timer(Metrics.STAGE_CONTROL):
+        language_code, table_name, field_name, destination, options, warnings = \
+            anonymizer.get_client_control_args(event)
 
-    # Get the records from the input event
-    input_records, record_warnings = anonymizer.get_records_from_event(event)
+    # Get the records from the input event, or stream them from the s3 input object
+    input_s3_key = options[anonymizer.INPUT_S3_KEY_OPTION]
+    if input_s3_key is not None:
+        input_records, record_warnings = anonymizer.get_records_from_s3(input_s3_key,
+                                                                        options[anonymizer.INPUT_FORMAT_OPTION])
+        # batch jobs are too large to return to the client, the output is written to s3
+        destination = anonymizer.DESTINATION_S3
+    else:
+        input_records, record_warnings = anonymizer.get_records_from_event(event)
 
-    # Anonymize the records
-    anonymized_records = anonymizer.anonymize_records(records_to_process=input_records,
-                                                      text_field_name=field_name, language_code=language_code)
+    # Anonymize the records through the staged pipeline, lazily so they are streamed to s3 as they are produced
+    anonymized_records = anonymizer_async.generate_anonymized_records(
+        records_to_process=input_records, text_field_name=field_name, language_code=language_code,
+        packed_detection=options[anonymizer.PACKED_DETECTION_OPTION],
+        concurrency=options[anonymizer.CONCURRENCY_OPTION],
+        pre_detection=options[anonymizer.PRE_DETECTION_OPTION],
+        reversible=options[anonymizer.REVERSIBLE_OPTION],
+        revert_mode=options[anonymizer.REVERT_MODE_OPTION],
+        gazetteer=options[anonymizer.GAZETTEER_OPTION])
 
-    # Prepare the output for the client app and write records to s3 if appropriate
-    result_to_client = anonymizer.output_results(anonymized_records, destination,
-                                                 anonymizer.ANONYMIZER_MODE, table_name)
+    # Prepare the output for the client app and write records to s3 if appropriate, the output stage excludes
+    # the time spent producing the records
+    with metrics.timer(Metrics.STAGE_OUTPUT) as output_timer:
+        result_to_client = anonymizer.output_results(output_timer.exclude(anonymized_records), destination,
+                                                     anonymizer.ANONYMIZER_MODE, table_name,
+                                                     options[anonymizer.OUTPUT_FORMAT_OPTION],
+                                                     options[anonymizer.OUTPUT_COMPRESSION_OPTION],
+                                                     options[anonymizer.MAX_RESPONSE_BYTES_OPTION])
+    metrics.record_latency(Metrics.STAGE_INVOCATION, (time.perf_counter() - start_time) * 1000)
+    # the failed records carry an error field, their number is reported with the response
+    failed_records = metrics.counters.get(Metrics.FAILED_RECORDS, 0)
+    if failed_records:
+        result_to_client['headers'][FAILED_RECORDS_HEADER] = str(failed_records)
 
-    if VERBOSE:
-        print("Received event: " + json.dumps(event, indent=2))
+    if EMIT_METRICS:
+        metrics.emit({'mode': anonymizer.ANONYMIZER_MODE, 'language_code': language_code})
 
+    if VERBOSE:
         print(f"language_code: {language_code}, table_name: {table_name}, field_name: {field_name}, "
-              f"destination: {destination}, warnings: {warnings}")
+              f"destination: {destination}, options: {options}, warnings: {warnings}")
         if record_warnings is not None:
             print(f"warnings: {record_warnings}")
+        elif input_s3_key is not None:
+            print(f"Records streamed from s3 object {input_s3_key}")
         else:
             print(f"There were {len(input_records)} records to process")
 
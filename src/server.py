@@ -0,0 +1,272 @@
+import argparse
+import http.server
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.app as app
+import anonymizer.JsonCodec as JsonCodec
+import anonymizer.Metrics as Metrics
+import anonymizer.MicroBatcher as MicroBatcher
+import anonymizer.RateLimiter as RateLimiter
+
+VERBOSE = False
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# The requests are lambda events, posted to the path of the processing
+ANONYMIZE_PATH = '/anonymize'
+REVERT_PATH = '/revert'
+MODES_BY_PATH = {ANONYMIZE_PATH: anonymizer.ANONYMIZER_MODE, REVERT_PATH: anonymizer.REVERT_MODE}
+HEALTH_PATH = '/health'
+STATS_PATH = '/stats'
+MAX_REQUEST_BYTES = 32 * 1024 * 1024
+# Connections waiting to be accepted, many clients connect at once to a batching server, socketserver allows 5
+LISTEN_BACKLOG = 128
+# Detection and persistence requests each batch runs in parallel, in place of the concurrency option of the requests
+DEFAULT_BATCH_CONCURRENCY = 4
+
+
+def batch_key(mode: str, language_code: str, field_name, options: dict) -> tuple:
+    """
+    :param mode: ANONYMIZER_MODE or REVERT_MODE
+    :param language_code: the language code of the request
+    :param field_name: the name of the text field, or list of the names of the text fields
+    :param options: the processing options of the request
+    :return: the processing options the records of a request share a batch by, the output options are applied to
+    each request
+    """
+    field_names = field_name if isinstance(field_name, str) else tuple(field_name)
+    if mode == anonymizer.REVERT_MODE:
+        return mode, field_names
+    return (mode, language_code, field_names, options[anonymizer.PACKED_DETECTION_OPTION],
+            options[anonymizer.PRE_DETECTION_OPTION], options[anonymizer.REVERSIBLE_OPTION],
+            options[anonymizer.REVERT_MODE_OPTION], options[anonymizer.GAZETTEER_OPTION])
+
+
+def as_text_field_name(field_names):
+    """
+    :param field_names: the name of the text field, or tuple of the names of the text fields, from a batch key
+    :return: the text_field_name parameter of the processing
+    """
+    return field_names if isinstance(field_names, str) else list(field_names)
+
+
+def create_batch_processor(metrics: Metrics.MetricsRecorder, concurrency: int = DEFAULT_BATCH_CONCURRENCY):
+    """
+    :param metrics: the recorder of the server, the metrics of each batch are added to it once it is processed
+    :param concurrency: the number of detection and persistence requests each batch runs in parallel
+    :return: the function processing the records of a batch, by the key returned by batch_key
+    """
+    def process_batch(key: tuple, records: list) -> list:
+        # the batches processed at once each record in their own recorder
+        batch_metrics = Metrics.reset()
+        try:
+            if key[0] == anonymizer.REVERT_MODE:
+                _, field_names = key
+                return anonymizer.revert_records(records, as_text_field_name(field_names), concurrency=concurrency)
+            _, language_code, field_names, packed_detection, pre_detection, reversible, revert_mode, gazetteer = key
+            return anonymizer.anonymize_records(records, as_text_field_name(field_names),
+                                                language_code=language_code, packed_detection=packed_detection,
+                                                concurrency=concurrency, pre_detection=pre_detection,
+                                                reversible=reversible, revert_mode=revert_mode, gazetteer=gazetteer)
+        finally:
+            metrics.merge(batch_metrics)
+    return process_batch
+
+
+def error_output(status_code: int, message: str) -> dict:
+    """
+    :return: dict that includes the status, headers, and the error message in the body
+    """
+    return {'statusCode': status_code,
+            'headers': {'Content-Type': 'application/json'},
+            'body': JsonCodec.dumps_text({anonymizer.ERROR_FIELD_NAME: message})}
+
+
+def handle_event(event: dict, mode: str, batcher: MicroBatcher.MicroBatcher,
+                 metrics: Metrics.MetricsRecorder) -> dict:
+    """
+    Anonymize or revert the records of a request, in a batch shared with the concurrent requests
+    :param event: the request, a lambda event with the control parameters and the records
+    :param mode: ANONYMIZER_MODE or REVERT_MODE
+    :param batcher: the MicroBatcher coalescing the records of the requests
+    :param metrics: the recorder of the server, the metrics of the request are added to it once it is processed
+    :return: dict that includes status, headers, and body, as returned by the lambda handler
+    """
+    # the processing of the request outside of the batches, a batch job or the output, records on its own
+    request_metrics = Metrics.reset()
+    try:
+        return process_event(event, mode, batcher)
+    finally:
+        metrics.merge(request_metrics)
+
+
+def process_event(event: dict, mode: str, batcher: MicroBatcher.MicroBatcher) -> dict:
+    """
+    :return: dict that includes status, headers, and body, as returned by the lambda handler
+    """
+    language_code, table_name, field_name, destination, options, warnings = \
+        anonymizer.get_client_control_args(event)
+    input_s3_key = options[anonymizer.INPUT_S3_KEY_OPTION]
+    if input_s3_key is not None and mode == anonymizer.ANONYMIZER_MODE:
+        # a batch job is streamed from s3 to s3 on its own, as by the lambda handler
+        input_records, _ = anonymizer.get_records_from_s3(input_s3_key, options[anonymizer.INPUT_FORMAT_OPTION])
+        results = anonymizer.generate_anonymized_records(
+            records_to_process=input_records, text_field_name=field_name, language_code=language_code,
+            packed_detection=options[anonymizer.PACKED_DETECTION_OPTION],
+            concurrency=options[anonymizer.CONCURRENCY_OPTION],
+            pre_detection=options[anonymizer.PRE_DETECTION_OPTION], reversible=options[anonymizer.REVERSIBLE_OPTION],
+            revert_mode=options[anonymizer.REVERT_MODE_OPTION], gazetteer=options[anonymizer.GAZETTEER_OPTION])
+        destination = anonymizer.DESTINATION_S3
+    else:
+        input_records, record_warnings = anonymizer.get_records_from_event(event)
+        if record_warnings is not None or not isinstance(input_records, list):
+            return error_output(400, record_warnings or "The records of the request are not a list")
+        results = batcher.process(batch_key(mode, language_code, field_name, options), input_records)
+    output = anonymizer.output_results(results, destination, mode, table_name,
+                                       options[anonymizer.OUTPUT_FORMAT_OPTION],
+                                       options[anonymizer.OUTPUT_COMPRESSION_OPTION],
+                                       options[anonymizer.MAX_RESPONSE_BYTES_OPTION])
+    if isinstance(results, list):
+        failed_records = sum(1 for record in results if anonymizer.ERROR_FIELD_NAME in record)
+        if failed_records:
+            output['headers'][app.FAILED_RECORDS_HEADER] = str(failed_records)
+    if VERBOSE and warnings is not None:
+        print(f"warnings: {warnings}")
+    return output
+
+
+def get_stats(batcher: MicroBatcher.MicroBatcher, metrics: Metrics.MetricsRecorder) -> dict:
+    """
+    :return: the counters of the batcher, of the processing since the server started, and of the shared caches
+    """
+    with metrics.lock:
+        counters = dict(metrics.counters)
+    return {'batcher': batcher.stats(),
+            'counters': counters,
+            'detection_cache': anonymizer.detection_cache.stats(),
+            'pattern_detection': anonymizer.pattern_detector_stats(),
+            'rate_limiters': RateLimiter.stats()}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler of the requests of a connection, the connection is kept open between requests
+    """
+
+    # HTTP/1.1 keeps the connections alive, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == HEALTH_PATH:
+            self.send_output({'statusCode': 200, 'headers': {'Content-Type': 'application/json'},
+                              'body': JsonCodec.dumps_text({'status': 'ok'})})
+        elif self.path == STATS_PATH:
+            self.send_output({'statusCode': 200, 'headers': {'Content-Type': 'application/json'},
+                              'body': JsonCodec.dumps_text(get_stats(self.server.batcher, self.server.metrics))})
+        else:
+            self.send_output(error_output(404, f"Unknown path \'{self.path}\'"))
+
+    def do_POST(self):
+        mode = MODES_BY_PATH.get(self.path)
+        length = self.headers.get('Content-Length')
+        if length is None or not length.isdigit() or int(length) > MAX_REQUEST_BYTES:
+            # the body can not be skipped, the connection is closed after the response
+            self.close_connection = True
+            self.send_output(error_output(411 if length is None else 413,
+                                          f"The request needs a Content-Length of at most {MAX_REQUEST_BYTES}"))
+            return
+        body = self.rfile.read(int(length))
+        if mode is None:
+            self.send_output(error_output(404, f"Unknown path \'{self.path}\'"))
+            return
+        try:
+            event = JsonCodec.loads(body)
+        except ValueError as error:
+            self.send_output(error_output(400, f"The request is not a JSON document: {error}"))
+            return
+        if not isinstance(event, dict):
+            self.send_output(error_output(400, "The request is not a JSON object"))
+            return
+        try:
+            output = handle_event(event, mode, self.server.batcher, self.server.metrics)
+        except Exception as error:
+            output = error_output(500, anonymizer.describe_error(error))
+        self.send_output(output)
+
+    def send_output(self, output: dict) -> None:
+        """
+        Send the output of the lambda handler as the response
+        :param output: dict that includes status, headers, and body
+        :return: None
+        """
+        body = output.get('body', '').encode('utf-8')
+        self.send_response(output['statusCode'])
+        for name, value in output['headers'].items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if VERBOSE:
+            super().log_message(format, *args)
+
+
+class BatchingHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server handling each connection in a thread of its own, the requests share the batches of its MicroBatcher
+    """
+
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, server_address, batcher: MicroBatcher.MicroBatcher, metrics: Metrics.MetricsRecorder):
+        self.batcher = batcher
+        self.metrics = metrics
+        super().__init__(server_address, RequestHandler)
+
+
+def create_server(batcher: MicroBatcher.MicroBatcher, metrics: Metrics.MetricsRecorder, host: str = DEFAULT_HOST,
+                  port: int = DEFAULT_PORT) -> BatchingHTTPServer:
+    """
+    :param batcher: the MicroBatcher coalescing the records of the requests
+    :param metrics: the recorder the batches and the requests add their metrics to, the one of the batch processor
+    :param host: the address to listen on
+    :param port: the port to listen on, 0 for any free port
+    :return: the server, a thread per connection, call serve_forever to handle the requests
+    """
+    return BatchingHTTPServer((host, port), batcher, metrics)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local HTTP service anonymizing and reverting records, the records '
+                                                 'of concurrent requests are processed in shared batches')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-batch-records', type=int, default=MicroBatcher.DEFAULT_MAX_BATCH_RECORDS)
+    parser.add_argument('--max-wait-ms', type=float, default=MicroBatcher.DEFAULT_MAX_WAIT_SECONDS * 1000)
+    parser.add_argument('--workers', type=int, default=MicroBatcher.DEFAULT_WORKERS)
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_BATCH_CONCURRENCY)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def main() -> None:
+    global VERBOSE
+    args = parse_args()
+    VERBOSE = args.verbose
+    metrics = Metrics.MetricsRecorder()
+    batcher = MicroBatcher.MicroBatcher(create_batch_processor(metrics, args.concurrency),
+                                        max_batch_records=args.max_batch_records,
+                                        max_wait_seconds=args.max_wait_ms / 1000, workers=args.workers)
+    server = create_server(batcher, metrics, args.host, args.port)
+    print(f"Listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+if __name__ == '__main__':
+    main()
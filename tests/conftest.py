@@ -0,0 +1,14 @@
+"""
+Make the src directory importable as the anonymizer package for the tests, as the benchmarks do
+"""
+import os
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'benchmarks'))
+# the facades build their clients lazily, a region is all boto3 needs to create them
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import bootstrap  # noqa: E402
+
+bootstrap.register_package()
@@ -0,0 +1,173 @@
+import copy
+import json
+
+import pytest
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.JsonCodec as JsonCodec
+import anonymizer.Metrics as Metrics
+import anonymizer.S3Facade as S3Facade
+import anonymizer.TransformCodec as TransformCodec
+import corpus
+import stand_ins
+
+FIELD_NAMES = ['text', 'notes', 'summary']
+
+
+@pytest.fixture
+def services():
+    services = stand_ins.StandIns(corpus.vocabulary('en'))
+    services.install()
+    yield services
+    ClientRegistry.reset()
+
+
+def generate_records(count: int, seed: int) -> list:
+    texts = [record['text'] for record in corpus.generate_records(count * 3, 200, 0.2, seed=seed)]
+    return [{'id': index, 'text': texts[3 * index], 'notes': texts[3 * index + 1], 'summary': texts[3 * index + 2]}
+            for index in range(count)]
+
+
+def test_pop_field_texts():
+    records = [{'id': 0, 'text': "a", 'notes': "b"}, {'id': 1, 'notes': 7, 'text': "c"}, {'id': 2, 'summary': None}]
+    texts, record_fields = anonymizer.pop_field_texts(records, FIELD_NAMES)
+    assert texts == ["a", "b", "c"]
+    assert record_fields == [['text', 'notes'], ['text'], []]
+    # a value that is not a string is left in the record
+    assert records == [{'id': 0}, {'id': 1, 'notes': 7}, {'id': 2, 'summary': None}]
+    records = [{'id': 0, 'text': "a"}, {'id': 1}]
+    assert anonymizer.pop_field_texts(records, 'text') == (["a", "No text provided"], [['text'], ['text']])
+
+
+def test_combine_field_transforms():
+    transforms = [{'Transforms': [index]} for index in range(4)]
+    error = KeyError('boom')
+    record_fields = [['text', 'notes'], [], ['summary'], ['text', 'summary']]
+    assert anonymizer.combine_field_transforms(transforms[:2] + [transforms[2], error], record_fields,
+                                               FIELD_NAMES) == [
+        {TransformCodec.FIELDS_KEY: {'text': transforms[0], 'notes': transforms[1]}},
+        {TransformCodec.FIELDS_KEY: {}},
+        {TransformCodec.FIELDS_KEY: {'summary': transforms[2]}},
+        # a failed field fails its record
+        error]
+    # the transforms of a single field are kept as they are
+    assert anonymizer.combine_field_transforms(transforms, [['text']] * 4, 'text') is transforms
+
+
+def test_group_field_texts():
+    error = KeyError('boom')
+    assert anonymizer.group_field_texts([['text', 'notes'], [], ['summary']], ["a", "b", error]) == \
+        [{'text': "a", 'notes': "b"}, {}, {'summary': error}]
+
+
+@pytest.mark.parametrize('field_names, expected', [
+    (None, (None, None)),
+    (['text', 'notes'], (['text', 'notes'], None)),
+    ("text, notes", (['text', 'notes'], None)),
+    (['text', 'text', 'notes'], (['text', 'notes'], "contains unacceptable field names")),
+    (['text', 'my-notes', '!'], (['text', 'my_notes'], "contains unacceptable field names")),
+    (['text', 3], (None, "is not a list of field names")),
+    ({'text': 1}, (None, "is not a list of field names")),
+    (" , ", (None, "has no field name")),
+])
+def test_sanitize_field_names(field_names, expected):
+    sanitized, warning = anonymizer.sanitize_field_names(field_names)
+    assert sanitized == expected[0]
+    assert warning is None if expected[1] is None else expected[1] in warning
+
+
+def test_field_names_take_the_place_of_the_field_name():
+    event = {'metadata': {'control': {'language_code': 'en', 'destination': anonymizer.DESTINATION_CLIENT,
+                                      'field_name': 'body', 'field_names': "text,notes"}}}
+    _, _, field_name, _, _, warnings = anonymizer.get_client_control_args(event)
+    assert field_name == ['text', 'notes'] and warnings is None
+    event['metadata']['control']['field_names'] = []
+    _, _, field_name, _, _, warnings = anonymizer.get_client_control_args(event)
+    assert field_name == 'body' and len(warnings) == 1
+
+
+@pytest.mark.parametrize('packed_detection', [False, True])
+def test_round_trip_of_several_fields(services, packed_detection):
+    records = generate_records(6, seed=4)
+    # a record without some of the fields, a value that is not a string, and a record without any of the fields
+    records[1].pop('notes')
+    records[2]['summary'] = 42
+    records[3]['notes'] = None
+    records[4] = {'id': 4}
+    anonymized = anonymizer.anonymize_records(copy.deepcopy(records), FIELD_NAMES, packed_detection=packed_detection,
+                                              concurrency=2)
+    assert [set(record) for record in anonymized] == [set(record) | {'revert_key'} for record in records]
+    for record, anonymized_record in zip(records, anonymized):
+        for field_name in FIELD_NAMES:
+            if isinstance(record.get(field_name), str):
+                assert anonymized_record[field_name] != record[field_name]
+            else:
+                assert anonymized_record.get(field_name, 'missing') == record.get(field_name, 'missing')
+    assert anonymizer.revert_records(anonymized, FIELD_NAMES) == records
+
+
+def test_fields_of_a_record_are_detected_together(services):
+    records = generate_records(5, seed=6)
+    anonymizer.anonymize_records(records, FIELD_NAMES, packed_detection=True)
+    assert services.comprehend.model.stats()['calls'] < 5 * len(FIELD_NAMES)
+
+
+def test_fields_are_reverted_with_the_fields_of_their_transform(services):
+    records = generate_records(2, seed=8)
+    anonymized = anonymizer.anonymize_records(copy.deepcopy(records), ['text', 'notes'])
+    # the transform of the record names its fields, the summary was not anonymized and stays as it is
+    assert anonymizer.revert_records(copy.deepcopy(anonymized), FIELD_NAMES) == records
+    # a single field name does not match a multi-field transform, the fields are reverted all the same
+    assert anonymizer.revert_records(anonymized, 'text') == records
+
+
+def spilled_records(services, body: str) -> list:
+    location = JsonCodec.loads(body)
+    bucket_name, s3_key = location['output_location'].split('/', 1)
+    lines = services.s3.objects[(bucket_name, s3_key)].splitlines()
+    assert location['record_count'] == len(lines)
+    return [JsonCodec.loads(line) for line in lines]
+
+
+def test_small_response_is_returned_inline(services):
+    records = generate_records(5, seed=3)
+    for max_response_bytes in [None, anonymizer.DEFAULT_MAX_RESPONSE_BYTES]:
+        output = anonymizer.output_results_to_client(iter(records), max_response_bytes)
+        assert JsonCodec.loads(output['body']) == records
+    assert services.s3.objects == {}
+
+
+def test_large_response_is_spilled_to_s3(services):
+    records = generate_records(50, seed=3)
+    records[1]['text'] = "Zoë \"quoted\" \\ 東京"
+    metrics = Metrics.reset()
+    output = anonymizer.output_results_to_client((record for record in records), anonymizer.MIN_MAX_RESPONSE_BYTES,
+                                                 anonymizer.ANONYMIZER_MODE, 'customers')
+    assert output['statusCode'] == 200
+    assert set(JsonCodec.loads(output['body'])) == {'output_location', 'record_count'}
+    assert spilled_records(services, output['body']) == records
+    (s3_key,) = [s3_key for _, s3_key in services.s3.objects]
+    assert s3_key.startswith(f"{S3Facade.ANONYMIZER_ROOT_PATH}customers/")
+    assert metrics.counters[Metrics.SPILLED_RESPONSES] == 1
+
+
+def test_spill_threshold_is_the_escaped_size_of_the_response(services):
+    records = generate_records(5, seed=3)
+    records[2]['notes'] = "naïve \"café\" \\ ✓"
+    # the lambda response escapes the body once more, non-ASCII characters as \u escapes
+    escaped_size = len(json.dumps(JsonCodec.dumps_text(records))) - 2
+    inline_sizes = []
+    for max_response_bytes in range(escaped_size - 20, escaped_size + 20):
+        output = anonymizer.output_results_to_client(records, max_response_bytes)
+        if 'output_location' in output['body']:
+            assert spilled_records(services, output['body']) == records
+        else:
+            assert JsonCodec.loads(output['body']) == records
+            inline_sizes.append(max_response_bytes)
+    # the size of a response is estimated from above, within a few bytes for a few non-ASCII characters
+    assert escaped_size <= inline_sizes[0] < escaped_size + 10
+    assert inline_sizes == list(range(inline_sizes[0], escaped_size + 20))
+    for record in records:
+        document = JsonCodec.dumps(record)
+        assert anonymizer.estimate_escaped_size(document) >= len(json.dumps(document.decode('utf-8'))) - 2
@@ -0,0 +1,74 @@
+import asyncio
+import copy
+import threading
+
+import pytest
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.anonymizer_async as anonymizer_async
+import anonymizer.ClientRegistry as ClientRegistry
+import corpus
+import stand_ins
+
+
+async def generate_batches(count: int, produced: list, closed: threading.Event = None, failure: Exception = None):
+    try:
+        for index in range(count):
+            await asyncio.sleep(0)
+            produced.append(index)
+            yield [index]
+        if failure is not None:
+            raise failure
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+def test_pipeline_runs_while_the_caller_handles_a_batch():
+    produced = []
+    records = anonymizer_async.iterate_batches(generate_batches(10, produced), max_queued_batches=2)
+    assert next(records) == 0
+    # the caller holds the first batch, the pipeline fills the queue meanwhile
+    for _ in range(100):
+        if len(produced) >= 4:
+            break
+        threading.Event().wait(0.01)
+    assert produced == [0, 1, 2, 3]
+    assert list(records) == list(range(1, 10))
+
+
+def test_failure_of_the_pipeline_is_raised_to_the_caller():
+    records = anonymizer_async.iterate_batches(generate_batches(3, [], failure=KeyError('boom')))
+    assert [next(records) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(KeyError):
+        next(records)
+
+
+def test_closing_the_records_closes_the_pipeline():
+    closed = threading.Event()
+    records = anonymizer_async.iterate_batches(generate_batches(100, [], closed), max_queued_batches=1)
+    assert next(records) == 0
+    records.close()
+    assert closed.is_set()
+
+
+@pytest.mark.parametrize('text_field_name', ['text', ['text', 'notes']])
+@pytest.mark.parametrize('packed_detection', [False, True])
+def test_pipelines_share_their_steps(text_field_name, packed_detection):
+    stand_ins.StandIns(corpus.vocabulary('en')).install()
+    try:
+        records = [{'id': index, 'text': record['text'], 'notes': record['text'][::-1]}
+                   for index, record in enumerate(corpus.generate_records(30, 200, 0.2, seed=5))]
+        results = []
+        for anonymize in [anonymizer.anonymize_records,
+                          lambda *args, **kwargs: asyncio.run(anonymizer_async.anonymize_records_async(*args,
+                                                                                                       **kwargs))]:
+            anonymized = anonymize(copy.deepcopy(records), text_field_name, packed_detection=packed_detection,
+                                   concurrency=4)
+            assert anonymizer.revert_records(copy.deepcopy(anonymized), text_field_name, concurrency=4) == records
+            assert asyncio.run(anonymizer_async.revert_records_async(anonymized, text_field_name)) == records
+            results.append([{name: value for name, value in record.items() if name != 'revert_key'}
+                            for record in anonymized])
+        assert results[0] == results[1]
+    finally:
+        ClientRegistry.reset()
@@ -0,0 +1,73 @@
+import botocore.exceptions
+
+import anonymizer.DetectionCache as DetectionCache
+import anonymizer.Metrics as Metrics
+
+TRANSFORMS = {'Transforms': [{'Type': 'NAME', 'BeginOffset': 0, 'EndOffset': 4, 'Original': "", 'Anonymized': ""}]}
+
+
+class DictTier:
+    """
+    Persistent tier kept in a dict
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get_many(self, keys: list) -> dict:
+        return {key: self.entries[key] for key in keys if key in self.entries}
+
+    def put_many(self, entries: dict) -> None:
+        self.entries.update(entries)
+
+
+class FailingTier:
+    """
+    Persistent tier whose service calls fail
+    """
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def get_many(self, keys: list) -> dict:
+        raise self.error
+
+    def put_many(self, entries: dict) -> None:
+        raise self.error
+
+
+def test_persistent_tier_fills_the_in_process_tier():
+    tier = DictTier()
+    DetectionCache.DetectionCache(persistent_tier=tier).put_many(['a'], [TRANSFORMS])
+    cache = DetectionCache.DetectionCache(persistent_tier=tier)
+    assert cache.get_many(['a', 'b']) == [TRANSFORMS, None]
+    assert cache.get_many(['a']) == [TRANSFORMS]
+    stats = cache.stats()
+    assert (stats['hits'], stats['persistent_hits'], stats['misses']) == (1, 1, 1)
+
+
+def test_failed_persistent_read_is_a_miss():
+    error = botocore.exceptions.ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                                            'BatchGetItem')
+    cache = DetectionCache.DetectionCache(persistent_tier=FailingTier(error))
+    assert cache.get_many(['a']) == [None]
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['persistent_errors'] == 1
+
+
+def test_failed_persistent_write_is_skipped():
+    cache = DetectionCache.DetectionCache(persistent_tier=FailingTier(
+        botocore.exceptions.EndpointConnectionError(endpoint_url='https://dynamodb.us-east-1.amazonaws.com')))
+    cache.put_many(['a'], [TRANSFORMS])
+    assert cache.get_many(['a']) == [TRANSFORMS]
+    assert cache.stats()['persistent_errors'] == 1
+
+
+def test_exhausted_retries_of_the_persistent_tier_are_counted():
+    metrics = Metrics.reset()
+    # DynamoDBFacade.backoff raises a RuntimeError once the unprocessed items stop making progress
+    cache = DetectionCache.DetectionCache(persistent_tier=FailingTier(RuntimeError('unprocessed items')))
+    cache.put_many(['a'], [TRANSFORMS])
+    assert cache.get_many(['a', 'b']) == [TRANSFORMS, None]
+    assert cache.stats()['persistent_errors'] == 2
+    assert metrics.counters[Metrics.DETECTION_CACHE_ERRORS] == 2
@@ -0,0 +1,118 @@
+import pytest
+
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.DynamoDBFacade as DynamoDBFacade
+import anonymizer.RateLimiter as RateLimiter
+
+
+def test_table_resource_is_created_once_and_single_attempt():
+    ClientRegistry.reset()
+    try:
+        dynamo = DynamoDBFacade.DynamoDBFacade('us-east-1')
+        table = dynamo.scrub_xform_table
+        assert dynamo.scrub_xform_table is table
+        # the rate limiter retries the calls of the resource, botocore makes a single attempt
+        assert table.meta.client.meta.config.retries == ClientRegistry.SINGLE_ATTEMPT_RETRIES
+        ClientRegistry.reset()
+        assert dynamo.scrub_xform_table is not table
+    finally:
+        ClientRegistry.reset()
+
+
+class ScriptedDynamoDB:
+    """
+    Low-level ddb client leaving the given number of items unprocessed in its successive batch responses
+    """
+
+    def __init__(self, unprocessed_counts: list = None):
+        self.unprocessed_counts = list(unprocessed_counts or [])
+        self.items = {}
+        self.requests = []
+
+    def unprocessed_count(self) -> int:
+        return self.unprocessed_counts.pop(0) if self.unprocessed_counts else 0
+
+    def batch_write_item(self, RequestItems: dict) -> dict:
+        ((table_name, requests),) = RequestItems.items()
+        self.requests.append(len(requests))
+        unprocessed = self.unprocessed_count()
+        for request in requests[unprocessed:]:
+            item = request['PutRequest']['Item']
+            self.items[item['guid']['S']] = item
+        return {'UnprocessedItems': {table_name: requests[:unprocessed]} if unprocessed else {}}
+
+    def batch_get_item(self, RequestItems: dict) -> dict:
+        ((table_name, request),) = RequestItems.items()
+        keys = request['Keys']
+        self.requests.append(len(keys))
+        unprocessed = self.unprocessed_count()
+        # the service returns the items in any order
+        found = [self.items[key['guid']['S']] for key in keys[unprocessed:] if key['guid']['S'] in self.items]
+        return {'Responses': {table_name: found[::-1]},
+                'UnprocessedKeys': {table_name: {'Keys': keys[:unprocessed]}} if unprocessed else {}}
+
+
+@pytest.fixture
+def scripted_client(monkeypatch):
+    # the retries do not wait, whatever the rate the throttling cuts the limiter to
+    monkeypatch.setattr(RateLimiter, 'backoff_delay', lambda attempt: 0)
+    monkeypatch.setattr(RateLimiter, 'MIN_RATE', 1e9)
+    RateLimiter.reset()
+    client = ScriptedDynamoDB()
+    ClientRegistry.reset()
+    ClientRegistry.register_client('dynamodb', client, region_name='us-east-1')
+    yield client
+    ClientRegistry.reset()
+    RateLimiter.reset()
+
+
+def create_scrub_xforms(count: int) -> list:
+    return [{'Transforms': [{'Type': 'NAME', 'BeginOffset': 0, 'EndOffset': index, 'Original': f"n{index}",
+                             'Anonymized': "x", 'AnonBeginOffset': 0, 'AnonEndOffset': 1}]} for index in range(count)]
+
+
+def test_writes_and_reads_are_chunked_to_the_limits(scripted_client):
+    dynamo = DynamoDBFacade.DynamoDBFacade('us-east-1')
+    guids = dynamo.put_scrub_xforms(create_scrub_xforms(60))
+    assert scripted_client.requests == [25, 25, 10]
+    scripted_client.requests.clear()
+    requested = guids[::-1] * 3 + ['missing'] + guids
+    found = dynamo.get_scrub_xforms(requested)
+    # duplicates are read once, in chunks of 100 keys
+    assert scripted_client.requests == [61]
+    assert found[180] is None
+    assert [scrub_xform['Transforms'][0]['EndOffset'] for scrub_xform in found[181:]] == list(range(60))
+    assert [scrub_xform['Transforms'][0]['EndOffset'] for scrub_xform in found[:60]] == list(range(59, -1, -1))
+    scripted_client.requests.clear()
+    dynamo.batch_get_items(dynamo.scrub_xform_table_name, 'guid', [f"guid-{index}" for index in range(250)])
+    assert scripted_client.requests == [100, 100, 50]
+
+
+def test_unprocessed_items_and_keys_are_retried(scripted_client):
+    dynamo = DynamoDBFacade.DynamoDBFacade('us-east-1')
+    scripted_client.unprocessed_counts = [20, 20, 5]
+    guids = dynamo.put_scrub_xforms(create_scrub_xforms(25))
+    assert scripted_client.requests == [25, 20, 20, 5]
+    assert set(scripted_client.items) == set(guids)
+    scripted_client.requests.clear()
+    scripted_client.unprocessed_counts = [10, 3]
+    found = dynamo.get_scrub_xforms(guids)
+    assert scripted_client.requests == [25, 10, 3]
+    assert [scrub_xform['Transforms'][0]['EndOffset'] for scrub_xform in found] == list(range(25))
+    assert RateLimiter.get_limiter('dynamodb').stats()['throttled'] == 5
+
+
+def test_retries_stop_when_no_progress_is_made(scripted_client):
+    dynamo = DynamoDBFacade.DynamoDBFacade('us-east-1')
+    # a request processing some of the items resets the count of the retries
+    scripted_client.unprocessed_counts = [10] * DynamoDBFacade.BATCH_MAX_RETRIES + [5] + \
+        [5] * (DynamoDBFacade.BATCH_MAX_RETRIES - 1) + [0]
+    dynamo.put_scrub_xforms(create_scrub_xforms(10))
+    scripted_client.unprocessed_counts = [10] * (DynamoDBFacade.BATCH_MAX_RETRIES + 1)
+    with pytest.raises(RuntimeError):
+        dynamo.put_scrub_xforms(create_scrub_xforms(10))
+    assert len(scripted_client.requests) == 2 * DynamoDBFacade.BATCH_MAX_RETRIES + 1 + \
+        DynamoDBFacade.BATCH_MAX_RETRIES + 1
+    scripted_client.unprocessed_counts = [1] * (DynamoDBFacade.BATCH_MAX_RETRIES + 1)
+    with pytest.raises(RuntimeError):
+        dynamo.get_scrub_xforms(['a'])
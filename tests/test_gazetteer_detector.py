@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import anonymizer.GazetteerDetector as GazetteerDetector
+
+DICTIONARIES = {
+    GazetteerDetector.CATEGORY_NAMES: ["John", "John Smith", "Smith", "O'Brien", "Élodie Dupré", "Strasse"],
+    GazetteerDetector.CATEGORY_ORGANIZATIONS: ["Smith Barney", "Bank of New York", "New York", "東京 銀行"],
+    GazetteerDetector.CATEGORY_LOCATIONS: ["York", "New York", "Montréal"],
+}
+
+
+@pytest.fixture
+def build(tmp_path):
+    automatons = []
+
+    def build(dictionaries: dict = None, require_capitalized: bool = False, name: str = 'gazetteer.bin'):
+        path = str(tmp_path / name)
+        GazetteerDetector.build_automaton(DICTIONARIES if dictionaries is None else dictionaries, path,
+                                          require_capitalized)
+        automatons.append(GazetteerDetector.GazetteerAutomaton(path))
+        return automatons[-1]
+
+    yield build
+    for automaton in automatons:
+        automaton.close()
+
+
+def find_terms(automaton: GazetteerDetector.GazetteerAutomaton, text: str) -> list:
+    return [(text[begin_offset:end_offset], automaton.categories[category_index])
+            for begin_offset, end_offset, category_index in automaton.find(text)]
+
+
+def test_overlapping_and_nested_terms(build):
+    automaton = build()
+    # the leftmost term, then the longest one, the terms nested in it or overlapping it are dropped
+    assert find_terms(automaton, "John Smith Barney of Bank of New York.") == [
+        ("John Smith", 'names'), ("Bank of New York", 'organizations')]
+    assert find_terms(automaton, "Smith Barney, New York and York") == [
+        ("Smith Barney", 'organizations'), ("New York", 'organizations'), ("York", 'locations')]
+    # the failure links find a term inside a longer partial match
+    assert find_terms(automaton, "Bank of New Jersey and John") == [("John", 'names')]
+    assert find_terms(automaton, "Bank of York") == [("York", 'locations')]
+
+
+def test_word_boundaries(build):
+    automaton = build()
+    assert find_terms(automaton, "Johnson and Smithers, JohnSmith") == []
+    # a term matches whole words whatever separates them, case folded
+    assert find_terms(automaton, "JOHN-SMITH and john\n smith") == [("JOHN-SMITH", 'names'), ("john\n smith", 'names')]
+    assert find_terms(automaton, "Straße") == [("Straße", 'names')]
+    # an apostrophe between letters is part of the word
+    assert find_terms(automaton, "O'Brien, not Brien's O'Briens") == [("O'Brien", 'names')]
+    assert find_terms(automaton, "Smith’s and d’Smith") == []
+
+
+def test_offsets_in_non_ascii_text(build):
+    automaton = build()
+    text = "😀 Zoë a vu Élodie Dupré à Montréal, près de 東京 銀行."
+    found = automaton.find(text)
+    assert [text[begin_offset:end_offset] for begin_offset, end_offset, _ in found] == \
+        ["Élodie Dupré", "Montréal", "東京 銀行"]
+    assert found[0][:2] == (text.index("Élodie"), text.index("Élodie") + len("Élodie Dupré"))
+
+
+def test_require_capitalized(build):
+    automaton = build(require_capitalized=True)
+    assert find_terms(automaton, "john smith, John smith and the new york office") == [("John smith", 'names')]
+
+
+def test_build_write_load_match(build, tmp_path):
+    terms = [f"Term{index} Word{index % 7}" for index in range(3000)]
+    dictionary_path = tmp_path / 'products.txt'
+    dictionary_path.write_text('\n'.join(terms + ["", "  "]) + '\n', encoding='utf-8')
+    path = str(tmp_path / 'products.bin')
+    stats = GazetteerDetector.build_automaton_from_files({'products': str(dictionary_path)}, path)
+    assert stats == {'terms': 3000, 'words': 3007, 'states': 6001, 'bytes': os.path.getsize(path)}
+    assert not os.path.exists(f"{path}.tmp")
+    automaton = GazetteerDetector.from_environment({GazetteerDetector.GAZETTEER_PATH_ENVIRONMENT_VARIABLE: path})
+    try:
+        assert automaton.categories == ['products']
+        text = " then ".join(terms[::97])
+        assert [text[begin_offset:end_offset] for begin_offset, end_offset, _ in automaton.find(text)] == terms[::97]
+        assert automaton.find("Term1 Word2 Term3000 Word0") == []
+        # the same dictionaries give the same fingerprint, rebuilding replaces the file of a loaded automaton
+        fingerprint = automaton.fingerprint
+        assert build({'products': terms}, name='products.bin').fingerprint == fingerprint
+        assert build({'products': terms[1:]}, name='products.bin').fingerprint != fingerprint
+        assert automaton.find(terms[0]) == [(0, len(terms[0]), 0)]
+    finally:
+        automaton.close()
+    assert GazetteerDetector.from_environment({}) is None
+
+
+def test_invalid_file(tmp_path):
+    path = tmp_path / 'invalid.bin'
+    path.write_bytes(b'NOTAGAZE' + bytes(GazetteerDetector.HEADER.size))
+    with pytest.raises(ValueError):
+        GazetteerDetector.GazetteerAutomaton(str(path))
+    with pytest.raises(ValueError):
+        GazetteerDetector.build_automaton({"names\nlocations": ["John"]}, str(tmp_path / 'categories.bin'))
+
+
+def test_detector_entities(build):
+    automaton = build({**DICTIONARIES, 'products': ["Acme Rocket"]})
+    text = "John Smith ordered an Acme Rocket in Montréal"
+    detector = GazetteerDetector.GazetteerDetector(automaton, language_code='fr')
+    assert [(transform['Type'], text[transform['BeginOffset']:transform['EndOffset']])
+            for transform in detector.detect_pii_entities(text)['Transforms']] == \
+        [('PERSON_FR', "John Smith"), ('products', "Acme Rocket"), ('LOCATION', "Montréal")]
+    # the entities overlapping a remote entity are dropped, the others are added in order
+    transforms = {'Transforms': [{'Type': 'ADDRESS', 'BeginOffset': 25, 'EndOffset': 45}]}
+    assert [transform['Type'] for transform in detector.merge_pii_entities(text, transforms)['Transforms']] == \
+        ['PERSON_FR', 'ADDRESS']
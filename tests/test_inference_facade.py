@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.InferenceFacade as InferenceFacade
+import anonymizer.RateLimiter as RateLimiter
+import corpus
+import stand_ins
+
+
+def install_stand_ins(language_code: str) -> stand_ins.StandIns:
+    vocabulary = corpus.vocabulary(language_code)
+    # an entity spanning the separator of two packed texts
+    vocabulary['PERSON'] = vocabulary['PERSON'] + ['Smith' + InferenceFacade.PACKED_SEPARATOR + 'Mary']
+    services = stand_ins.StandIns(vocabulary)
+    services.install()
+    return services
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    RateLimiter.reset()
+    yield
+    ClientRegistry.reset()
+    RateLimiter.reset()
+
+
+@pytest.mark.parametrize('language_code', ['en', 'fr'])
+def test_packed_detection_matches_unpacked_detection(language_code):
+    install_stand_ins(language_code)
+    texts = [record['text'] for record in corpus.generate_records(60, 300, 0.1, language_code, seed=3)]
+    texts[10:12] = ["a note from Smith", "Mary called twice"]
+    facade = InferenceFacade.InferenceFacade(language_code=language_code)
+    assert facade.detect_pii_entities_packed(texts) == [facade.detect_pii_entities(text) for text in texts]
+
+
+def test_entity_straddling_a_separator_is_detected_again():
+    services = install_stand_ins('en')
+    facade = InferenceFacade.InferenceFacade()
+    texts = ["a note from Smith", "Mary called twice"]
+    assert facade.detect_pii_entities_packed(texts) == [{'Transforms': []}, {'Transforms': []}]
+    # the packed request, then each text on its own
+    assert services.comprehend.model.stats()['calls'] == 3
+
+
+def test_split_text_covers_the_text_in_overlapping_chunks():
+    facade = InferenceFacade.InferenceFacade()
+    facade.max_text_size = 1000
+    text = corpus.generate_records(1, 20000, 0.1, seed=8)[0]['text'].replace(" a ", " é. ")
+    chunks = facade.split_text(text)
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+    for (start, end), (next_start, _) in zip(chunks, chunks[1:]):
+        assert facade.text_size(text[start:end]) <= facade.max_text_size
+        assert end - InferenceFacade.CHUNK_OVERLAP_CHARS <= next_start <= end
+        # chunks end and start on a boundary, no word is cut
+        assert text[end - 1].isspace() and text[next_start - 1].isspace()
+
+
+def test_merge_chunk_entities():
+    facade = InferenceFacade.InferenceFacade()
+    chunks = [(0, 100), (80, 200)]
+    chunk_entities = [[{'Type': 'NAME', 'BeginOffset': 10, 'EndOffset': 20},
+                       # cut at the end of the first chunk, whole in the second one
+                       {'Type': 'NAME', 'BeginOffset': 90, 'EndOffset': 100},
+                       {'Type': 'EMAIL', 'BeginOffset': 85, 'EndOffset': 95}],
+                      [{'Type': 'NAME', 'BeginOffset': 10, 'EndOffset': 25},
+                       # detected in both chunks
+                       {'Type': 'EMAIL', 'BeginOffset': 5, 'EndOffset': 15},
+                       {'Type': 'PHONE', 'BeginOffset': 50, 'EndOffset': 62}]]
+    assert [(entity['Type'], entity['BeginOffset'], entity['EndOffset'])
+            for entity in facade.merge_chunk_entities(chunks, chunk_entities)] == \
+        [('NAME', 10, 20), ('EMAIL', 85, 95), ('NAME', 90, 105), ('PHONE', 130, 142)]
+    # the entities of the service are not updated
+    assert chunk_entities[0][1]['EndOffset'] == 100
+
+
+def test_chunked_detection_matches_the_whole_text():
+    services = install_stand_ins('en')
+    facade = InferenceFacade.InferenceFacade()
+    facade.max_text_size = 2000
+    text = corpus.generate_records(1, 30000, 0.1, seed=6)[0]['text']
+    expected = facade.build_transforms(services.comprehend.detect_pii_entities(Text=text, LanguageCode='en')
+                                       ['Entities'])
+    detect_threads = set()
+
+    def detect_pii_entities_en(chunk: str) -> list:
+        detect_threads.add(threading.get_ident())
+        return facade_detect(chunk)
+
+    facade_detect, facade.ai_detect_facade = facade.ai_detect_facade, detect_pii_entities_en
+    assert facade.detect_pii_entities(text) == expected
+    assert services.comprehend.model.stats()['calls'] > len(text) // facade.max_text_size
+    # the chunks are detected by the calling worker, without a pool of their own
+    assert detect_threads == {threading.get_ident()}
@@ -0,0 +1,89 @@
+import dataclasses
+import datetime
+import decimal
+import importlib
+import json
+import math
+import sys
+
+import pytest
+
+import anonymizer.JsonCodec as JsonCodec
+
+VALUES = [
+    {'id': 1, 'text': "Call John Smith at 555-123-4567", 'score': 0.25, 'tags': ["a", "b"], 'ok': True, 'error': None},
+    {'text': "Zoë a appelé de São Paulo, 東京 ✓ 😀", 'quote': "\"quoted\" \\ back\\slash",
+     'control': "tab\tnew\nline\x01"},
+    ["line\u2028separator", "", 0, -7, 2 ** 63 - 1, 1.5, 0.1, -2.0],
+    "just a string",
+]
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+@pytest.fixture(params=[JsonCodec.ENCODER_ORJSON, JsonCodec.ENCODER_STDLIB])
+def codec(request, monkeypatch):
+    if request.param == JsonCodec.ENCODER_ORJSON:
+        pytest.importorskip('orjson')
+    else:
+        # the import of orjson raises ImportError
+        monkeypatch.setitem(sys.modules, 'orjson', None)
+    codec = importlib.reload(JsonCodec)
+    assert codec.ENCODER == request.param
+    yield codec
+    monkeypatch.undo()
+    importlib.reload(JsonCodec)
+
+
+def stdlib_dumps(value, default=None) -> bytes:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=default).encode('utf-8')
+
+
+@pytest.mark.parametrize('value', VALUES)
+def test_compact_utf8_documents(codec, value):
+    document = codec.dumps(value)
+    assert document == stdlib_dumps(value)
+    assert codec.dumps_text(value) == document.decode('utf-8')
+    assert codec.loads(document) == value
+    assert codec.loads(document.decode('utf-8')) == value
+
+
+def test_values_orjson_does_not_take(codec):
+    for value in [{'big': 2 ** 64}, {1: "one", 'two': 2}]:
+        assert codec.dumps(value) == stdlib_dumps(value)
+    assert math.isnan(codec.loads(b'{"value":NaN}')['value'])
+    # the exponents of floats are written the way of each encoder, the documents decode to the same values
+    assert codec.loads(codec.dumps([1e-7, 1e20, 1.5e300])) == [1e-7, 1e20, 1.5e300]
+    # a lone surrogate is not valid UTF-8, the document is escaped to ASCII
+    assert codec.dumps("a\ud800b") == b'"a\\ud800b"'
+
+
+def test_default_encodes_the_other_types(codec):
+    value = {'amount': decimal.Decimal('12.50'), 'at': datetime.datetime(2023, 2, 28, 9, 30),
+             'day': datetime.date(2023, 2, 28), 'point': Point(1, 2), 'names': ["Zoë"]}
+    assert codec.dumps(value, default=str) == stdlib_dumps(value, default=str)
+    assert codec.loads(codec.dumps_text(value, default=str)) == {
+        'amount': "12.50", 'at': "2023-02-28 09:30:00", 'day': "2023-02-28", 'point': "Point(x=1, y=2)",
+        'names': ["Zoë"]}
+    # without default they are not encoded, by either encoder
+    for other in value.values():
+        if not isinstance(other, list):
+            with pytest.raises(TypeError):
+                codec.dumps({'value': other})
+
+
+def test_encoders_give_equal_documents(monkeypatch):
+    pytest.importorskip('orjson')
+    value = VALUES + [{'amount': decimal.Decimal('1.10'), 'at': datetime.datetime(2023, 2, 28)}]
+    documents = [importlib.reload(JsonCodec).dumps(value, default=str)]
+    monkeypatch.setitem(sys.modules, 'orjson', None)
+    try:
+        documents.append(importlib.reload(JsonCodec).dumps(value, default=str))
+    finally:
+        monkeypatch.undo()
+        importlib.reload(JsonCodec)
+    assert documents[0] == documents[1]
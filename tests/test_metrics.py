@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.Metrics as Metrics
+import anonymizer.server as server
+import corpus
+import stand_ins
+
+
+def test_merge_adds_counters_and_histograms():
+    metrics = Metrics.MetricsRecorder()
+    for milliseconds in [3, 40]:
+        other = Metrics.MetricsRecorder()
+        other.increment(Metrics.RECORDS, 2)
+        other.record_latency(Metrics.STAGE_DETECT, milliseconds)
+        metrics.merge(other)
+    histogram = metrics.histograms[Metrics.STAGE_DETECT].to_dict()
+    assert metrics.counters == {Metrics.RECORDS: 4}
+    assert (histogram['count'], histogram['sum'], histogram['min'], histogram['max']) == (2, 43, 3, 40)
+    assert histogram['buckets'] == {'5': 1, '50': 1}
+
+
+def test_concurrent_invocations_record_in_their_own_recorder():
+    recorders = {}
+    barrier = threading.Barrier(2)
+
+    def invocation(name: str, records: int) -> None:
+        recorders[name] = Metrics.reset()
+        barrier.wait()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # the work handed to a thread pool records in the recorder of the invocation
+            anonymizer.map_concurrently(lambda _: Metrics.current().increment(Metrics.RECORDS), range(records),
+                                        executor)
+
+    threads = [threading.Thread(target=invocation, args=('a', 3)), threading.Thread(target=invocation, args=('b', 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert recorders['a'].counters == {Metrics.RECORDS: 3}
+    assert recorders['b'].counters == {Metrics.RECORDS: 5}
+
+
+def test_batches_of_the_server_merge_their_metrics():
+    stand_ins.StandIns(corpus.vocabulary('en')).install()
+    try:
+        metrics = Metrics.MetricsRecorder()
+        process_batch = server.create_batch_processor(metrics, concurrency=2)
+        records = corpus.generate_records(6, 200, 0.1, seed=4)
+        key = server.batch_key(anonymizer.ANONYMIZER_MODE, 'en', 'text', anonymizer.get_client_control_options({})[0])
+        process_batch(key, records[:2])
+        process_batch(key, records[2:])
+        assert metrics.counters[Metrics.RECORDS] == 6
+        assert metrics.histograms[Metrics.STAGE_DETECT].count >= 2
+    finally:
+        ClientRegistry.reset()
+
+
+def test_cache_pattern_and_throttling_counters_are_in_the_emf_line():
+    stand_ins.StandIns(corpus.vocabulary('en'), comprehend_model=stand_ins.ServiceModel(throttle_rate=0.3, seed=1))\
+        .install()
+    try:
+        metrics = Metrics.reset()
+        records = corpus.generate_records(20, 200, 0.1, seed=7) + [{'text': "it is for you and me, a@b.com"}]
+        for _ in range(2):
+            # the second time the texts are in the cache
+            anonymizer.anonymize_records([dict(record) for record in records], 'text', pre_detection='conservative')
+        document = metrics.to_emf({'mode': anonymizer.ANONYMIZER_MODE})
+        names = [metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        for name in [Metrics.DETECTION_CACHE_HITS, Metrics.DETECTION_CACHE_MISSES, Metrics.REMOTE_CALLS_AVOIDED,
+                     Metrics.THROTTLED_CALLS]:
+            assert name in names and document[name] > 0
+    finally:
+        ClientRegistry.reset()
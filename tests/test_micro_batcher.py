@@ -0,0 +1,121 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import anonymizer.MicroBatcher as MicroBatcher
+
+TIMEOUT_SECONDS = 5
+
+
+class RecordingProcessor:
+    """
+    Batch processor tagging each record with the key of its batch, and recording the batches
+    """
+
+    def __init__(self, failing_keys=()):
+        self.failing_keys = set(failing_keys)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, key, records: list) -> list:
+        with self.lock:
+            self.batches.append((key, list(records)))
+        if key in self.failing_keys:
+            raise KeyError(key)
+        if key == 'short':
+            return records[1:]
+        return [(key, record) for record in records]
+
+
+@pytest.fixture
+def processor():
+    return RecordingProcessor(failing_keys=['bad'])
+
+
+@pytest.fixture
+def make_batcher():
+    batchers = []
+
+    def make_batcher(process_batch, **kwargs):
+        batchers.append(MicroBatcher.MicroBatcher(process_batch, **kwargs))
+        return batchers[-1]
+
+    yield make_batcher
+    for batcher in batchers:
+        batcher.close()
+
+
+def test_batch_is_dispatched_when_full(processor, make_batcher):
+    batcher = make_batcher(processor, max_batch_records=4, max_wait_seconds=60)
+    first = batcher.submit('a', [1, 2])
+    second = batcher.submit('a', [3, 4, 5])
+    # the batch went at its size, well before its wait time
+    assert first.result(TIMEOUT_SECONDS) == [('a', 1), ('a', 2)]
+    assert second.result(TIMEOUT_SECONDS) == [('a', 3), ('a', 4), ('a', 5)]
+    assert processor.batches == [('a', [1, 2, 3, 4, 5])]
+    third = batcher.submit('a', [6])
+    assert not third.done()
+
+
+def test_batch_is_dispatched_when_its_wait_expires(processor, make_batcher):
+    batcher = make_batcher(processor, max_batch_records=1000, max_wait_seconds=0.05)
+    started = time.monotonic()
+    futures = [batcher.submit('a', [index]) for index in range(3)]
+    assert [future.result(TIMEOUT_SECONDS) for future in futures] == [[('a', 0)], [('a', 1)], [('a', 2)]]
+    assert time.monotonic() - started >= 0.05
+    # the requests of the wait share the batch
+    assert processor.batches == [('a', [0, 1, 2])]
+    assert batcher.stats() == {'requests': 3, 'records': 3, 'batches': 1, 'requests_per_batch': 3.0,
+                               'records_per_batch': 3.0}
+
+
+def test_requests_of_other_keys_do_not_share_a_batch(processor, make_batcher):
+    batcher = make_batcher(processor, max_batch_records=1000, max_wait_seconds=0.02)
+    futures = {key: batcher.submit(key, [key.upper()]) for key in ['a', 'b', 'c']}
+    assert {key: future.result(TIMEOUT_SECONDS) for key, future in futures.items()} == \
+        {'a': [('a', "A")], 'b': [('b', "B")], 'c': [('c', "C")]}
+    assert sorted(processor.batches) == [('a', ["A"]), ('b', ["B"]), ('c', ["C"])]
+
+
+def test_errors_reach_the_requests_of_the_failed_batch(processor, make_batcher):
+    batcher = make_batcher(processor, max_batch_records=1000, max_wait_seconds=0.02)
+    failed = [batcher.submit('bad', [1]), batcher.submit('bad', [2, 3])]
+    short = batcher.submit('short', [1, 2])
+    succeeded = batcher.submit('good', [4])
+    for future in failed:
+        with pytest.raises(KeyError):
+            future.result(TIMEOUT_SECONDS)
+    # a batch with a result missing fails too, no request gets the results of another one
+    with pytest.raises(ValueError):
+        short.result(TIMEOUT_SECONDS)
+    assert succeeded.result(TIMEOUT_SECONDS) == [('good', 4)]
+
+
+def test_results_reach_their_request(make_batcher):
+    def process_batch(key, records: list) -> list:
+        time.sleep(0.001)
+        return [record * 10 for record in records]
+
+    batcher = make_batcher(process_batch, max_batch_records=50, max_wait_seconds=0.005, workers=2)
+
+    def process(request: int) -> (list, list):
+        records = list(range(request * 100, request * 100 + request % 7 + 1))
+        return batcher.process('key', records), [record * 10 for record in records]
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for results, expected in executor.map(process, range(200)):
+            assert results == expected
+    stats = batcher.stats()
+    assert stats['requests'] == 200 and stats['batches'] < 200
+
+
+def test_close_dispatches_the_pending_batches(processor, make_batcher):
+    batcher = make_batcher(processor, max_batch_records=1000, max_wait_seconds=60)
+    future = batcher.submit('a', [1])
+    assert batcher.submit('a', []).result(0) == []
+    batcher.close()
+    assert future.result(0) == [('a', 1)]
+    with pytest.raises(RuntimeError):
+        batcher.submit('a', [2])
@@ -0,0 +1,54 @@
+import pytest
+
+import anonymizer.PatternDetector as PatternDetector
+
+
+@pytest.fixture(params=[PatternDetector.POLICY_CONSERVATIVE, PatternDetector.POLICY_AGGRESSIVE])
+def detector(request):
+    return PatternDetector.PatternDetector(language_code='en', policy=request.param)
+
+
+@pytest.mark.parametrize('text', [
+    "John called about the invoice.",
+    "Thanks. Mary will call back.",
+    "my name is john smith and my email is john@example.com",
+    "Call me at 555-123-4567, Robert",
+])
+def test_names_need_remote_detection(detector, text):
+    assert detector.detect_pii_entities(text) is None
+
+
+def test_french_names_need_remote_detection():
+    detector = PatternDetector.PatternDetector(language_code='fr', policy=PatternDetector.POLICY_CONSERVATIVE)
+    assert detector.detect_pii_entities("Camille a appelé. merci") is None
+    assert detector.detect_pii_entities("merci de rappeler léa martin") is None
+
+
+def test_stopwords_and_patterns_skip_remote_detection(detector):
+    text = "Please, 555-123-4567 or help@example.com. Thanks"
+    transforms = detector.detect_pii_entities(text)
+    assert [(transform['Type'], text[transform['BeginOffset']:transform['EndOffset']])
+            for transform in transforms['Transforms']] == [('PHONE', '555-123-4567'), ('EMAIL', 'help@example.com')]
+
+
+def test_empty_text_skips_remote_detection(detector):
+    assert detector.detect_pii_entities("") == {'Transforms': []}
+
+
+@pytest.mark.parametrize('text', ["my number is 123-45-6789", "it is 4111 1111 1111 1111"])
+def test_long_numbers_need_remote_detection(detector, text):
+    assert detector.detect_pii_entities(text) is None
+
+
+def test_short_numbers_by_policy():
+    text = "it is 2 of them"
+    conservative = PatternDetector.PatternDetector(policy=PatternDetector.POLICY_CONSERVATIVE)
+    aggressive = PatternDetector.PatternDetector(policy=PatternDetector.POLICY_AGGRESSIVE)
+    assert conservative.detect_pii_entities(text) is None
+    assert aggressive.detect_pii_entities(text) == {'Transforms': []}
+
+
+def test_policy_off_always_needs_remote_detection():
+    detector = PatternDetector.PatternDetector(policy=PatternDetector.POLICY_OFF)
+    assert detector.detect_pii_entities("thanks") is None
+    assert detector.stats()['texts_seen'] == 0
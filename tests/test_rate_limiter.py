@@ -0,0 +1,200 @@
+import pytest
+
+import anonymizer.Metrics as Metrics
+import anonymizer.RateLimiter as RateLimiter
+import stand_ins
+
+
+# A sleep lasts at least the resolution of the clock, like the sleeps of the system
+CLOCK_RESOLUTION_SECONDS = 1e-6
+
+
+class FakeClock:
+    """
+    Clock of the limiter, sleeping advances it at once and counts the time slept
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        seconds = max(seconds, CLOCK_RESOLUTION_SECONDS)
+        self.slept += seconds
+        self.now += seconds
+
+    def sleeping(self):
+        """
+        :return: the time slept since the last call
+        """
+        slept, self.slept = self.slept, 0.0
+        return pytest.approx(slept, abs=1e-5)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(RateLimiter, 'time', clock)
+    return clock
+
+
+def make_calls(limiter: RateLimiter.AdaptiveRateLimiter, clock: FakeClock, count: int, interval: float) -> None:
+    for _ in range(count):
+        limiter.acquire()
+        clock.now += interval
+    clock.now -= interval
+
+
+def test_unbounded_limiter_does_not_wait(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    for _ in range(1000):
+        limiter.acquire()
+    assert clock.sleeping() == 0
+    assert limiter.stats() == {'rate': None, 'calls': 1000, 'throttled': 0}
+
+
+def test_token_bucket_acquisition(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter(rate=10)
+    # the bucket holds BURST_SECONDS of requests, then a request waits for its token
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeping() == 0
+    limiter.acquire()
+    assert clock.sleeping() == 0.1
+    # an idle period refills the bucket up to its capacity only
+    clock.now += 5
+    limiter.acquire()
+    limiter.acquire()
+    assert clock.sleeping() == 0
+    limiter.acquire()
+    assert clock.sleeping() == 0.1
+
+
+def test_request_larger_than_the_bucket_leaves_it_in_debt(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter(rate=10)
+    limiter.acquire()
+    # the request waits for a full bucket, not for its own units
+    limiter.acquire(10)
+    assert clock.sleeping() == 0.1
+    limiter.acquire()
+    assert clock.sleeping() == 0.9
+    assert limiter.stats()['calls'] == 3
+
+
+def test_throttling_cuts_the_rate_once_per_window(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    make_calls(limiter, clock, 10, 0.1)
+    # within the tolerance, the throttled units are only retried
+    limiter.on_throttle(2)
+    assert limiter.stats()['rate'] is None
+    limiter.on_throttle(1)
+    cut_rate = 10 / 0.9 * RateLimiter.RATE_DECREASE_FACTOR
+    assert limiter.stats()['rate'] == pytest.approx(cut_rate)
+    # the calls in flight are throttled together, the rate is not cut again in the same window
+    limiter.on_throttle(5)
+    assert limiter.stats() == {'rate': pytest.approx(cut_rate), 'calls': 10, 'throttled': 3}
+    clock.now += RateLimiter.RATE_WINDOW_SECONDS
+    make_calls(limiter, clock, 10, 0.1)
+    limiter.on_throttle(10)
+    assert limiter.stats()['rate'] < cut_rate
+
+
+def test_sporadic_throttling_does_not_cut_the_rate(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    make_calls(limiter, clock, RateLimiter.MIN_WINDOW_CALLS - 1, 0.1)
+    limiter.on_throttle(RateLimiter.MIN_WINDOW_CALLS - 1)
+    assert limiter.stats()['rate'] is None
+
+
+def test_rate_is_not_cut_below_the_minimum(clock, monkeypatch):
+    monkeypatch.setattr(RateLimiter, 'MIN_RATE', 50.0)
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    make_calls(limiter, clock, 10, 0.1)
+    limiter.on_throttle(10)
+    assert limiter.stats()['rate'] == 50.0
+
+
+def test_rate_recovers_while_the_service_accepts_the_calls(clock):
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    make_calls(limiter, clock, 10, 0.1)
+    limiter.on_throttle(10)
+    cut_rate = limiter.stats()['rate']
+    # about a second of calls at the cut rate grows it by RATE_GROWTH_PER_SECOND
+    calls = round(cut_rate)
+    for _ in range(calls):
+        limiter.call(lambda: None)
+    assert limiter.stats()['rate'] == pytest.approx(cut_rate + RateLimiter.RATE_GROWTH_PER_SECOND * calls)
+    # the calls waited for the rate, less than a second with the burst and the growth
+    assert 0.5 < clock.slept < calls / cut_rate
+    # an unbounded limiter stays unbounded
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    limiter.call(lambda: None)
+    assert limiter.stats()['rate'] is None
+
+
+def test_call_retries_throttled_calls(clock, monkeypatch):
+    monkeypatch.setattr(RateLimiter, 'backoff_delay', lambda attempt: 2.0 ** attempt)
+    metrics = Metrics.reset()
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    outcomes = [stand_ins.client_error('ThrottlingException', 'Rate exceeded', 'DetectPiiEntities')] * 2 + ['done']
+
+    def function(value: str) -> str:
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return value + outcome
+
+    assert limiter.call(function, 'all ') == 'all done'
+    assert clock.sleeping() == 3.0
+    assert limiter.stats() == {'rate': None, 'calls': 3, 'throttled': 2}
+    assert metrics.counters[Metrics.THROTTLED_CALLS] == 2
+
+
+def test_call_gives_up_after_the_retries(clock, monkeypatch):
+    monkeypatch.setattr(RateLimiter, 'backoff_delay', lambda attempt: 0)
+    limiter = RateLimiter.AdaptiveRateLimiter()
+    error = stand_ins.client_error('ProvisionedThroughputExceededException', 'Slow down', 'PutItem')
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise error
+
+    with pytest.raises(type(error)):
+        limiter.call(throttled)
+    assert len(calls) == RateLimiter.MAX_RETRIES + 1
+
+    def failed():
+        calls.append(1)
+        raise stand_ins.client_error('ValidationException', 'Bad request', 'PutItem')
+
+    calls.clear()
+    with pytest.raises(type(error)):
+        limiter.call(failed)
+    assert len(calls) == 1
+
+
+def test_throttling_errors():
+    assert RateLimiter.is_throttling_error(stand_ins.client_error('SlowDown', 'Slow down', 'PutObject'))
+    assert not RateLimiter.is_throttling_error(stand_ins.client_error('AccessDenied', 'Denied', 'PutObject'))
+    assert not RateLimiter.is_throttling_error(ValueError('ThrottlingException'))
+
+
+def test_backoff_delay_is_bounded():
+    for attempt in range(20):
+        delay = RateLimiter.backoff_delay(attempt)
+        assert 0 <= delay <= min(RateLimiter.BACKOFF_MAX_SECONDS, RateLimiter.BACKOFF_BASE_SECONDS * 2 ** attempt)
+
+
+def test_limiters_are_shared_until_reset():
+    RateLimiter.reset()
+    limiter = RateLimiter.get_limiter('comprehend')
+    assert RateLimiter.get_limiter('comprehend') is limiter
+    assert RateLimiter.get_limiter('dynamodb') is not limiter
+    assert set(RateLimiter.stats()) == {'comprehend', 'dynamodb'}
+    RateLimiter.reset()
+    assert RateLimiter.get_limiter('comprehend') is not limiter
+    RateLimiter.reset()
@@ -0,0 +1,90 @@
+import copy
+
+import pytest
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.RevertTokens as RevertTokens
+import corpus
+import stand_ins
+
+pytest.importorskip('cryptography')
+
+TRANSFORMS = {'Transforms': [{'Type': 'NAME', 'BeginOffset': 5, 'EndOffset': 15, 'Original': "John Smith",
+                              'Anonymized': "John Doe", 'AnonBeginOffset': 5, 'AnonEndOffset': 12}]}
+BINDING = RevertTokens.record_binding({'text': "Call John Doe today"})
+
+
+@pytest.fixture
+def keyring():
+    return RevertTokens.RevertTokenKeyring({'1': bytes(32), '2': bytes(range(32))}, current_version='1')
+
+
+def test_round_trip(keyring):
+    token = keyring.encrypt(TRANSFORMS, BINDING)
+    assert token.startswith('rt1.1.')
+    assert keyring.decrypt(token, BINDING) == TRANSFORMS
+
+
+@pytest.mark.parametrize('field_texts', [{'text': "Call John Doe today!"},
+                                         {'notes': "Call John Doe today"},
+                                         {'text': "Call John Doe today", 'notes': ""}])
+def test_token_is_bound_to_its_record_and_field(keyring, field_texts):
+    token = keyring.encrypt(TRANSFORMS, BINDING)
+    with pytest.raises(ValueError):
+        keyring.decrypt(token, RevertTokens.record_binding(field_texts))
+
+
+def test_tampered_token_is_rejected(keyring):
+    token = keyring.encrypt(TRANSFORMS, BINDING)
+    payload = RevertTokens.decode_base64(token.split('.')[2])
+    tampered = payload[:-1] + bytes([payload[-1] ^ 1])
+    with pytest.raises(ValueError):
+        keyring.decrypt(f"rt1.1.{RevertTokens.encode_base64(tampered)}", BINDING)
+    # the key version is authenticated too
+    with pytest.raises(ValueError):
+        keyring.decrypt(token.replace('rt1.1.', 'rt1.2.'), BINDING)
+    with pytest.raises(ValueError):
+        keyring.decrypt('rt0.1.' + token.split('.')[2], BINDING)
+
+
+def test_tokens_of_an_older_key_still_decrypt(keyring):
+    token = keyring.encrypt(TRANSFORMS, BINDING)
+    keyring.current_version = '2'
+    assert keyring.encrypt(TRANSFORMS, BINDING).startswith('rt1.2.')
+    assert keyring.decrypt(token, BINDING) == TRANSFORMS
+
+
+def test_revert_records_with_tokens(keyring, monkeypatch):
+    stand_ins.StandIns(corpus.vocabulary('en')).install()
+    monkeypatch.setattr(anonymizer, 'revert_token_keyring', keyring)
+    try:
+        records = corpus.generate_records(4, 200, 0.2, seed=9)
+        anonymized = anonymizer.anonymize_records(copy.deepcopy(records), 'text',
+                                                  revert_mode=anonymizer.REVERT_MODE_TOKEN)
+        assert all('revert_token' in record for record in anonymized)
+        # a token moved to another record does not decrypt there
+        anonymized[0]['revert_token'], anonymized[1]['revert_token'] = \
+            anonymized[1]['revert_token'], anonymized[0]['revert_token']
+        reverted = anonymizer.revert_records(anonymized, 'text')
+        assert [anonymizer.ERROR_FIELD_NAME in record for record in reverted] == [True, True, False, False]
+        assert reverted[2:] == records[2:]
+    finally:
+        ClientRegistry.reset()
+
+
+def test_revert_records_with_tokens_of_several_fields(keyring, monkeypatch):
+    stand_ins.StandIns(corpus.vocabulary('en')).install()
+    monkeypatch.setattr(anonymizer, 'revert_token_keyring', keyring)
+    try:
+        records = [{'id': index, 'text': record['text'], 'notes': record['text'][::-1]}
+                   for index, record in enumerate(corpus.generate_records(3, 200, 0.2, seed=2))]
+        records[2].pop('notes')
+        anonymized = anonymizer.anonymize_records(copy.deepcopy(records), ['text', 'notes'],
+                                                  revert_mode=anonymizer.REVERT_MODE_TOKEN)
+        assert anonymizer.revert_records(copy.deepcopy(anonymized), ['text', 'notes']) == records
+        # the token of two fields does not decrypt for one of them, the last record only has the one field
+        assert [anonymizer.ERROR_FIELD_NAME in record for record in anonymizer.revert_records(anonymized, 'text')] \
+            == [True, True, False]
+    finally:
+        ClientRegistry.reset()
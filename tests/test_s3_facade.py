@@ -0,0 +1,148 @@
+import io
+import os
+
+import pytest
+
+import anonymizer.S3Facade as S3Facade
+import stand_ins
+
+pyarrow = pytest.importorskip('pyarrow')
+
+RECORDS = [{'id': 1, 'text': "a", 'score': 1.5},
+           {'id': 2, 'text': "b", 'score': 2, 'tags': None},
+           {'id': 3, 'text': None, 'score': "high", 'revert_key': "k3"},
+           {'id': 4, 'text': "d", 'score': 4, 'tags': ["x"]}]
+
+
+class PartSink(io.BytesIO):
+    """
+    Sink of a part, keeping its content once the writer closes it
+    """
+
+    def __init__(self, parts: list):
+        super().__init__()
+        self.parts = parts
+
+    def close(self) -> None:
+        self.parts.append(self.getvalue())
+        super().close()
+
+
+def read_part(content: bytes, output_format: str):
+    if output_format == S3Facade.OUTPUT_FORMAT_PARQUET:
+        return pyarrow.parquet.read_table(io.BytesIO(content))
+    return pyarrow.ipc.open_file(io.BytesIO(content)).read_all()
+
+
+def write_parts(records: list, output_format: str, batch_records: int, row_group_target_bytes: int,
+                schema=None) -> (list, int):
+    parts = []
+    writer = S3Facade.ColumnarRecordWriter(lambda part: PartSink(parts), output_format, nullable_fields=['error'],
+                                           row_group_target_bytes=row_group_target_bytes, schema=schema)
+    for start in range(0, len(records), batch_records):
+        writer.write_records(records[start:start + batch_records])
+    writer.close()
+    assert writer.parts == len(parts)
+    return parts, writer.row_groups
+
+
+def write(records: list, output_format: str, batch_records: int, row_group_target_bytes: int, schema=None):
+    parts, row_groups = write_parts(records, output_format, batch_records, row_group_target_bytes, schema)
+    return [read_part(content, output_format) for content in parts], row_groups
+
+
+@pytest.mark.parametrize('output_format', S3Facade.COLUMNAR_OUTPUT_FORMATS)
+def test_schema_of_all_the_records(output_format):
+    (table,), row_groups = write(RECORDS, output_format, len(RECORDS), S3Facade.ROW_GROUP_TARGET_BYTES)
+    assert table.schema.names == ['id', 'text', 'score', 'tags', 'revert_key', 'error']
+    assert str(table.schema.field('id').type) == 'int64'
+    assert str(table.schema.field('score').type) == 'string'
+    assert pyarrow.types.is_list(table.schema.field('tags').type)
+    assert table.to_pylist() == [
+        {'id': 1, 'text': "a", 'score': "1.5", 'tags': None, 'revert_key': None, 'error': None},
+        {'id': 2, 'text': "b", 'score': "2", 'tags': None, 'revert_key': None, 'error': None},
+        {'id': 3, 'text': None, 'score': "high", 'tags': None, 'revert_key': "k3", 'error': None},
+        {'id': 4, 'text': "d", 'score': "4", 'tags': ["x"], 'revert_key': None, 'error': None}]
+    assert row_groups == 1
+
+
+@pytest.mark.parametrize('output_format', S3Facade.COLUMNAR_OUTPUT_FORMATS)
+def test_row_groups_are_written_as_they_fill(output_format):
+    records = [{'id': index, 'text': f"text {index}"} for index in range(10)]
+    (part,), row_groups = write_parts(records, output_format, 2, 1)
+    assert row_groups == 5
+    if output_format == S3Facade.OUTPUT_FORMAT_PARQUET:
+        assert pyarrow.parquet.ParquetFile(io.BytesIO(part)).metadata.num_row_groups == 5
+    assert read_part(part, output_format).column('id').to_pylist() == list(range(10))
+
+
+@pytest.mark.parametrize('output_format', S3Facade.COLUMNAR_OUTPUT_FORMATS)
+def test_wider_records_start_a_new_part(output_format):
+    tables, _ = write(RECORDS, output_format, 1, S3Facade.ROW_GROUP_TARGET_BYTES)
+    # 2 is conformed to the float of the first part, and the tags without values are null, then the string score,
+    # the revert_key and the list of tags need wider schemas
+    assert [table.num_rows for table in tables] == [2, 1, 1]
+    assert [str(table.schema.field('score').type) for table in tables] == ['double', 'string', 'string']
+    assert tables[0].schema.names == ['id', 'text', 'score', 'error']
+    assert tables[2].schema.names == ['id', 'text', 'score', 'error', 'revert_key', 'tags']
+    assert [record['score'] for table in tables for record in table.to_pylist()] == [1.5, 2.0, "high", "4"]
+    assert tables[2].to_pylist()[0]['tags'] == ["x"]
+
+
+def test_records_are_conformed_to_the_part():
+    records = [{'value': 1.5, 'name': None}, {'value': 2}, {'value': None, 'name': 7}]
+    (table,), _ = write(records, S3Facade.OUTPUT_FORMAT_PARQUET, 1, 1)
+    assert str(table.schema.field('value').type) == 'double'
+    assert table.column('value').to_pylist() == [1.5, 2.0, None]
+    # a field always null when the part was opened is a string, later values are written as JSON
+    assert table.column('name').to_pylist() == [None, None, "7"]
+
+
+def test_declared_schema():
+    schema = pyarrow.schema([pyarrow.field('value', pyarrow.float64()), pyarrow.field('note', pyarrow.string())])
+    (table,), _ = write([{'value': 1}, {'value': 2, 'note': 3}], S3Facade.OUTPUT_FORMAT_PARQUET, 1, 1, schema)
+    assert table.schema.names == ['value', 'note', 'error']
+    assert table.to_pylist() == [{'value': 1.0, 'note': None, 'error': None},
+                                 {'value': 2.0, 'note': "3", 'error': None}]
+
+
+def test_conflicting_types_in_a_batch_are_strings():
+    (table,), _ = write([{'value': 1}, {'value': "one"}, {'only_last': True}], S3Facade.OUTPUT_FORMAT_PARQUET, 3,
+                        S3Facade.ROW_GROUP_TARGET_BYTES)
+    assert table.column('value').to_pylist() == ["1", "one", None]
+    assert table.column('only_last').to_pylist() == [None, None, True]
+
+
+def test_empty_output_has_the_nullable_fields():
+    (table,), _ = write([], S3Facade.OUTPUT_FORMAT_PARQUET, 1, S3Facade.ROW_GROUP_TARGET_BYTES)
+    assert table.schema.names == ['error'] and table.num_rows == 0
+
+
+def test_parts_are_written_to_s3_as_they_complete():
+    s3 = stand_ins.FakeS3()
+    facade = S3Facade.S3Facade('bucket', s3_client=s3)
+    keys = facade.write_records_to_s3(RECORDS, 'out', S3Facade.OUTPUT_FORMAT_PARQUET)
+    assert keys == ['out.parquet']
+    keys = facade.write_records_to_s3(RECORDS[:1] + [{'id': "two"}], 'wide', S3Facade.OUTPUT_FORMAT_PARQUET,
+                                      nullable_fields=['error'])
+    assert keys == ['wide.parquet']
+    records = iter([RECORDS[0]] * S3Facade.COLUMNAR_BATCH_RECORDS + [{'id': "two"}])
+    keys = facade.write_records_to_s3(records, 'parts', S3Facade.OUTPUT_FORMAT_PARQUET)
+    assert keys == ['parts.parquet', 'parts-0002.parquet']
+    assert [read_part(s3.objects[('bucket', key)], S3Facade.OUTPUT_FORMAT_PARQUET).num_rows for key in keys] == \
+        [S3Facade.COLUMNAR_BATCH_RECORDS, 1]
+
+
+def test_failed_output_aborts_the_open_part():
+    s3 = stand_ins.FakeS3()
+    facade = S3Facade.S3Facade('bucket', s3_client=s3, part_size=5 * 1024 * 1024)
+
+    def records():
+        # a first row group is written, and uploaded in parts, before the failure
+        yield from [{'id': index, 'text': os.urandom(20000).hex()} for index in range(S3Facade.COLUMNAR_BATCH_RECORDS)]
+        raise KeyError('boom')
+
+    with pytest.raises(KeyError):
+        facade.write_records_to_s3(records(), 'failed', S3Facade.OUTPUT_FORMAT_PARQUET, compression='none')
+    assert s3.model.stats()['calls'] > 1
+    assert not s3.objects and not s3.uploads
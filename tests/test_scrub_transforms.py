@@ -0,0 +1,45 @@
+import anonymizer.ScrubTransforms as ScrubTransforms
+
+TEXT = "Call John Smith at 555-123-4567 or john@example.com today"
+
+
+def transform(text: str, entity: str, entity_type: str, anonymized: str) -> dict:
+    begin_offset = text.index(entity)
+    return {'Type': entity_type, 'BeginOffset': begin_offset, 'EndOffset': begin_offset + len(entity),
+            'Original': entity, 'Anonymized': anonymized}
+
+
+def transforms() -> dict:
+    return {'Transforms': [transform(TEXT, "John Smith", 'PERSON', "John Doe"),
+                           transform(TEXT, "555-123-4567", 'PHONE', "(555) 555-5555"),
+                           transform(TEXT, "john@example.com", 'EMAIL', "anon@anon.com")]}
+
+
+def test_rewrite_spans():
+    text, offsets = ScrubTransforms.rewrite_spans("abcdef", [(1, 2, "XYZ"), (4, 6, "")])
+    assert text == "aXYZcd"
+    assert offsets == [(1, 4), (6, 6)]
+    assert ScrubTransforms.rewrite_spans("abc", []) == ("abc", [])
+
+
+def test_anonymous_offsets_and_round_trip():
+    transform_as_dict = transforms()
+    anonymous_text, transform_as_dict = ScrubTransforms.ScrubTransforms.generate_anonymous_text(TEXT,
+                                                                                              transform_as_dict)
+    assert anonymous_text == "Call John Doe at (555) 555-5555 or anon@anon.com today"
+    for entity in transform_as_dict['Transforms']:
+        assert anonymous_text[entity['AnonBeginOffset']:entity['AnonEndOffset'] + 1] == entity['Anonymized']
+    assert ScrubTransforms.ScrubTransforms.generate_original_text(anonymous_text, transform_as_dict) == TEXT
+    assert ScrubTransforms.ScrubTransforms.generate_irreversible_text(TEXT, transforms()) == anonymous_text
+
+
+def test_overlapping_transforms_are_resolved():
+    text = "Write to Mary Jane Watson today"
+    transform_as_dict = {'Transforms': [transform(text, "Jane Watson", 'NAME', "Doe"),
+                                        transform(text, "Mary Jane", 'PERSON', "John"),
+                                        transform(text, "Mary Jane Watson", 'PERSON', "John Doe")]}
+    anonymous_text, transform_as_dict = ScrubTransforms.ScrubTransforms.generate_anonymous_text(text,
+                                                                                              transform_as_dict)
+    assert anonymous_text == "Write to John Doe today"
+    assert [entity['Original'] for entity in transform_as_dict['Transforms']] == ["Mary Jane Watson"]
+    assert ScrubTransforms.ScrubTransforms.generate_original_text(anonymous_text, transform_as_dict) == text
@@ -0,0 +1,80 @@
+import http.client
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import anonymizer.anonymizer as anonymizer
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.JsonCodec as JsonCodec
+import anonymizer.Metrics as Metrics
+import anonymizer.MicroBatcher as MicroBatcher
+import anonymizer.server as server
+import corpus
+import stand_ins
+
+REQUESTS = 12
+
+
+@pytest.fixture
+def address():
+    stand_ins.StandIns(corpus.vocabulary('en')).install()
+    metrics = Metrics.MetricsRecorder()
+    batcher = MicroBatcher.MicroBatcher(server.create_batch_processor(metrics), max_batch_records=100,
+                                        max_wait_seconds=0.02)
+    # port 0, any free port
+    http_server = server.create_server(batcher, metrics, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server.server_address
+    http_server.shutdown()
+    http_server.server_close()
+    batcher.close()
+    thread.join()
+    ClientRegistry.reset()
+
+
+def send(address, method: str, path: str, event=None, connection: http.client.HTTPConnection = None) -> tuple:
+    connection = connection or http.client.HTTPConnection(*address, timeout=10)
+    body = event if isinstance(event, bytes) or event is None else JsonCodec.dumps(event)
+    connection.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    return response.status, JsonCodec.loads(response.read())
+
+
+def test_concurrent_requests_share_batches(address):
+    requests = [[{'id': f"{request}-{index}", 'text': record['text']} for index, record in
+                 enumerate(corpus.generate_records(request % 4 + 1, 200, 0.2, seed=request))]
+                for request in range(REQUESTS)]
+
+    def round_trip(records: list) -> (list, list):
+        # the requests of a client share its connection
+        connection = http.client.HTTPConnection(*address, timeout=10)
+        try:
+            status, anonymized = send(address, 'POST', server.ANONYMIZE_PATH, {'records': records}, connection)
+            assert status == 200
+            status, reverted = send(address, 'POST', server.REVERT_PATH, {'records': anonymized}, connection)
+            assert status == 200
+            return anonymized, reverted
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=REQUESTS) as executor:
+        for records, (anonymized, reverted) in zip(requests, executor.map(round_trip, requests)):
+            assert [record['id'] for record in anonymized] == [record['id'] for record in records]
+            assert all('revert_key' in record and anonymizer.ERROR_FIELD_NAME not in record for record in anonymized)
+            assert reverted == records
+    status, stats = send(address, 'GET', server.STATS_PATH)
+    assert status == 200
+    assert stats['batcher']['requests'] == 2 * REQUESTS
+    assert stats['batcher']['batches'] < 2 * REQUESTS
+    assert stats['counters'][Metrics.RECORDS] == 2 * sum(len(records) for records in requests)
+
+
+def test_health_and_invalid_requests(address):
+    assert send(address, 'GET', server.HEALTH_PATH) == (200, {'status': 'ok'})
+    status, output = send(address, 'GET', '/missing')
+    assert status == 404 and anonymizer.ERROR_FIELD_NAME in output
+    assert send(address, 'POST', server.ANONYMIZE_PATH, b'{"records": [')[0] == 400
+    assert send(address, 'POST', server.ANONYMIZE_PATH, [1, 2])[0] == 400
+    assert send(address, 'POST', server.ANONYMIZE_PATH, {'records': []})[0] == 400
@@ -0,0 +1,42 @@
+import pytest
+
+import anonymizer.TransformCodec as TransformCodec
+
+
+def transform(entity_type: str, begin_offset: int, original: str, anonymized: str, anon_begin_offset: int) -> dict:
+    return {'Type': entity_type,
+            'BeginOffset': begin_offset,
+            'EndOffset': begin_offset + len(original),
+            'Original': original,
+            'Anonymized': anonymized,
+            'AnonBeginOffset': anon_begin_offset,
+            'AnonEndOffset': anon_begin_offset + len(anonymized) - 1}
+
+
+TRANSFORMS = {'Transforms': [transform('NAME', 5, "Zoë Ångström", "John Doe", 5),
+                             transform('CUSTOMER_ID', 30, "C-12345", "ID123", 26),
+                             transform('EMAIL', 60, "zoe@example.com", "anon@anon.com", 52)]}
+
+
+@pytest.mark.parametrize('scrub_xform', [TRANSFORMS, {'Transforms': []}])
+def test_round_trip_of_a_text(scrub_xform):
+    data = TransformCodec.encode(scrub_xform)
+    assert data[0] == TransformCodec.VERSION_1
+    assert TransformCodec.decode(data) == scrub_xform
+
+
+def test_round_trip_of_several_fields():
+    scrub_xform = {TransformCodec.FIELDS_KEY: {'subject': {'Transforms': TRANSFORMS['Transforms'][:1]},
+                                               'body': {'Transforms': []},
+                                               'notes ✓': {'Transforms': TRANSFORMS['Transforms'][1:]}}}
+    data = TransformCodec.encode(scrub_xform)
+    assert data[0] == TransformCodec.VERSION_2
+    decoded = TransformCodec.decode(data)
+    assert decoded == scrub_xform
+    assert list(decoded[TransformCodec.FIELDS_KEY]) == ['subject', 'body', 'notes ✓']
+
+
+def test_unsupported_version():
+    data = TransformCodec.encode(TRANSFORMS)
+    with pytest.raises(ValueError):
+        TransformCodec.decode(bytes([3]) + data[1:])
@@ -0,0 +1,74 @@
+import sqlite3
+
+import pytest
+
+import anonymizer.ClientRegistry as ClientRegistry
+import anonymizer.DynamoDBFacade as DynamoDBFacade
+import anonymizer.TransformStore as TransformStore
+import stand_ins
+
+
+def create_scrub_xform(index: int) -> dict:
+    return {'Transforms': [{'Type': 'NAME', 'BeginOffset': index, 'EndOffset': index + 4, 'Original': f"Jo{index}",
+                            'Anonymized': "Ann", 'AnonBeginOffset': index, 'AnonEndOffset': index + 3}]}
+
+
+@pytest.fixture(params=TransformStore.STORES)
+def store(request, tmp_path):
+    if request.param == TransformStore.STORE_DYNAMODB:
+        stand_ins.StandIns({}).install()
+        store = TransformStore.DynamoDBTransformStore(DynamoDBFacade.DynamoDBFacade('us-east-1'))
+    elif request.param == TransformStore.STORE_SQLITE:
+        store = TransformStore.SQLiteTransformStore(str(tmp_path / 'transforms.db'))
+    else:
+        store = TransformStore.InMemoryTransformStore()
+    yield store
+    ClientRegistry.reset()
+
+
+def test_base_store_is_abstract():
+    with pytest.raises(TypeError):
+        TransformStore.TransformStore()
+
+
+def test_round_trip_in_guid_order(store):
+    scrub_xforms = [create_scrub_xform(index) for index in range(store.write_batch_size)]
+    guids = store.put_many(scrub_xforms)
+    assert guids == [scrub_xform['guid'] for scrub_xform in scrub_xforms]
+    assert len(set(guids)) == len(guids)
+    requested = guids[::-1][:store.read_batch_size]
+    found = store.get_many(requested)
+    assert [scrub_xform['Transforms'] for scrub_xform in found] == \
+        [scrub_xforms[guids.index(guid)]['Transforms'] for guid in requested]
+
+
+def test_unknown_and_repeated_guids(store):
+    (guid,) = store.put_many([create_scrub_xform(1)])
+    found = store.get_many([guid, store.create_guid(), guid])
+    assert found[1] is None
+    assert found[0]['Transforms'] == found[2]['Transforms'] == create_scrub_xform(1)['Transforms']
+
+
+def test_close(store):
+    store.put_many([create_scrub_xform(2)])
+    store.close()
+    if isinstance(store, TransformStore.SQLiteTransformStore):
+        with pytest.raises(sqlite3.ProgrammingError):
+            store.get_many([store.create_guid()])
+
+
+def test_sqlite_store_is_persistent(tmp_path):
+    path = str(tmp_path / 'transforms.db')
+    store = TransformStore.SQLiteTransformStore(path)
+    (guid,) = store.put_many([create_scrub_xform(3)])
+    store.close()
+    reopened = TransformStore.SQLiteTransformStore(path)
+    assert reopened.get_many([guid])[0]['Transforms'] == create_scrub_xform(3)['Transforms']
+    reopened.close()
+
+
+def test_from_environment():
+    assert isinstance(TransformStore.from_environment(None, {TransformStore.STORE_ENVIRONMENT_VARIABLE: 'memory'}),
+                      TransformStore.InMemoryTransformStore)
+    with pytest.raises(ValueError):
+        TransformStore.from_environment(None, {TransformStore.STORE_ENVIRONMENT_VARIABLE: 'redis'})